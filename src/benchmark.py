@@ -0,0 +1,428 @@
+"""
+Benchmarks for the metadata pipeline, run against a synthetic library that
+is generated offline:
+
+    python benchmark.py --tracks 2000 --output results.json
+
+Each benchmark reports its throughput and peak Python memory, and the JSON
+results can be compared between commits.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any
+from collections.abc import Callable, Sequence
+
+from mutagen.id3 import (
+    APIC,
+    COMM,
+    ID3,
+    POPM,
+    SYLT,
+    TALB,
+    TCON,
+    TCOP,
+    TDRC,
+    TENC,
+    TIT2,
+    TPE1,
+    TPE2,
+    TPOS,
+    TRCK,
+    TSRC,
+    USLT,
+    WOAS,
+    Encoding,
+)
+from PIL import Image
+
+TRACKS_PER_ALBUM = 12
+# Edge lengths of the generated album art, from thumbnails to oversized scans
+ART_EDGES = (300, 640, 1000, 1500, 3000)
+
+WORDS = (
+    "love night heart light fire dream rain city gold river dance wild "
+    "home road summer shadow ocean sky stone echo silver ghost radio"
+).split()
+
+# A single silent MPEG-1 Layer III frame, repeated to make a small MP3
+SILENT_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413
+
+
+def words(rng: random.Random, count: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def make_art(rng: random.Random, edge: int, format: str) -> bytes:
+    """Generates a noisy gradient, which compresses like a real cover."""
+    small = Image.new("RGB", (16, 16))
+    small.putdata(
+        [
+            (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+            for _ in range(16 * 16)
+        ]
+    )
+    image = small.resize((edge, edge), Image.Resampling.BICUBIC)
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **({"quality": 90} if format == "JPEG" else {}))
+    return buffer.getvalue()
+
+
+def make_lyrics(rng: random.Random) -> list[tuple[int, str]]:
+    """Synced lyrics, starting with the credit lines clean_lyrics removes."""
+    lines = [(0, f"Written by : {words(rng, 2).title()}")]
+    lines += [(0, f"Produced by : {words(rng, 2).title()}")]
+    ms = 5000
+    for _ in range(rng.randint(20, 60)):
+        lines.append((ms, words(rng, rng.randint(3, 8)).capitalize()))
+        ms += rng.randint(1500, 6000)
+    return lines
+
+
+def lrc_timestamp(ms: int) -> str:
+    return f"{ms // 60000:02d}:{ms // 1000 % 60:02d}.{ms % 1000 // 10:02d}"
+
+
+def format_lrc(lyrics: list[tuple[int, str]]) -> str:
+    return "".join(f"[{lrc_timestamp(ms)}]{text}\n" for ms, text in lyrics)
+
+
+def make_enhanced_lrc(rng: random.Random, lines: int, offset: bool = True) -> str:
+    """
+    A long Enhanced LRC file: header tags and (optionally) an offset, word
+    timestamps on every line, and a chorus repeated under several timestamps.
+    """
+    result = [f"[ar:{words(rng, 2).title()}]", f"[ti:{words(rng, 3).title()}]"]
+    if offset:
+        result.append(f"[offset:{rng.randint(-500, 500):+d}]")
+    chorus = words(rng, 6).capitalize()
+    ms = 5000
+    chorus_stamps: list[int] = []
+    for index in range(lines):
+        if index % 8 == 7:
+            chorus_stamps.append(ms)
+            ms += rng.randint(1500, 6000)
+            continue
+        chunks: list[str] = []
+        word_ms = ms
+        for word in words(rng, rng.randint(3, 8)).split():
+            chunks.append(f"<{lrc_timestamp(word_ms)}>{word} ")
+            word_ms += rng.randint(150, 600)
+        result.append(f"[{lrc_timestamp(ms)}]" + "".join(chunks).rstrip())
+        ms = word_ms + rng.randint(200, 2000)
+    # The chorus is written once per 16 repeats, with all of their timestamps
+    for start in range(0, len(chorus_stamps), 16):
+        stamps = chorus_stamps[start : start + 16]
+        result.append("".join(f"[{lrc_timestamp(ms)}]" for ms in stamps) + chorus)
+    return "\n".join(result) + "\n"
+
+
+LEGACY_LRC_REGEX = re.compile(r"\[(\d{2}):(\d{2})\.(\d{2,3})\]")
+
+
+def legacy_parse_lyrics(text: str) -> list[tuple[int | None, str]]:
+    """
+    The line by line parser that parse_lrc replaced, which ignored header
+    tags and [offset:]. Kept to compare the LRC benchmarks against.
+    """
+    from utils import to_ms
+
+    lines: list[tuple[int | None, str]] = []
+    for line in text.splitlines():
+        line = line.rstrip()
+        if line.startswith("[") and "]" in line:
+            time_part, rest = line.split("]", 1)
+            m = LEGACY_LRC_REGEX.match(time_part + "]")
+            if m:
+                lines.append((to_ms(m.group(1), m.group(2), m.group(3)), rest.lstrip()))
+                continue
+        lines.append((None, line.strip()))
+    return lines
+
+
+def generate_library(directory: Path, tracks: int, seed: int = 0) -> dict[str, Any]:
+    """
+    Writes a library of small MP3s with realistic ID3 frames under the
+    directory: text frames, URLs in WOAS and COMM, synced and unsynced
+    lyrics, and embedded PNG or JPEG art of varied sizes shared by each
+    album. Some tracks also get the .json, .lrc and cover.jpg sidecars the
+    metadata stages read. Returns the lyrics and art for the benchmarks of
+    single functions.
+    """
+    from metadata.tags import parse_id3_tags, tags_to_json
+
+    rng = random.Random(seed)
+    lrc_texts: list[str] = []
+    art: list[bytes] = []
+
+    for index in range(tracks):
+        album_index, track_number = divmod(index, TRACKS_PER_ALBUM)
+        album_rng = random.Random(seed * 1_000_003 + album_index)
+        artist = words(album_rng, 2).title()
+        album = words(album_rng, 3).title()
+        album_dir = directory / artist / f"{album} {album_index}"
+        if track_number == 0:
+            album_dir.mkdir(parents=True, exist_ok=True)
+            art_format = "PNG" if album_rng.random() < 0.3 else "JPEG"
+            album_art = make_art(album_rng, album_rng.choice(ART_EDGES), art_format)
+            art.append(album_art)
+            if album_rng.random() < 0.2:
+                (album_dir / "cover.jpg").write_bytes(make_art(album_rng, 640, "JPEG"))
+
+        title = words(rng, rng.randint(1, 4)).title()
+        mp3_path = album_dir / f"{track_number + 1:02d} {title}.mp3"
+        mp3_path.write_bytes(SILENT_FRAME * 40)
+
+        id3 = ID3()
+        id3.add(TIT2(encoding=3, text=title))
+        id3.add(TPE1(encoding=3, text=f"{artist}; {words(rng, 2).title()}"))
+        id3.add(TALB(encoding=3, text=album))
+        id3.add(TPE2(encoding=3, text=artist))
+        id3.add(TRCK(encoding=3, text=f"{track_number + 1}/{TRACKS_PER_ALBUM}"))
+        id3.add(TPOS(encoding=3, text="1/1"))
+        id3.add(TDRC(encoding=3, text=str(rng.randint(1960, 2025))))
+        id3.add(TCON(encoding=3, text=rng.choice(["Pop", "Rock", "Jazz", "Hip-Hop"])))
+        id3.add(TSRC(encoding=3, text=f"US{rng.randrange(10**10):010d}"))
+        id3.add(TCOP(encoding=3, text=f"{rng.randint(1960, 2025)} {artist} Records"))
+        id3.add(TENC(encoding=3, text="spotdl"))
+        id3.add(WOAS(url=f"https://open.spotify.com/track/{rng.randrange(16**22):022x}"))
+        id3.add(
+            COMM(
+                encoding=3,
+                lang="eng",
+                desc="",
+                text=f"https://music.youtube.com/watch?v={rng.randrange(16**11):011x} {words(rng, 4)}",
+            )
+        )
+        id3.add(POPM(email="", rating=rng.randrange(256), count=0))
+
+        lyrics = make_lyrics(rng)
+        lrc_texts.append(format_lrc(lyrics))
+        if rng.random() < 0.5:
+            id3.add(
+                SYLT(
+                    encoding=Encoding.UTF8,
+                    lang="eng",
+                    format=2,
+                    type=1,
+                    text=[(text, ms) for ms, text in lyrics],
+                )
+            )
+        id3.add(
+            USLT(
+                encoding=Encoding.UTF8,
+                lang="eng",
+                text="\n".join(text for _, text in lyrics),
+            )
+        )
+        id3.add(APIC(encoding=3, mime="image/jpeg", type=3, data=art[-1]))
+        id3.save(mp3_path)
+
+        # Some tracks have been edited through their sidecars
+        if rng.random() < 0.2:
+            tags = parse_id3_tags(id3)
+            tags.genre = "Edited"
+            mp3_path.with_suffix(".json").write_text(tags_to_json(tags))
+        if rng.random() < 0.2:
+            mp3_path.with_suffix(".lrc").write_text(lrc_texts[-1])
+
+    return {"lrc_texts": lrc_texts, "art": art}
+
+
+def measure(
+    name: str, items: int, function: Callable[[], Any], memory: bool = True
+) -> dict[str, Any]:
+    """
+    Runs the function once, returning its throughput and, if `memory` is
+    set, the peak memory traced while it ran. Tracing slows Python code
+    down, so time and memory are measured in separate runs where possible.
+    """
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    result: dict[str, Any] = {
+        "items": items,
+        "seconds": round(seconds, 4),
+        "per_second": round(items / seconds, 2) if seconds else None,
+    }
+    if memory:
+        tracemalloc.start()
+        function()
+        result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    print(
+        f"{name:<24} {items:>7} items  {seconds:>8.3f} s  "
+        f"{result['per_second'] or 0:>10.1f} /s"
+        + (f"  {result['peak_memory_bytes'] / 1e6:>8.1f} MB" if memory else "")
+    )
+    return result
+
+
+def run_benchmarks(
+    tracks: int, seed: int, workers: int, work_dir: Path
+) -> dict[str, dict[str, Any]]:
+    from metadata.album_art import convert_to_jpeg
+    from metadata.lyrics import parse_lrc, parse_lyrics, serialize_to_lrc
+    from metadata.main import load_id3, process_directory, process_file
+    from metadata.tags import parse_id3_tags
+
+    source = work_dir / "source"
+    print(f"Generating {tracks} tracks in {source}...")
+    start = time.perf_counter()
+    corpus = generate_library(source, tracks, seed)
+    print(f"Generated the library in {time.perf_counter() - start:.1f} s")
+    mp3_files = sorted(source.rglob("*.mp3"))
+    id3s = [load_id3(mp3_file) for mp3_file in mp3_files]
+
+    def fresh_copy(name: str) -> Path:
+        """process_file writes, so every benchmark that runs it gets a copy."""
+        target = work_dir / name
+        shutil.rmtree(target, ignore_errors=True)
+        shutil.copytree(source, target)
+        # The manifest and library index must not remember the last run
+        for database in Path(os.environ["DATA_DIR"]).glob("*.sqlite3*"):
+            database.unlink()
+        return target
+
+    def run_process_file():
+        for mp3_file in sorted(fresh_copy("process_file").rglob("*.mp3")):
+            process_file(mp3_file)
+
+    def run_process_directory(workers: int) -> Callable[[], Any]:
+        return lambda: process_directory(
+            fresh_copy("process_directory"), full=True, workers=workers
+        )
+
+    results: dict[str, dict[str, Any]] = {}
+    results["parse_id3_tags"] = measure(
+        "parse_id3_tags", len(id3s), lambda: [parse_id3_tags(id3) for id3 in id3s]
+    )
+    results["parse_lyrics"] = measure(
+        "parse_lyrics",
+        len(corpus["lrc_texts"]),
+        lambda: [parse_lyrics(text) for text in corpus["lrc_texts"]],
+    )
+    # Fewer but much longer files, with every Enhanced LRC feature, and the
+    # same files with an [offset:]. The parser parse_lrc replaced is timed
+    # on both for comparison.
+    lrc_rng = random.Random(seed)
+    enhanced_lrc_texts = [
+        make_enhanced_lrc(lrc_rng, 2000, offset=False)
+        for _ in range(max(tracks // 100, 1))
+    ]
+    lrc_rng = random.Random(seed)
+    offset_lrc_texts = [
+        make_enhanced_lrc(lrc_rng, 2000) for _ in range(max(tracks // 100, 1))
+    ]
+    for case, texts in (("enhanced", enhanced_lrc_texts), ("offset", offset_lrc_texts)):
+        lrc_lines = sum(text.count("\n") for text in texts)
+        results[f"parse_lyrics_{case}"] = measure(
+            f"parse_lyrics ({case})",
+            lrc_lines,
+            lambda texts=texts: [parse_lyrics(text) for text in texts],
+        )
+        results[f"legacy_parse_lyrics_{case}"] = measure(
+            f"legacy ({case})",
+            lrc_lines,
+            lambda texts=texts: [legacy_parse_lyrics(text) for text in texts],
+        )
+    parsed_lrcs = [parse_lrc(text) for text in offset_lrc_texts]
+    results["serialize_to_lrc"] = measure(
+        "serialize_to_lrc",
+        sum(len(parsed.lines) for parsed in parsed_lrcs),
+        lambda: [
+            serialize_to_lrc(parsed.lines, parsed.tags, parsed.offset)
+            for parsed in parsed_lrcs
+        ],
+    )
+    results["convert_to_jpeg"] = measure(
+        "convert_to_jpeg",
+        len(corpus["art"]),
+        # Normalize like ART_MAX_EDGE=1200 so oversized art is re-encoded
+        lambda: [convert_to_jpeg(data, max_edge=1200) for data in corpus["art"]],
+    )
+    # Copying the library is part of these runs, but it's small next to the work
+    results["process_file"] = measure("process_file", len(mp3_files), run_process_file)
+    results["process_directory"] = measure(
+        "process_directory", len(mp3_files), run_process_directory(1)
+    )
+    if workers > 1:
+        # Worker processes aren't traced, so only time this one
+        results[f"process_directory_{workers}_workers"] = measure(
+            f"process_directory ({workers}w)",
+            len(mp3_files),
+            run_process_directory(workers),
+            memory=False,
+        )
+    return results
+
+
+def git_commit() -> str | None:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def main(argv: Sequence[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--tracks", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="also time process_directory with this many worker processes",
+    )
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the generated library"
+    )
+    args = parser.parse_args(argv)
+
+    work_dir = Path(tempfile.mkdtemp(prefix="intersonic-benchmark-"))
+    # The manifest and library index go to the scratch directory, not /data
+    os.environ["DATA_DIR"] = str(work_dir / "data")
+    try:
+        results = run_benchmarks(args.tracks, args.seed, args.workers, work_dir)
+    finally:
+        if args.keep:
+            print(f"Kept the generated library in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "commit": git_commit(),
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "tracks": args.tracks,
+        "seed": args.seed,
+        "results": results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"Wrote the results to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
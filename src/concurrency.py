@@ -0,0 +1,89 @@
+import threading
+import time
+from typing import Any, Optional
+from collections.abc import Callable
+
+# How much the limit is cut after a throttle (429, timeout) or another error
+THROTTLE_BACKOFF = 0.5
+ERROR_BACKOFF = 0.8
+# The limit only grows while the average latency stays within this factor
+# of the best average seen so far
+LATENCY_TOLERANCE = 2.0
+# Weight of the newest sample in the average latency
+LATENCY_SMOOTHING = 0.2
+
+
+class AdaptiveLimiter:
+    """
+    A semaphore whose limit adapts to how the work is going, using additive
+    increase and multiplicative decrease (AIMD). Every `limit` successes with
+    healthy latency raise the limit by one, and every failure cuts it by a
+    factor. Failures of work started before the last cut are ignored, so a
+    burst of failures from the same overload only counts once.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int = 1,
+        maximum: Optional[int] = None,
+        on_change: Optional[Callable[[int, str], None]] = None,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum or initial * 2
+        self.on_change = on_change
+        self.condition = threading.Condition()
+
+        self.limit = float(initial)
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.latency: Optional[float] = None
+        self.best_latency: Optional[float] = None
+
+    @property
+    def current_limit(self) -> int:
+        return max(self.minimum, int(self.limit))
+
+    def acquire(self) -> float:
+        """Waits for a free slot, returning the start time to pass to release."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_flight < self.current_limit)
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, started: float, outcome: str):
+        """`outcome` is "success", "error" or "throttled"."""
+        now = time.monotonic()
+        with self.condition:
+            self.in_flight -= 1
+            before = self.current_limit
+
+            if outcome == "success":
+                latency = now - started
+                self.latency = (
+                    latency
+                    if self.latency is None
+                    else LATENCY_SMOOTHING * latency
+                    + (1 - LATENCY_SMOOTHING) * self.latency
+                )
+                self.best_latency = min(self.best_latency or self.latency, self.latency)
+                if self.latency <= self.best_latency * LATENCY_TOLERANCE:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif started >= self.last_decrease:
+                backoff = THROTTLE_BACKOFF if outcome == "throttled" else ERROR_BACKOFF
+                self.limit = max(self.minimum, self.limit * backoff)
+                self.last_decrease = now
+
+            after = self.current_limit
+            self.condition.notify_all()
+
+        if after != before and self.on_change:
+            self.on_change(after, outcome)
+
+    def status(self) -> dict[str, Any]:
+        with self.condition:
+            return {
+                "limit": self.current_limit,
+                "in_flight": self.in_flight,
+                "latency": self.latency,
+            }
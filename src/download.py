@@ -5,19 +5,35 @@ from spotdl import Spotdl
 from spotdl.utils.formatter import create_file_name
 from spotdl.types.options import DownloaderOptionalOptions
 from spotdl.types.song import Song
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import os
 import asyncio
+import re
 
-from metadata.main import process_file
+from concurrency import AdaptiveLimiter
+from events import EVENTS
+from failures import FailureLedger
+from metadata.library import get_library_index
+from metadata.lyrics_cache import get_lyrics_cache, lyrics_keys
+from metadata.main import (
+    DEFAULT_WORKERS,
+    discard_metadata_pool,
+    metadata_pool,
+    timed_process_file,
+)
+from metrics import (
+    BYTES_WRITTEN,
+    LYRICS_LOOKUPS,
+    SONGS,
+    STAGE_SECONDS,
+    observe_stage_timings,
+)
+from search_cache import SearchCache, cached_search
+from tracing import in_current_context, record_timings, span
 
-client_id = os.environ.get("SPOTIFY_CLIENT_ID")
-client_secret = os.environ.get("SPOTIFY_CLIENT_SECRET")
 genius_token = os.environ.get("GENIUS_ACCESS_TOKEN")
 
-if not client_id or not client_secret:
-    raise ValueError(
-        "SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET must be set as environment variables"
-    )
 if not genius_token:
     print("Warning: GENIUS_ACCESS_TOKEN is not set")
 
@@ -54,75 +70,363 @@ def get_spotdl():
     return spotdl
 
 
-spotdl = get_spotdl()
+# Built by init_downloader, so that importing this module stays fast and
+# doesn't fail when the credentials are missing
+_spotdl: Optional[Spotdl] = None
+search_cache = SearchCache()
+
+
+def init_downloader():
+    global _spotdl
+    if _spotdl is None:
+        _spotdl = get_spotdl()
+        # Every download looks its lyrics up in the cache first
+        _spotdl.downloader.search_lyrics = search_lyrics
+
+
+def search_lyrics(song: Song) -> Optional[str]:
+    """
+    Replaces the downloader's search_lyrics. The lyrics cache is consulted
+    first, and only on a miss are the lyrics providers tried in order.
+    Whatever they find, including nothing, is cached for the next download.
+    """
+    cache = get_lyrics_cache()
+    keys = lyrics_keys(song.isrc, song.url)
+    cached = cache.get(keys)
+    if cached is not None:
+        LYRICS_LOOKUPS.inc(result="cached")
+        return cached.lyrics
+
+    failed = False
+    with STAGE_SECONDS.time(stage="search_lyrics"):
+        for provider in require_spotdl().downloader.lyrics_providers:
+            try:
+                lyrics = provider.get_lyrics(song.name, song.artists)
+            except Exception as e:
+                print(f"Error: {provider.name} failed to find lyrics for {song.display_name}: {e}")
+                failed = True
+                continue
+            if lyrics:
+                LYRICS_LOOKUPS.inc(result="found")
+                cache.put(keys, provider.name, lyrics)
+                return lyrics
+
+    LYRICS_LOOKUPS.inc(result="not_found")
+    # A provider that broke might have had them, so only cache a clean miss
+    if not failed:
+        cache.put(keys, None, None)
+    return None
+
+
+def require_spotdl() -> Spotdl:
+    if _spotdl is None:
+        raise RuntimeError("The downloader hasn't been initialized yet")
+    return _spotdl
+
+
+# Upper bound for the adaptive download concurrency, which starts at the
+# downloader's "threads"
+DOWNLOAD_MAX_CONCURRENCY = int(os.environ.get("DOWNLOAD_MAX_CONCURRENCY") or 16)
+
+# Errors that mean we are going too fast for YouTube or the exit node
+THROTTLE_PATTERNS = ("429", "too many requests", "rate limit", "sign in to confirm")
+TIMEOUT_PATTERNS = ("timed out", "timeout")
+NETWORK_PATTERNS = ("connection", "proxy", "temporary failure in name resolution")
+
+
+# Error class of songs that downloaded, but failed in the metadata stage
+METADATA_ERROR = "metadata"
+
+
+def classify_error(message: str) -> str:
+    """
+    Sorts an error message like "DownloadError: ..." into "throttled",
+    "timeout", "network" or, for anything else, the exception class.
+    """
+    lower = message.lower()
+    for error_class, patterns in (
+        ("throttled", THROTTLE_PATTERNS),
+        ("timeout", TIMEOUT_PATTERNS),
+        ("network", NETWORK_PATTERNS),
+    ):
+        if any(pattern in lower for pattern in patterns):
+            return error_class
+    match = re.match(r"(\w+):", message)
+    return match.group(1) if match else "unknown"
+
+
+def report_download_limit(limit: int, outcome: str):
+    if outcome == "success":
+        message = f"Raised the download limit to {limit} at a time."
+    else:
+        message = f"Lowered the download limit to {limit} at a time after {'being throttled' if outcome == 'throttled' else 'an error'}."
+    print(message)
+    EVENTS.publish("downloads", message, limit=limit)
+
+
+failure_ledger = FailureLedger()
+
+# Shared by every running download, so that concurrent jobs don't multiply
+# the number of requests going through the exit node
+download_limiter = AdaptiveLimiter(
+    downloader_settings["threads"],
+    maximum=DOWNLOAD_MAX_CONCURRENCY,
+    on_change=report_download_limit,
+)
+
+
+def search_and_download(song: Song) -> tuple[Song, Optional[Path]]:
+    """
+    Downloads a song within the concurrency limit. Failures are recorded in
+    the failure ledger, and successes clear the song from it.
+    """
+    spotdl = require_spotdl()
+    started = download_limiter.acquire()
+    error = "unknown: Download failed"
+    try:
+        with (
+            STAGE_SECONDS.time(stage="search_and_download"),
+            span("search_and_download", track=song.display_name),
+        ):
+            song, path = spotdl.downloader.search_and_download(song)
+        if path:
+            error = None
+            BYTES_WRITTEN.inc(os.path.getsize(path))
+        else:
+            # spotdl swallows most errors, the message is in its error list
+            prefix = f"{song.url} - "
+            error = next(
+                (
+                    e.removeprefix(prefix)
+                    for e in reversed(spotdl.downloader.errors)
+                    if e.startswith(prefix)
+                ),
+                "unknown: Download failed",
+            )
+        return song, path
+    except Exception as e:
+        error = f"{e.__class__.__name__}: {e}"
+        raise
+    finally:
+        if error is None:
+            download_limiter.release(started, "success")
+            failure_ledger.resolve(song.url)
+        else:
+            SONGS.inc(result="failed")
+            error_class = classify_error(error)
+            download_limiter.release(
+                started,
+                "throttled" if error_class in ("throttled", "timeout") else "error",
+            )
+            failure_ledger.record(song, error_class, error)
 
 
 def download_missing(
-    queries: list[str], status_callback: Optional[Callable[[str], None]] = None
+    queries: list[str],
+    status_callback: Optional[Callable[[str], None]] = None,
+    metadata_workers: int = DEFAULT_WORKERS,
 ):
-    # spotdl = get_spotdl()
+    """
+    Searches for the queries and downloads the songs that aren't in the
+    library yet.
+    """
+    spotdl = require_spotdl()
 
     print(f"Searching for {len(queries)} queries")
     if status_callback:
         status_callback(
             f"Searching for {len(queries)} {'query' if len(queries) == 1 else 'queries'}..."
         )
-    songs = spotdl.search(queries)
+    def search(queries: list[str]) -> list[Song]:
+        with STAGE_SECONDS.time(stage="search"), span("search", query=queries[0]):
+            return spotdl.search(queries)
+
+    # Only queries that haven't been resolved recently go to Spotify
+    songs = cached_search(
+        search,
+        queries,
+        search_cache,
+        threads=downloader_settings["threads"],
+        status_callback=status_callback,
+    )
     print(f"Found {len(songs)} songs")
 
-    to_download: list[Song] = []
-    for song in songs:
-        path = create_file_name(
+    return download_songs(
+        missing_songs(songs),
+        status_callback=status_callback,
+        metadata_workers=metadata_workers,
+    )
+
+
+def retry_failed(
+    urls: list[str],
+    status_callback: Optional[Callable[[str], None]] = None,
+    metadata_workers: int = DEFAULT_WORKERS,
+):
+    """
+    Downloads the songs from the failure ledger again, skipping the search.
+    The songs must have been marked as retrying with take_due or take_all.
+    """
+    songs = failure_ledger.songs(urls)
+    try:
+        # The files of songs that failed in the metadata stage are already on
+        # disk. The downloader skips them, straight to the metadata stage.
+        metadata_failed = {
+            entry.url
+            for entry in failure_ledger.entries()
+            if entry.error_class == METADATA_ERROR
+        }
+        missing = {
+            song.url
+            for song in missing_songs(
+                [song for song in songs if song.url not in metadata_failed]
+            )
+        }
+        to_download = [
+            song for song in songs if song.url in missing or song.url in metadata_failed
+        ]
+        # Songs that made it into the library some other way are done
+        retrying = {song.url for song in to_download}
+        for song in songs:
+            if song.url not in retrying:
+                failure_ledger.resolve(song.url)
+
+        return download_songs(
+            to_download,
+            status_callback=status_callback,
+            metadata_workers=metadata_workers,
+        )
+    finally:
+        # Songs the retry didn't get to wait for the next one
+        failure_ledger.release(urls)
+
+
+def missing_songs(songs: list[Song]) -> list[Song]:
+    spotdl = require_spotdl()
+    paths = [
+        create_file_name(
             song=song,
             template=spotdl.downloader.settings["output"],
             file_extension=spotdl.downloader.settings["format"],
             restrict=spotdl.downloader.settings["restrict"],
             file_name_length=spotdl.downloader.settings["max_filename_length"],
         )
-        file_exists = os.path.exists(path)
-        if not file_exists:
+        for song in songs
+    ]
+    # Check the whole batch against the library index at once, which also
+    # recognizes songs we own under a different path
+    owned = get_library_index().owned(
+        [(song.url, song.isrc, path) for song, path in zip(songs, paths)]
+    )
+
+    to_download: list[Song] = []
+    for song, path, is_owned in zip(songs, paths, owned):
+        # Fall back to the disk for files that haven't been indexed yet
+        if not is_owned and not os.path.exists(path):
             to_download.append(song)
+    SONGS.inc(len(songs) - len(to_download), result="skipped")
+    return to_download
+
 
+def download_songs(
+    to_download: list[Song],
+    status_callback: Optional[Callable[[str], None]] = None,
+    metadata_workers: int = DEFAULT_WORKERS,
+):
+    """
+    Downloads the songs (as many at a time as download_limiter allows,
+    across all running jobs) and processes their metadata (up to
+    `metadata_workers` songs at a time, on the process pool shared by all
+    running jobs). The two run as separate pipeline stages, so they overlap
+    instead of taking turns.
+    """
     if not to_download:
         print("All songs already downloaded.")
+        if status_callback:
+            status_callback("All songs already downloaded.")
         return []
 
     print(f"Downloading {len(to_download)} songs")
     if status_callback:
         status_callback(
-            f"Downloading {len(to_download)} {'song' if len(to_download) == 1 else 'songs'}..."
+            f"Downloading {len(to_download)} {'song' if len(to_download) == 1 else 'songs'} (up to {download_limiter.current_limit} at a time)..."
         )
 
     total_songs = len(to_download)
     downloaded_songs = 0
 
     loop = asyncio.get_event_loop()
-    semaphore = asyncio.Semaphore(spotdl.downloader.settings["threads"])
 
-    async def download_song(song: Song) -> tuple[Song, Optional[Path]]:
-        nonlocal downloaded_songs
-        try:
-            async with semaphore:
-                song, path = await loop.run_in_executor(
-                    None, spotdl.downloader.search_and_download, song
-                )
-            if path:
-                process_file(path)
+    # Downloaded files wait here for the metadata stage. Bounding it makes
+    # downloads pause instead of piling up when metadata falls behind.
+    metadata_queue: asyncio.Queue[Optional[tuple[int, Song, Path]]] = asyncio.Queue(
+        maxsize=metadata_workers * 2
+    )
+    results_by_index: dict[int, tuple[Song, Optional[Path]]] = {}
 
-            downloaded_songs += 1
-            percentage_str = f"{(downloaded_songs / total_songs) * 100:.2f}%"
-            song_log_str = f"Downloaded {percentage_str} ({downloaded_songs}/{total_songs}) - '{song.display_name}'"
-            print(song_log_str)
-            if status_callback:
-                status_callback(song_log_str)
+    def song_done(song: Song):
+        nonlocal downloaded_songs
+        downloaded_songs += 1
+        percentage_str = f"{(downloaded_songs / total_songs) * 100:.2f}%"
+        song_log_str = f"Downloaded {percentage_str} ({downloaded_songs}/{total_songs}) - '{song.display_name}'"
+        print(song_log_str)
+        if status_callback:
+            status_callback(song_log_str)
 
-            return song, path
+    async def download_song(index: int, song: Song, executor: ThreadPoolExecutor):
+        try:
+            song, path = await loop.run_in_executor(
+                executor, in_current_context(search_and_download), song
+            )
         except Exception as e:
             print(f"Error downloading {song.display_name}: {e}")
-            return song, None
+            results_by_index[index] = (song, None)
+            return
+
+        results_by_index[index] = (song, path)
+        if path:
+            await metadata_queue.put((index, song, path))
+        else:
+            song_done(song)
+
+    async def metadata_worker():
+        while (item := await metadata_queue.get()) is not None:
+            index, song, path = item
+            executor = metadata_pool()
+            try:
+                _, timings = await loop.run_in_executor(
+                    executor, timed_process_file, path
+                )
+                observe_stage_timings(timings)
+                record_timings(timings, track=song.display_name)
+                SONGS.inc(result="downloaded")
+                song_done(song)
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    discard_metadata_pool(executor)
+                print(f"Error processing metadata for {song.display_name}: {e}")
+                SONGS.inc(result="failed")
+                failure_ledger.record(song, METADATA_ERROR, f"{type(e).__name__}: {e}")
+                results_by_index[index] = (song, None)
+
+    async def run_pipeline():
+        # The download threads must cover the highest limit download_limiter allows
+        with ThreadPoolExecutor(max_workers=download_limiter.maximum) as download_executor:
+            workers = [
+                asyncio.create_task(metadata_worker()) for _ in range(metadata_workers)
+            ]
+            await asyncio.gather(
+                *(
+                    download_song(index, song, download_executor)
+                    for index, song in enumerate(to_download)
+                )
+            )
+            for _ in workers:
+                await metadata_queue.put(None)
+            await asyncio.gather(*workers)
 
-    tasks = [download_song(song) for song in to_download]
-    results = loop.run_until_complete(asyncio.gather(*tasks))
+    loop.run_until_complete(run_pipeline())
+    results = [results_by_index[index] for index in range(total_songs)]
 
     successful_downloads = len([song for song, path in results if path is not None])
     failed_downloads = len([song for song, path in results if path is None])
@@ -0,0 +1,53 @@
+import threading
+import time
+from collections import deque
+from typing import Any
+
+# Number of recent events kept for clients that connect late
+EVENT_BUFFER_SIZE = 1000
+
+Event = dict[str, Any]
+
+
+class EventBus:
+    """
+    Fans progress events out to any number of listeners. The most recent
+    events are kept in a ring buffer so listeners can replay what they
+    missed, using the increasing event IDs.
+    """
+
+    def __init__(self, size: int = EVENT_BUFFER_SIZE):
+        self.events: deque[Event] = deque(maxlen=size)
+        self.last_id = 0
+        self.condition = threading.Condition()
+
+    def publish(self, type: str, message: str, **fields: Any) -> Event:
+        with self.condition:
+            self.last_id += 1
+            event = {
+                "id": self.last_id,
+                "time": time.time(),
+                "type": type,
+                "message": message,
+                **fields,
+            }
+            self.events.append(event)
+            self.condition.notify_all()
+        return event
+
+    def since(self, last_id: int) -> list[Event]:
+        """Returns the buffered events newer than `last_id`."""
+        with self.condition:
+            # An ID from before a restart would hide every new event
+            if last_id > self.last_id:
+                last_id = 0
+            return [event for event in self.events if event["id"] > last_id]
+
+    def wait(self, last_id: int, timeout: float) -> list[Event]:
+        """Like since, but waits up to `timeout` seconds for a new event."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.last_id != last_id, timeout)
+            return self.since(last_id)
+
+
+EVENTS = EventBus()
@@ -0,0 +1,208 @@
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Optional
+from collections.abc import Callable
+
+from spotdl.types.song import Song
+
+from utils import DATA_DIR, connect_db
+
+FAILURES_PATH = DATA_DIR / "failures.sqlite3"
+
+# Transient failures are retried automatically this many times
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS") or 5)
+# Seconds before the first automatic retry, doubling with every attempt
+RETRY_BASE_DELAY = 60
+RETRY_MAX_DELAY = 6 * 60 * 60
+# Seconds between checks for songs that are due to be retried
+RETRY_CHECK_INTERVAL = 60
+
+# Error classes that are worth retrying without anyone asking
+TRANSIENT_ERRORS = ("throttled", "timeout", "network")
+
+
+def retry_delay(attempts: int) -> float:
+    """Exponential backoff with jitter, so that failed songs don't retry in lockstep."""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.5)
+
+
+@dataclass
+class FailedSong:
+    url: str
+    name: str
+    error_class: str
+    error: str
+    attempts: int
+    status: str  # "waiting" to be retried, "retrying" or "failed" for good
+    last_failed_at: float
+    retry_at: Optional[float]
+
+
+FAILED_SONG_COLUMNS = (
+    "url, name, error_class, error, attempts, status, last_failed_at, retry_at"
+)
+
+
+class FailureLedger:
+    """
+    A durable record of songs that failed to download, so they can be
+    retried later without searching for the whole query again.
+    """
+
+    def __init__(self, path: Path = FAILURES_PATH):
+        self.lock = threading.Lock()
+        self.conn = connect_db(path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS failed_songs (
+                    url TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    song TEXT NOT NULL,
+                    error_class TEXT NOT NULL,
+                    error TEXT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    first_failed_at REAL NOT NULL,
+                    last_failed_at REAL NOT NULL,
+                    retry_at REAL
+                )
+                """
+            )
+
+    def record(self, song: Song, error_class: str, error: str):
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT attempts FROM failed_songs WHERE url = ?", (song.url,)
+            ).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            if error_class in TRANSIENT_ERRORS and attempts < RETRY_MAX_ATTEMPTS:
+                status, retry_at = "waiting", now + retry_delay(attempts)
+            else:
+                status, retry_at = "failed", None
+            self.conn.execute(
+                """
+                INSERT INTO failed_songs (url, name, song, error_class, error, attempts, status, first_failed_at, last_failed_at, retry_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (url) DO UPDATE SET
+                    song = excluded.song,
+                    error_class = excluded.error_class,
+                    error = excluded.error,
+                    attempts = excluded.attempts,
+                    status = excluded.status,
+                    last_failed_at = excluded.last_failed_at,
+                    retry_at = excluded.retry_at
+                """,
+                (
+                    song.url,
+                    song.display_name,
+                    json.dumps(song.json),
+                    error_class,
+                    error,
+                    attempts,
+                    status,
+                    now,
+                    now,
+                    retry_at,
+                ),
+            )
+
+    def resolve(self, url: str):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM failed_songs WHERE url = ?", (url,))
+
+    def take_due(self) -> list[str]:
+        """Marks the songs whose retry is due as retrying and returns their URLs."""
+        return self.take("status = 'waiting' AND retry_at <= ?", (time.time(),))
+
+    def take_all(self) -> list[str]:
+        """Marks every song that isn't already being retried as retrying."""
+        return self.take("status != 'retrying'", ())
+
+    def take(self, condition: str, params: tuple) -> list[str]:
+        with self.lock, self.conn:
+            urls = [
+                url
+                for (url,) in self.conn.execute(
+                    f"SELECT url FROM failed_songs WHERE {condition} ORDER BY first_failed_at",
+                    params,
+                )
+            ]
+            self.conn.executemany(
+                "UPDATE failed_songs SET status = 'retrying' WHERE url = ?",
+                [(url,) for url in urls],
+            )
+        return urls
+
+    def release(self, urls: list[str]):
+        """Puts songs that a retry didn't get to back in line."""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE failed_songs SET status = 'waiting', retry_at = ? WHERE url = ? AND status = 'retrying'",
+                [(time.time() + retry_delay(1), url) for url in urls],
+            )
+
+    def songs(self, urls: list[str]) -> list[Song]:
+        with self.lock:
+            songs_by_url = {
+                url: Song.from_dict(json.loads(song))
+                for url, song in self.conn.execute(
+                    f"SELECT url, song FROM failed_songs WHERE url IN ({', '.join('?' * len(urls))})",
+                    urls,
+                )
+            }
+        return [songs_by_url[url] for url in urls if url in songs_by_url]
+
+    def entries(self) -> list[FailedSong]:
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT {FAILED_SONG_COLUMNS} FROM failed_songs ORDER BY last_failed_at DESC"
+            ).fetchall()
+        return [FailedSong(*row) for row in rows]
+
+    def count(self) -> int:
+        with self.lock:
+            (count,) = self.conn.execute("SELECT COUNT(*) FROM failed_songs").fetchone()
+        return count
+
+
+class RetryScheduler:
+    """
+    Periodically hands the songs whose retry is due to `enqueue`, which
+    should start a job that downloads them.
+    """
+
+    def __init__(
+        self,
+        ledger: FailureLedger,
+        enqueue: Callable[[list[str]], Any],
+        interval: float = RETRY_CHECK_INTERVAL,
+    ):
+        self.ledger = ledger
+        self.enqueue = enqueue
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, name="retry-scheduler", daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            urls = []
+            try:
+                urls = self.ledger.take_due()
+                if urls:
+                    self.enqueue(urls)
+            except Exception as e:
+                print(f"Error scheduling retries: {e}")
+                self.ledger.release(urls)
@@ -0,0 +1,254 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Optional
+from collections.abc import Callable, Collection, Mapping
+
+from events import EVENTS
+from tracing import trace
+from utils import DATA_DIR, connect_db
+
+JOBS_PATH = DATA_DIR / "jobs.sqlite3"
+
+# Number of jobs that may run at the same time
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS") or 2)
+
+
+@dataclass
+class Job:
+    id: int
+    type: str
+    params: dict[str, Any]
+    status: str  # "queued", "running", "done" or "failed"
+    message: str
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+
+# A handler runs a job, reporting progress through the status callback
+JobHandler = Callable[[Job, Callable[[str], None]], None]
+
+JOB_COLUMNS = "id, type, params, status, message, created_at, started_at, finished_at"
+
+
+def row_to_job(row: tuple) -> Job:
+    id, type, params, status, message, created_at, started_at, finished_at = row
+    return Job(
+        id=id,
+        type=type,
+        params=json.loads(params),
+        status=status,
+        message=message,
+        created_at=created_at,
+        started_at=started_at,
+        finished_at=finished_at,
+    )
+
+
+def publish_job_event(job: Job, message: str):
+    EVENTS.publish(
+        "job", message, job_id=job.id, job_type=job.type, status=job.status
+    )
+
+
+class JobQueue:
+    """
+    A durable queue of jobs, stored in SQLite, drained by a fixed number of
+    worker threads. Jobs that were queued or running when the app stopped
+    are picked up again on the next start.
+
+    Jobs of an exclusive type never run alongside another job of that type,
+    and jobs never run alongside a job of a type they conflict with. Jobs of
+    a paused type stay queued until the type is resumed.
+    """
+
+    def __init__(
+        self,
+        handlers: dict[str, JobHandler],
+        workers: int = JOB_WORKERS,
+        exclusive_types: Collection[str] = (),
+        conflicts: Mapping[str, Collection[str]] = {},
+        paused_types: Collection[str] = (),
+        path: Path = JOBS_PATH,
+    ):
+        self.handlers = handlers
+        self.workers = workers
+        # The types each type can't run alongside, both ways
+        self.conflicts: dict[str, set[str]] = {type: {type} for type in exclusive_types}
+        for type, others in conflicts.items():
+            for other in others:
+                self.conflicts.setdefault(type, set()).add(other)
+                self.conflicts.setdefault(other, set()).add(type)
+        self.paused_types = set(paused_types)
+        self.condition = threading.Condition()
+
+        self.conn = connect_db(path)
+        with self.condition, self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    type TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+                """
+            )
+            # Jobs that were running when the app stopped start over
+            self.conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL, message = ? WHERE status = 'running'",
+                ("Interrupted by a restart, waiting to run again...",),
+            )
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self.work, name=f"job-worker-{i}", daemon=True).start()
+
+    def pause(self, type: str):
+        with self.condition:
+            self.paused_types.add(type)
+
+    def resume(self, type: str):
+        with self.condition:
+            self.paused_types.discard(type)
+            self.condition.notify_all()
+
+    def enqueue(self, type: str, params: dict[str, Any], message: str) -> Job:
+        if type not in self.handlers:
+            raise ValueError(f"Unknown job type: {type}")
+        with self.condition:
+            with self.conn:
+                cursor = self.conn.execute(
+                    "INSERT INTO jobs (type, params, status, message, created_at) VALUES (?, ?, 'queued', ?, ?)",
+                    (type, json.dumps(params), message, time.time()),
+                )
+            job_id = cursor.lastrowid
+            assert job_id is not None
+            self.condition.notify()
+        job = self.get(job_id)
+        assert job is not None
+        publish_job_event(job, message)
+        return job
+
+    def get(self, job_id: int) -> Optional[Job]:
+        with self.condition:
+            row = self.conn.execute(
+                f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return row_to_job(row) if row else None
+
+    def recent(self, limit: int = 10) -> list[Job]:
+        """Unfinished jobs first, then the most recently created ones."""
+        with self.condition:
+            rows = self.conn.execute(
+                f"""
+                SELECT {JOB_COLUMNS} FROM jobs
+                ORDER BY status IN ('done', 'failed'), id DESC
+                LIMIT ?
+                """,
+                (limit,),
+            ).fetchall()
+        return [row_to_job(row) for row in rows]
+
+    def count(self, status: str, type: Optional[str] = None) -> int:
+        """The number of jobs with this status, of any type unless one is given."""
+        with self.condition:
+            (count,) = self.conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND (? IS NULL OR type = ?)",
+                (status, type, type),
+            ).fetchone()
+        return count
+
+    def update_message(self, job: Job, message: str):
+        job.message = message
+        with self.condition, self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET message = ? WHERE id = ?", (message, job.id)
+            )
+        publish_job_event(job, message)
+
+    def claim(self) -> Optional[Job]:
+        """Marks the oldest runnable job as running. Call with the condition held."""
+        blocked: set[str] = set()
+        for (type,) in self.conn.execute(
+            "SELECT DISTINCT type FROM jobs WHERE status = 'running'"
+        ):
+            blocked |= self.conflicts.get(type, set())
+
+        # A job that has to wait also holds back the newer jobs it conflicts
+        # with, so that a stream of downloads can't starve a processing job
+        waiting: set[str] = set()
+        job_id: Optional[int] = None
+        for queued_id, type in self.conn.execute(
+            "SELECT id, type FROM jobs WHERE status = 'queued' ORDER BY id"
+        ).fetchall():
+            if type in self.paused_types:
+                continue
+            if type in blocked or self.conflicts.get(type, set()) & waiting:
+                waiting.add(type)
+                continue
+            job_id = queued_id
+            break
+        if job_id is None:
+            return None
+
+        row = self.conn.execute(
+            f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        job = row_to_job(row)
+        job.status = "running"
+        job.started_at = time.time()
+        with self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?",
+                (job.started_at, job.id),
+            )
+        return job
+
+    def finish(self, job: Job, status: str, message: Optional[str] = None):
+        job.status = status
+        job.message = message or job.message
+        job.finished_at = time.time()
+        with self.condition:
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE jobs SET status = ?, message = ?, finished_at = ? WHERE id = ?",
+                    (status, job.message, job.finished_at, job.id),
+                )
+            # An exclusive job finishing can unblock the next one
+            self.condition.notify_all()
+        publish_job_event(job, job.message)
+
+    def work(self):
+        # threads do not get a default event loop, so we create one for spotdl
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        while True:
+            with self.condition:
+                while (job := self.claim()) is None:
+                    self.condition.wait()
+
+            print(f"Starting {job.type} job #{job.id}")
+            publish_job_event(job, job.message)
+
+            def status_callback(message: str, job: Job = job):
+                print(f"Job #{job.id}: {message}")
+                self.update_message(job, message)
+
+            try:
+                with trace(f"job-{job.id}", profile=True, type=job.type):
+                    self.handlers[job.type](job, status_callback)
+                self.finish(job, "done")
+            except Exception as e:
+                print(f"An error occurred in {job.type} job #{job.id}: {e}")
+                self.finish(job, "failed", f"Error: {e}")
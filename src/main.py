@@ -1,7 +1,7 @@
 import pathlib
 
-from tailscale import tailscale_setup
-from download import download_missing
+from tailscale import ExitNodeMonitor, tailscale_setup
+from download import download_missing, init_downloader
 from metadata.main import process_directory
 
 
@@ -9,6 +9,9 @@ def main():
     print("Hello from Intersonic")
 
     tailscale_setup()
+    # Like the server at startup, but without monitoring afterwards
+    ExitNodeMonitor().check()
+    init_downloader()
 
     print("Starting download...")
     queries = ["https://open.spotify.com/track/2LCGFBu1ej6zt4r1VGPjny"]
@@ -1,4 +1,8 @@
+import hashlib
 import io
+import os
+import threading
+from collections import OrderedDict
 from pathlib import Path
 from typing import Optional
 
@@ -6,106 +10,264 @@ from mutagen.id3 import ID3
 from mutagen.id3._frames import APIC
 from PIL import Image
 
+from metadata.sync import (
+    StageResult,
+    read_sidecar,
+    remove_sidecar,
+    replace_frames,
+    write_sidecar,
+)
 
-def extract_embedded_art(mp3_path: Path) -> Optional[bytes]:
+# Art shared by the tracks of an album is stored once in the album directory
+ALBUM_ART_NAME = "cover.jpg"
+# Description of embedded art that came from the album's cover.jpg, so it
+# follows the cover when it's edited. Other art is embedded as "Cover".
+ALBUM_ART_DESC = ALBUM_ART_NAME
+TRACK_ART_DESC = "Cover"
+
+# Number of converted images remembered by cached_convert_to_jpeg
+JPEG_CACHE_SIZE = 16
+
+# Optional album art normalization, disabled unless one of these limits is set.
+# Art is downscaled to ART_MAX_EDGE pixels on its longest side, and the JPEG
+# quality (then the size) is lowered until it fits in ART_MAX_BYTES.
+ART_MAX_EDGE = int(os.environ.get("ART_MAX_EDGE") or 0)
+ART_MAX_BYTES = int(os.environ.get("ART_MAX_BYTES") or 0)
+ART_QUALITY = int(os.environ.get("ART_QUALITY") or 95)
+
+# Limits for shrinking art to fit in ART_MAX_BYTES
+MIN_ART_QUALITY = 60
+MIN_ART_EDGE = 300
+
+# Magic bytes at the start of common image formats
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"BM", "BMP"),
+)
+
+_jpeg_cache: OrderedDict[bytes, Optional[bytes]] = OrderedDict()
+_jpeg_cache_lock = threading.Lock()
+
+
+def extract_embedded_art(tags: ID3) -> Optional[APIC]:
     """
     Extracts album art from an MP3 file's ID3 tags.
-    Returns the first 'APIC' (Attached Picture) frame's data as bytes.
+    Returns the first 'APIC' (Attached Picture) frame.
     """
-    try:
-        tags = ID3(mp3_path)
-        # 'APIC:' is the key for Attached Picture frames
-        apic_frames = tags.getall("APIC")
-        if apic_frames:
-            # Just return the data of the first picture found
-            return apic_frames[0].data
-    except Exception as e:
-        print(f"Warning: Could not extract embedded art from {mp3_path}: {e}")
+    # 'APIC:' is the key for Attached Picture frames
+    apic_frames = tags.getall("APIC")
+    if apic_frames:
+        # Just return the first picture found
+        return apic_frames[0]
+    return None
+
+
+def sniff_image_format(image_data: bytes) -> Optional[str]:
+    """Identifies an image format from its magic bytes, without decoding it."""
+    for signature, image_format in IMAGE_SIGNATURES:
+        if image_data.startswith(signature):
+            return image_format
+    if image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP":
+        return "WEBP"
     return None
 
 
-def convert_to_jpeg(image_data: bytes) -> Optional[bytes]:
+def encode_jpeg(img: Image.Image, quality: int, progressive: bool) -> bytes:
+    with io.BytesIO() as out_buffer:
+        img.save(
+            out_buffer,
+            format="JPEG",
+            quality=quality,
+            progressive=progressive,
+            optimize=progressive,
+        )
+        return out_buffer.getvalue()
+
+
+def convert_to_jpeg(
+    image_data: bytes,
+    max_edge: int = ART_MAX_EDGE,
+    max_bytes: int = ART_MAX_BYTES,
+    quality: int = ART_QUALITY,
+) -> Optional[bytes]:
     """
     Converts image data from any format into JPEG format using Pillow.
-    If the data is already JPEG, it's returned as-is.
+    If the data is already JPEG (and within the normalization limits, if
+    any), it's returned as-is.
     """
+    normalize = bool(max_edge or max_bytes)
+
+    # Without limits, a JPEG never needs to be looked at
+    if not normalize and sniff_image_format(image_data) == "JPEG":
+        return image_data
+
     try:
         with io.BytesIO(image_data) as in_buffer:
+            # Opening only reads the header, the pixels are decoded on demand
             img = Image.open(in_buffer)
 
-            # If it's already a JPEG, don't re-encode
-            if img.format == "JPEG":
+            too_large = bool(max_edge) and max(img.size) > max_edge
+            too_heavy = (
+                bool(max_bytes)
+                and len(image_data) > max_bytes
+                and max(img.size) > MIN_ART_EDGE
+            )
+
+            # If it's already a suitable JPEG, don't re-encode
+            if img.format == "JPEG" and not too_large and not too_heavy:
                 return image_data
 
+            if too_large:
+                # For JPEGs this lets the decoder skip most of the pixels
+                img.draft("RGB", (max_edge, max_edge))
+                img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
             # Remove transparency if the image has it
-            if img.mode in ("RGBA", "P"):
+            if img.mode not in ("RGB", "L"):
                 img = img.convert("RGB")
 
-            with io.BytesIO() as out_buffer:
-                img.save(out_buffer, format="JPEG", quality=95)
-                return out_buffer.getvalue()
+            jpeg_data = encode_jpeg(img, quality, progressive=normalize)
+
+            # Trade quality, then resolution, for size until it fits
+            while (
+                max_bytes
+                and len(jpeg_data) > max_bytes
+                and max(img.size) > MIN_ART_EDGE
+            ):
+                if quality > MIN_ART_QUALITY:
+                    quality = max(quality - 10, MIN_ART_QUALITY)
+                else:
+                    edge = max(int(max(img.size) * 0.75), MIN_ART_EDGE)
+                    img.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+                jpeg_data = encode_jpeg(img, quality, progressive=True)
+
+            return jpeg_data
     except Exception as e:
         print(f"Warning: Could not process or convert image to JPG: {e}")
         return None
 
 
-def embed_art_to_mp3(mp3_path: Path, image_data: bytes):
-    """Embeds the given JPG image data into the MP3 file's ID3 tags."""
-    try:
-        tags = ID3(mp3_path)
-    except Exception:
-        tags = ID3()  # Create new ID3 tag
-
-    # Remove any existing art to prevent duplicates
-    tags.delall("APIC")
-    tags.add(
-        APIC(
-            encoding=3,  # 3 is for utf-8
-            mime="image/jpeg",
-            type=3,  # 3 is for the cover (front) image
-            desc="Cover",
-            data=image_data,
-        )
+def cached_convert_to_jpeg(image_data: bytes) -> Optional[bytes]:
+    """
+    Same as convert_to_jpeg, but remembers recent results by content hash,
+    so the identical art embedded in every track of an album is only
+    decoded and converted once.
+    """
+    key = hashlib.blake2b(image_data, digest_size=16).digest()
+    with _jpeg_cache_lock:
+        if key in _jpeg_cache:
+            _jpeg_cache.move_to_end(key)
+            return _jpeg_cache[key]
+
+    jpeg_data = convert_to_jpeg(image_data)
+
+    with _jpeg_cache_lock:
+        _jpeg_cache[key] = jpeg_data
+        if len(_jpeg_cache) > JPEG_CACHE_SIZE:
+            _jpeg_cache.popitem(last=False)
+    return jpeg_data
+
+
+def embed_art_to_mp3(tags: ID3, image_data: bytes, desc: str = TRACK_ART_DESC) -> bool:
+    """
+    Embeds the given JPG image data into the given ID3 tags.
+    Returns True if the ID3 tags were modified.
+    """
+    # Replace any existing art to prevent duplicates
+    return replace_frames(
+        tags,
+        {"APIC"},
+        [
+            APIC(
+                encoding=3,  # 3 is for utf-8
+                mime="image/jpeg",
+                type=3,  # 3 is for the cover (front) image
+                desc=desc,
+                data=image_data,
+            )
+        ],
     )
-    try:
-        tags.save(mp3_path)
-    except Exception as e:
-        raise RuntimeError(f"Failed to save album art to {mp3_path}: {e}") from e
 
 
-def process_album_art(mp3_path: Path):
+def process_album_art(mp3_path: Path, tags: ID3) -> StageResult:
     """
     Processes album art for the given MP3 file.
-    It prioritizes an external .jpg file, falls back to embedded art,
-    and ensures both the file and the MP3 tag are synchronized.
-    If no art is found, it cleans up any existing art.
+    It prioritizes the track's own .jpg file, then its embedded art, then
+    falls back to the album's cover.jpg, and ensures the files and the MP3
+    tag are synchronized. Art shared with the album cover is only stored in
+    cover.jpg, and is embedded marked as such, so that it follows the cover
+    when cover.jpg is edited. A track only keeps its own .jpg if its art
+    differs, as it does in a compilation.
     """
-    jpg_path = mp3_path.with_suffix(".jpg")
+    track_jpg_path = mp3_path.with_suffix(".jpg")
+    album_jpg_path = mp3_path.parent / ALBUM_ART_NAME
 
-    raw_image_data: Optional[bytes] = None
+    result = StageResult()
+    album_jpg_data: Optional[bytes] = None
+    final_jpg_data: Optional[bytes] = None
+    found_art = False
 
-    if jpg_path.exists():
-        # Priority 1: .jpg file if it exists
+    try:
+        raw_album_data = read_sidecar(album_jpg_path)
+        if raw_album_data is not None:
+            album_jpg_data = cached_convert_to_jpeg(raw_album_data)
+            # Make sure the album cover itself is a proper JPEG
+            if album_jpg_data and album_jpg_data != raw_album_data:
+                result.sidecar_changed |= write_sidecar(album_jpg_path, album_jpg_data)
+    except Exception as e:
+        print(f"Error: Failed to read image from {album_jpg_path}: {e}")
+
+    raw_image_data = read_sidecar(track_jpg_path)
+    if raw_image_data is not None:
+        # Priority 1: the track's own .jpg file if it exists
         try:
-            raw_image_data = jpg_path.read_bytes()
+            found_art = True
+            final_jpg_data = cached_convert_to_jpeg(raw_image_data)
         except Exception as e:
-            print(f"Error: Failed to read image from {jpg_path}: {e}")
+            print(f"Error: Failed to read image from {track_jpg_path}: {e}")
     else:
-        # Priority 2: Fallback to embedded art
-        raw_image_data = extract_embedded_art(mp3_path)
-
-    if raw_image_data:
-        # We have image data, now process and sync it
-        final_jpg_data = convert_to_jpeg(raw_image_data)
-
-        if final_jpg_data:
-            # Write to .jpg file and embed in MP3
+        embedded = extract_embedded_art(tags)
+        if embedded and embedded.desc == ALBUM_ART_DESC and album_jpg_data:
+            # The album's art, which follows the current cover.jpg
+            found_art = True
+            final_jpg_data = album_jpg_data
+        elif embedded and embedded.data:
+            # Priority 2: the track's embedded art, which may not be the album's
             try:
-                jpg_path.write_bytes(final_jpg_data)
-                embed_art_to_mp3(mp3_path, final_jpg_data)
+                found_art = True
+                final_jpg_data = cached_convert_to_jpeg(embedded.data)
             except Exception as e:
-                print(f"Error: Failed to process album art for {mp3_path}: {e}")
-        else:
-            print(f"Could not get image data for {mp3_path.name}, skipping")
+                print(f"Error: Failed to read the embedded art of {mp3_path}: {e}")
+        if not final_jpg_data and album_jpg_data:
+            # Priority 3: Fallback to the album's cover.jpg
+            found_art = True
+            final_jpg_data = album_jpg_data
+
+    if final_jpg_data:
+        # Write to the sidecar files and embed in MP3, only where something changed
+        try:
+            if album_jpg_data is None:
+                # The first track of an album with art provides its cover
+                result.sidecar_changed |= write_sidecar(album_jpg_path, final_jpg_data)
+                album_jpg_data = final_jpg_data
+
+            if final_jpg_data == album_jpg_data:
+                # The album cover already holds exactly this art, drop the
+                # redundant copy
+                result.sidecar_changed |= remove_sidecar(track_jpg_path)
+                desc = ALBUM_ART_DESC
+            else:
+                result.sidecar_changed |= write_sidecar(track_jpg_path, final_jpg_data)
+                desc = TRACK_ART_DESC
+
+            result.tags_changed = embed_art_to_mp3(tags, final_jpg_data, desc)
+        except Exception as e:
+            print(f"Error: Failed to process album art for {mp3_path}: {e}")
+    elif found_art:
+        print(f"Could not get image data for {mp3_path.name}, skipping")
     else:
         print(f"Could not find any album art for {mp3_path.name}, skipping")
+    return result
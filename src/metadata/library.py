@@ -0,0 +1,322 @@
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional
+from collections.abc import Iterable
+
+from metadata.tags import Tags
+from utils import DATA_DIR, connect_db
+
+LIBRARY_PATH = DATA_DIR / "library.sqlite3"
+
+SPOTIFY_TRACK_REGEX = re.compile(r"open\.spotify\.com/(?:intl-\w+/)?track/(\w+)")
+
+# Separators between several artists in one tag
+ARTIST_SEPARATOR_REGEX = re.compile(r"; |\x00|/")
+
+# SQLite limits the number of parameters in one query
+QUERY_CHUNK_SIZE = 500
+
+# Catalog columns, besides the path and the lookup keys
+CATALOG_COLUMNS = (
+    "title",
+    "artist",
+    "album",
+    "album_artist",
+    "track",
+    "disc",
+    "recording_date",
+    "genre",
+    "spotify_url",
+    "youtube_url",
+    "has_lyrics",
+    "has_synced_lyrics",
+    "has_art",
+    "updated_at",
+)
+TRACK_COLUMNS = ("path", "spotify_id", "isrc") + CATALOG_COLUMNS
+
+
+def spotify_track_id(url: Optional[str]) -> Optional[str]:
+    """Extracts the track ID from a Spotify track URL."""
+    if not url:
+        return None
+    match = SPOTIFY_TRACK_REGEX.search(url)
+    return match.group(1) if match else None
+
+
+def normalize_isrc(isrc: Optional[str]) -> Optional[str]:
+    """ISRCs are stored and looked up in upper case, whatever the tags have."""
+    return isrc.upper() if isrc else None
+
+
+def split_artists(*values: Optional[str]) -> set[str]:
+    return {
+        artist.strip()
+        for value in values
+        if value
+        for artist in ARTIST_SEPARATOR_REGEX.split(value)
+        if artist.strip()
+    }
+
+
+class LibraryIndex:
+    """
+    A catalog of the tracks in the library, kept up to date by process_file.
+    It finds out whether a song is already owned without touching the disk,
+    and answers questions about the library with indexed lookups instead of
+    reading every sidecar.
+    """
+
+    def __init__(self, path: Path = LIBRARY_PATH):
+        self.lock = threading.Lock()
+        self.conn = connect_db(path)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(tracks)")}
+        if columns and not columns.issuperset(TRACK_COLUMNS):
+            # An index from before the catalog, process_directory refills it
+            self.conn.executescript("DROP TABLE tracks; DROP TABLE IF EXISTS track_artists;")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tracks (
+                path TEXT PRIMARY KEY,
+                spotify_id TEXT,
+                isrc TEXT,
+                title TEXT,
+                artist TEXT,
+                album TEXT,
+                album_artist TEXT,
+                track TEXT,
+                disc TEXT,
+                recording_date TEXT,
+                genre TEXT,
+                spotify_url TEXT,
+                youtube_url TEXT,
+                has_lyrics INTEGER NOT NULL DEFAULT 0,
+                has_synced_lyrics INTEGER NOT NULL DEFAULT 0,
+                has_art INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS tracks_spotify_id ON tracks (spotify_id);
+            CREATE INDEX IF NOT EXISTS tracks_isrc ON tracks (isrc);
+            CREATE INDEX IF NOT EXISTS tracks_album ON tracks (album COLLATE NOCASE);
+            -- A track can have several artists, each of them gets a row
+            CREATE TABLE IF NOT EXISTS track_artists (
+                path TEXT NOT NULL,
+                artist TEXT NOT NULL,
+                PRIMARY KEY (path, artist)
+            );
+            CREATE INDEX IF NOT EXISTS track_artists_artist
+                ON track_artists (artist COLLATE NOCASE);
+            """
+        )
+        # ISRCs used to be stored as they were in the tags
+        self.conn.execute(
+            "UPDATE tracks SET isrc = upper(isrc) WHERE isrc <> upper(isrc)"
+        )
+        self.conn.commit()
+
+    def update(
+        self,
+        mp3_path: Path,
+        tags: Tags,
+        has_lyrics: bool = False,
+        has_synced_lyrics: bool = False,
+        has_art: bool = False,
+    ):
+        path = str(mp3_path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO tracks ({', '.join(TRACK_COLUMNS)}) VALUES ({', '.join('?' * len(TRACK_COLUMNS))})",
+                (
+                    path,
+                    spotify_track_id(tags.spotify_url),
+                    normalize_isrc(tags.isrc),
+                    tags.title,
+                    tags.artist,
+                    tags.album,
+                    tags.album_artist,
+                    tags.track,
+                    tags.disc,
+                    tags.recording_date,
+                    tags.genre,
+                    tags.spotify_url,
+                    tags.youtube_url,
+                    has_lyrics,
+                    has_synced_lyrics,
+                    has_art,
+                    time.time(),
+                ),
+            )
+            self.conn.execute("DELETE FROM track_artists WHERE path = ?", (path,))
+            self.conn.executemany(
+                "INSERT INTO track_artists (path, artist) VALUES (?, ?)",
+                [
+                    (path, artist)
+                    for artist in split_artists(tags.artist, tags.album_artist)
+                ],
+            )
+
+    def remove(self, mp3_path: Path):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM tracks WHERE path = ?", (str(mp3_path),))
+            self.conn.execute(
+                "DELETE FROM track_artists WHERE path = ?", (str(mp3_path),)
+            )
+
+    def contains(self, mp3_path: Path) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM tracks WHERE path = ?", (str(mp3_path),)
+            ).fetchone()
+        return row is not None
+
+    def prune(self, directory: Path, existing: set[Path]):
+        """Removes tracks under the directory that are no longer in `existing`."""
+        prefix = f"{directory.as_posix().rstrip('/')}/"
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path FROM tracks WHERE substr(path, 1, ?) = ?",
+                (len(prefix), prefix),
+            ).fetchall()
+        stale = [(path,) for (path,) in rows if Path(path) not in existing]
+        if stale:
+            with self.lock, self.conn:
+                self.conn.executemany("DELETE FROM tracks WHERE path = ?", stale)
+                self.conn.executemany(
+                    "DELETE FROM track_artists WHERE path = ?", stale
+                )
+
+    def _existing(self, column: str, values: Iterable[Optional[str]]) -> set[str]:
+        """Returns which of the given values are present in a column."""
+        values = list({value for value in values if value})
+        found: set[str] = set()
+        with self.lock:
+            for i in range(0, len(values), QUERY_CHUNK_SIZE):
+                chunk = values[i : i + QUERY_CHUNK_SIZE]
+                placeholders = ", ".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT DISTINCT {column} FROM tracks WHERE {column} IN ({placeholders})",
+                    chunk,
+                )
+                found.update(value for (value,) in rows)
+        return found
+
+    def owned(
+        self, songs: list[tuple[Optional[str], Optional[str], Path]]
+    ) -> list[bool]:
+        """
+        Checks a batch of songs, given as (spotify url, isrc, rendered path),
+        against the index. A song is owned if any of the three matches a
+        track, so songs that were moved or renamed are still recognized.
+        """
+        spotify_ids = [spotify_track_id(url) for url, _, _ in songs]
+        isrcs = [normalize_isrc(isrc) for _, isrc, _ in songs]
+        owned_ids = self._existing("spotify_id", spotify_ids)
+        owned_isrcs = self._existing("isrc", isrcs)
+        owned_paths = self._existing("path", (str(path) for _, _, path in songs))
+        return [
+            spotify_id in owned_ids or isrc in owned_isrcs or str(path) in owned_paths
+            for spotify_id, isrc, (_, _, path) in zip(spotify_ids, isrcs, songs)
+        ]
+
+    def find(
+        self,
+        artist: Optional[str] = None,
+        album: Optional[str] = None,
+        isrc: Optional[str] = None,
+        spotify_url: Optional[str] = None,
+        has_lyrics: Optional[bool] = None,
+        has_synced_lyrics: Optional[bool] = None,
+        has_art: Optional[bool] = None,
+        limit: int = 1000,
+    ) -> list[dict[str, Any]]:
+        """
+        Returns the tracks matching every given filter, ordered by album
+        artist, album, disc and track. Artist and album must match exactly,
+        ignoring case; a track matches an artist that is one of several.
+        """
+        conditions: list[str] = []
+        params: list[Any] = []
+        if artist is not None:
+            conditions.append(
+                "path IN (SELECT path FROM track_artists WHERE artist = ? COLLATE NOCASE)"
+            )
+            params.append(artist)
+        if album is not None:
+            conditions.append("album = ? COLLATE NOCASE")
+            params.append(album)
+        if isrc is not None:
+            conditions.append("isrc = ?")
+            params.append(normalize_isrc(isrc))
+        if spotify_url is not None:
+            conditions.append("spotify_id = ?")
+            params.append(spotify_track_id(spotify_url) or spotify_url)
+        for column, value in (
+            ("has_lyrics", has_lyrics),
+            ("has_synced_lyrics", has_synced_lyrics),
+            ("has_art", has_art),
+        ):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.lock:
+            cursor = self.conn.execute(
+                f"""
+                SELECT {', '.join(TRACK_COLUMNS)} FROM tracks {where}
+                ORDER BY album_artist COLLATE NOCASE, album COLLATE NOCASE,
+                    CAST(disc AS INTEGER), CAST(track AS INTEGER), path
+                LIMIT ?
+                """,
+                (*params, limit),
+            )
+            rows = cursor.fetchall()
+        return [
+            {
+                **dict(zip(TRACK_COLUMNS, row)),
+                "has_lyrics": bool(row[TRACK_COLUMNS.index("has_lyrics")]),
+                "has_synced_lyrics": bool(row[TRACK_COLUMNS.index("has_synced_lyrics")]),
+                "has_art": bool(row[TRACK_COLUMNS.index("has_art")]),
+            }
+            for row in rows
+        ]
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            tracks, with_lyrics, with_synced_lyrics, with_art, albums = self.conn.execute(
+                """
+                SELECT COUNT(*), COALESCE(SUM(has_lyrics), 0),
+                    COALESCE(SUM(has_synced_lyrics), 0), COALESCE(SUM(has_art), 0),
+                    COUNT(DISTINCT album_artist || char(0) || album)
+                FROM tracks
+                """
+            ).fetchone()
+            (artists,) = self.conn.execute(
+                "SELECT COUNT(DISTINCT artist COLLATE NOCASE) FROM track_artists"
+            ).fetchone()
+        return {
+            "tracks": tracks,
+            "albums": albums,
+            "artists": artists,
+            "with_lyrics": with_lyrics,
+            "with_synced_lyrics": with_synced_lyrics,
+            "with_art": with_art,
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+_library_index: Optional[LibraryIndex] = None
+_library_index_lock = threading.Lock()
+
+
+def get_library_index() -> LibraryIndex:
+    """The shared LibraryIndex of this process."""
+    global _library_index
+    with _library_index_lock:
+        if _library_index is None:
+            _library_index = LibraryIndex()
+        return _library_index
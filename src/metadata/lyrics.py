@@ -1,54 +1,182 @@
 import re
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional, List
+from typing import Dict, Optional, List, Tuple
 from mutagen.id3 import ID3
-from mutagen.id3._frames import USLT, SYLT
+from mutagen.id3._frames import Frame, USLT, SYLT
 from mutagen.id3._specs import Encoding
 
+from metadata.lyrics_cache import get_lyrics_cache, lyrics_keys
+from metadata.sync import StageResult, read_sidecar, replace_frames, write_sidecar
+from metadata.tags import parse_id3_tags
 from utils import LyricLine, to_ms
 
-LRC_REGEX = re.compile(r"\[(\d{2}):(\d{2})\.(\d{2,3})\]")
+# A line timestamp like [01:23.45], also accepting [1:23], [01:23.4],
+# [01:23.456] and [01:23:45]
+TIMESTAMP_REGEX = re.compile(r"\[(\d+):(\d{1,2})(?:[.:](\d{1,3}))?\]")
+# Any line, with its first timestamp if it starts with one
+LINE_REGEX = re.compile(
+    r"^[^\S\n]*(?:\[(\d+):(\d{1,2})(?:[.:](\d{1,3}))?\])?(.*)$", re.MULTILINE
+)
+# A word timestamp of Enhanced LRC, like <01:23.45>
+WORD_TIMESTAMP_REGEX = re.compile(r"<(\d+):(\d{1,2})(?:[.:](\d{1,3}))?>")
+# A header tag taking up a whole line, like [ar:Artist] or [offset:+200]
+ID_TAG_REGEX = re.compile(r"\[([A-Za-z#]+):([^\]]*)\]$")
+# The standard LRC header tags. Anything else in brackets, like a section
+# label such as [Chorus: Artist], is part of the lyrics.
+ID_TAGS = {"ar", "ti", "al", "au", "by", "length", "offset", "re", "ve", "#"}
+
+# The ID3 frames managed by this module
+LYRICS_FRAMES = {"USLT", "SYLT"}
+
+
+@dataclass
+class ParsedLyrics:
+    lines: List[LyricLine]
+    # Header tags like "ar" or "ti", in file order, except for the offset
+    tags: Dict[str, str] = field(default_factory=dict)
+    # The [offset:] in ms, already applied to the line timestamps. Word
+    # timestamps are kept in the text as written, split_words applies it.
+    offset: int = 0
+
+
+def format_timestamp(ms: int) -> str:
+    """mm:ss.xx, with a third decimal only when it's needed to be exact."""
+    minutes, ms = divmod(ms, 60000)
+    seconds, ms = divmod(ms, 1000)
+    if ms % 10:
+        return f"{minutes:02d}:{seconds:02d}.{ms:03d}"
+    return f"{minutes:02d}:{seconds:02d}.{ms // 10:02d}"
+
+
+def split_words(ms: int, text: str, offset: int = 0) -> List[Tuple[int, str]]:
+    """
+    Splits a line with word timestamps into (ms, text) chunks, applying the
+    [offset:] to the word timestamps. The text before the first word
+    timestamp starts at the line's own time.
+    """
+    parts = WORD_TIMESTAMP_REGEX.split(text)
+    chunks = [(ms, parts[0])]
+    for i in range(1, len(parts), 4):
+        word_ms = to_ms(parts[i], parts[i + 1], parts[i + 2] or "") - offset
+        chunks.append((word_ms if word_ms > 0 else 0, parts[i + 3]))
+    if not chunks[0][1] and len(chunks) > 1 and chunks[1][0] == ms:
+        # A word timestamp at the very start of the line repeats its time
+        del chunks[0]
+    return chunks
+
+
+def join_words(chunks: List[Tuple[int, str]]) -> str:
+    """The inverse of split_words, for a line at the first chunk's time."""
+    return chunks[0][1] + "".join(
+        f"<{format_timestamp(ms)}>{word}" for ms, word in chunks[1:]
+    )
+
+
+def strip_words(text: str) -> str:
+    return WORD_TIMESTAMP_REGEX.sub("", text) if "<" in text else text
+
+
+def parse_lrc(text: str) -> ParsedLyrics:
+    """
+    Parse LRC text in a single pass, with one regex tokenizing every line.
+    Lines with several timestamps are repeated at each of them, [offset:]
+    is applied to them as they're read, header tags before the first lyric
+    line are collected, and Enhanced LRC word timestamps are kept in the
+    text as written. Lines without a timestamp are unsynced.
+    """
+    lines: List[LyricLine] = []
+    tags: Dict[str, str] = {}
+    if not text:
+        return ParsedLyrics(lines, tags)
+    if "\r" in text:
+        text = "\n".join(text.splitlines())
+    elif text.endswith("\n"):
+        # Like splitlines, a final newline doesn't start another line
+        text = text[:-1]
+
+    offset = 0
+    ordered = True
+    last_ms = -1
+    header = True
+    append = lines.append
+    for minutes, seconds, fraction, rest in LINE_REGEX.findall(text):
+        rest = rest.strip()
+        if not minutes:
+            tag = ID_TAG_REGEX.match(rest) if header and rest.startswith("[") else None
+            if tag is None or tag.group(1).lower() not in ID_TAGS:
+                # Unsynced or unformatted line
+                append((None, rest))
+                if rest:
+                    header = False
+                continue
+            key, value = tag.group(1).lower(), tag.group(2).strip()
+            if key == "offset":
+                try:
+                    offset = int(value)
+                except ValueError:
+                    pass
+            else:
+                tags[key] = value
+            continue
+
+        header = False
+        ms = to_ms(minutes, seconds, fraction)
+        stamps: Tuple[int, ...] = (ms,)
+        if rest.startswith("["):
+            # The same line at several times
+            while m := TIMESTAMP_REGEX.match(rest):
+                stamps += (to_ms(*m.groups("")),)
+                rest = rest[m.end() :].lstrip()
+        for ms in stamps:
+            if offset:
+                # The header tags, offset included, come before any lyrics.
+                # A positive offset makes the lyrics show up sooner.
+                ms = ms - offset if ms > offset else 0
+            if ms < last_ms:
+                ordered = False
+            last_ms = ms
+            append((ms, rest))
+
+    if not ordered:
+        # Put repeated lines in time order, keeping unsynced lines after the
+        # line they followed
+        anchors: List[int] = []
+        anchor = -1
+        for ms, _ in lines:
+            anchor = anchor if ms is None else ms
+            anchors.append(anchor)
+        lines = [lines[i] for i in sorted(range(len(lines)), key=anchors.__getitem__)]
+    return ParsedLyrics(lines, tags, offset)
 
 
 def parse_lyrics(text: str) -> List[LyricLine]:
     """Parse raw lyrics text into list of (timestamp in ms or None, text)."""
-    lines: List[LyricLine] = []
-    for line in text.splitlines():
-        line = line.rstrip()
-        if line.startswith("[") and "]" in line:
-            # Attempt to extract timestamp from the beginning.
-            try:
-                time_part, rest = line.split("]", 1)
-                m = LRC_REGEX.match(time_part + "]")
-                if m:
-                    ms = to_ms(m.group(1), m.group(2), m.group(3))
-                    lines.append((ms, rest.lstrip()))
-                    continue
-            except Exception:
-                pass
-        # Unsynced or unformatted line.
-        lines.append((None, line.strip()))
-    return lines
-
-
-def serialize_to_lrc(lyrics: List[LyricLine]) -> str:
-    """Serialize lyrics into LRC formatted text using first timestamp if present."""
-    result = []
+    return parse_lrc(text).lines
+
+
+def serialize_to_lrc(
+    lyrics: List[LyricLine], tags: Optional[Dict[str, str]] = None, offset: int = 0
+) -> str:
+    """
+    Serialize lyrics, and any header tags and offset, into LRC formatted
+    text that parse_lrc reads back unchanged. Timestamps keep their
+    milliseconds.
+    """
+    result = [f"[{key}:{value}]" for key, value in (tags or {}).items()]
+    if offset:
+        result.append(f"[offset:{offset:+d}]")
     for ts, text in lyrics:
         if ts is not None:
-            minutes = ts // 60000
-            seconds = (ts % 60000) / 1000
-            # Format: [mm:ss.xx]
-            timestamp = f"[{minutes:02d}:{seconds:05.2f}]"
-            result.append(f"{timestamp} {text}")
+            result.append(f"[{format_timestamp(ts + offset)}] {text}")
         else:
             result.append(text)
-    return "\n".join(result) + "\n"
+    return "".join(f"{line}\n" for line in result)
 
 
 def serialize_to_plain(lyrics: List[LyricLine]) -> str:
     """Serialize lyrics into plain text suitable for ID3 (timestamps removed)."""
-    return "\n".join(text for _, text in lyrics)
+    return "\n".join(strip_words(text) for _, text in lyrics)
 
 
 def clean_lyrics(lyrics: List[LyricLine]) -> List[LyricLine]:
@@ -71,21 +199,23 @@ def clean_lyrics(lyrics: List[LyricLine]) -> List[LyricLine]:
     return cleaned
 
 
-def parse_id3_lyrics(mp3_path: Path) -> Optional[List[LyricLine]]:
+def parse_id3_lyrics(tags: ID3) -> Optional[List[LyricLine]]:
     """Parse lyrics from ID3 tags into the intermediate format.
     Prioritize SYLT (synced) then USLT (unsynced).
     """
     try:
-        tags = ID3(mp3_path)
         # SYLT: synced lyrics, might be list of (text, ms) pairs.
         sylt_tags = tags.getall("SYLT")
         if sylt_tags:
             lines: List[LyricLine] = []
             for tag in sylt_tags:
-                if isinstance(tag.text, list):
-                    lines.extend([(ms, text.strip()) for text, ms in tag.text])
-                else:
+                if not isinstance(tag.text, list):
                     lines.append((None, tag.text.strip()))
+                elif any(text.startswith("\n") for text, _ in tag.text[1:]):
+                    # Word by word, every line starts with a newline
+                    lines.extend(parse_word_sync_data(tag.text))
+                else:
+                    lines.extend([(ms, text.strip()) for text, ms in tag.text])
             if lines:
                 return lines
         # USLT: unsynced lyrics (plain text)
@@ -98,64 +228,104 @@ def parse_id3_lyrics(mp3_path: Path) -> Optional[List[LyricLine]]:
     return None
 
 
-def embed_lyrics_to_mp3(mp3_path: Path, lyrics: List[LyricLine]):
-    try:
-        tags = ID3(mp3_path)
-    except Exception:
-        tags = ID3()  # Create new ID3 tag
+def word_sync_data(lyrics: List[LyricLine], offset: int = 0) -> List[Tuple[str, int]]:
+    """
+    SYLT entries for lyrics with word timestamps: one entry per word, and
+    as the ID3 spec has it, a newline before the first word of every line.
+    """
+    sync_data: List[Tuple[str, int]] = []
+    for ts, text in lyrics:
+        if ts is None:
+            continue
+        for i, (ms, word) in enumerate(split_words(ts, text, offset)):
+            sync_data.append(("\n" + word if i == 0 and sync_data else word, ms))
+    return sync_data
+
+
+def parse_word_sync_data(sync_data: List[Tuple[str, int]]) -> List[LyricLine]:
+    """The inverse of word_sync_data."""
+    lines: List[List[Tuple[int, str]]] = []
+    for i, (text, ms) in enumerate(sync_data):
+        if i == 0 or text.startswith("\n"):
+            lines.append([(ms, text[1:] if text.startswith("\n") else text)])
+        else:
+            lines[-1].append((ms, text))
+    return [(chunks[0][0], join_words(chunks).strip()) for chunks in lines]
+
 
+def embed_lyrics_to_mp3(tags: ID3, lyrics: List[LyricLine], offset: int = 0) -> bool:
+    """
+    Replace the lyrics frames in the given ID3 tags. `offset` is the
+    [offset:] the lyrics were parsed with, still to be applied to their
+    word timestamps.
+    Returns True if the ID3 tags were modified.
+    """
     # Determine if any synced entries exist.
     has_synced = any(ts is not None for ts, _ in lyrics)
     unsynced_text = serialize_to_plain(lyrics)
-    tags.delall("USLT")
-    tags.delall("SYLT")
-    tags.add(USLT(encoding=Encoding.UTF8, text=unsynced_text))
+    frames: List[Frame] = [USLT(encoding=Encoding.UTF8, text=unsynced_text)]
     if has_synced:
         # For SYLT, embed only those with a defined timestamp.
-        sync_data = [(text, ts) for ts, text in lyrics if ts is not None]
+        if any(ts is not None and strip_words(text) != text for ts, text in lyrics):
+            sync_data = word_sync_data(lyrics, offset)
+        else:
+            sync_data = [(text, ts) for ts, text in lyrics if ts is not None]
         if sync_data:
-            tags.add(SYLT(encoding=Encoding.UTF8, text=sync_data, format=2, type=1))
-    try:
-        tags.save(mp3_path)
-    except Exception as e:
-        raise RuntimeError(f"Failed to save lyrics to {mp3_path}: {e}") from e
+            frames.append(
+                SYLT(encoding=Encoding.UTF8, text=sync_data, format=2, type=1)
+            )
+    return replace_frames(tags, LYRICS_FRAMES, frames)
 
 
-def remove_embedded_lyrics(mp3_path: Path):
-    try:
-        tags = ID3(mp3_path)
-        tags.delall("USLT")
-        tags.delall("SYLT")
-        tags.save(mp3_path)
-    except Exception as e:
-        print(f"Error: Failed to remove lyrics from {mp3_path}: {e}")
+def remove_embedded_lyrics(tags: ID3) -> bool:
+    return replace_frames(tags, LYRICS_FRAMES, [])
+
+
+def cached_lyrics(tags: ID3) -> Optional[ParsedLyrics]:
+    """Lyrics from the lyrics cache, looked up by the ISRC and Spotify URL."""
+    tags_data = parse_id3_tags(tags)
+    cached = get_lyrics_cache().get(lyrics_keys(tags_data.isrc, tags_data.spotify_url))
+    if cached is None or not cached.lyrics:
+        return None
+    return parse_lrc(cached.lyrics)
 
 
-def process_lyrics(mp3_path: Path):
+def process_lyrics(mp3_path: Path, tags: ID3) -> StageResult:
     lrc_path = mp3_path.with_suffix(".lrc")
 
     raw_lyrics: Optional[List[LyricLine]] = None
+    lrc_tags: Dict[str, str] = {}
+    lrc_offset = 0
 
-    if lrc_path.exists():
+    lrc_data = read_sidecar(lrc_path)
+    if lrc_data is not None:
         # Priority: .lrc file if it exists
         try:
-            raw_text = lrc_path.read_text(encoding="utf-8")
-            raw_lyrics = parse_lyrics(raw_text)
+            parsed = parse_lrc(lrc_data.decode("utf-8"))
+            raw_lyrics, lrc_tags, lrc_offset = parsed.lines, parsed.tags, parsed.offset
         except Exception as e:
             print(f"Error: Failed to read lyrics from {lrc_path}: {e}")
     else:
-        # Fallback: parse lyrics from ID3
-        raw_lyrics = parse_id3_lyrics(mp3_path)
+        # Fallback: parse lyrics from ID3, then from what the lyrics
+        # providers found when the song was downloaded
+        raw_lyrics = parse_id3_lyrics(tags)
+        if not raw_lyrics and (cached := cached_lyrics(tags)):
+            raw_lyrics, lrc_offset = cached.lines, cached.offset
 
+    result = StageResult()
     if raw_lyrics:
         # Apply cleaning
         cleaned_lyrics = clean_lyrics(raw_lyrics)
 
-        # Write to .lrc file and embed in MP3
+        # Write to .lrc file and embed in MP3, only where something changed
         try:
-            lrc_path.write_text(serialize_to_lrc(cleaned_lyrics), encoding="utf-8")
-            embed_lyrics_to_mp3(mp3_path, cleaned_lyrics)
+            result.sidecar_changed = write_sidecar(
+                lrc_path,
+                serialize_to_lrc(cleaned_lyrics, lrc_tags, lrc_offset).encode("utf-8"),
+            )
+            result.tags_changed = embed_lyrics_to_mp3(tags, cleaned_lyrics, lrc_offset)
         except Exception as e:
             print(f"Error: Failed to process lyrics for {mp3_path}: {e}")
     else:
         print(f"No lyrics found for {mp3_path.name}, skipping")
+    return result
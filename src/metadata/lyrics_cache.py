@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from metadata.library import spotify_track_id
+from utils import DATA_DIR, connect_db
+
+LYRICS_CACHE_PATH = DATA_DIR / "lyrics.sqlite3"
+
+# Songs no provider had lyrics for (instrumentals, obscure tracks) are only
+# looked up again after this many seconds. Found lyrics never expire.
+LYRICS_CACHE_NEGATIVE_TTL = int(
+    os.environ.get("LYRICS_CACHE_NEGATIVE_TTL") or 30 * 24 * 60 * 60
+)
+
+
+def lyrics_keys(isrc: Optional[str], spotify_url: Optional[str]) -> list[str]:
+    """The cache keys of a song, the same recording under every ID it has."""
+    keys: list[str] = []
+    if isrc:
+        keys.append(f"isrc:{isrc.upper()}")
+    spotify_id = spotify_track_id(spotify_url)
+    if spotify_id:
+        keys.append(f"spotify:{spotify_id}")
+    return keys
+
+
+@dataclass
+class CachedLyrics:
+    provider: Optional[str]  # None when no provider had lyrics
+    lyrics: Optional[str]
+    fetched_at: float
+
+
+class LyricsCache:
+    """
+    A persistent cache of lyrics provider results, keyed by ISRC and Spotify
+    track ID. Songs without lyrics are cached too, so every provider isn't
+    scraped again for them on each download.
+    """
+
+    def __init__(self, path: Path = LYRICS_CACHE_PATH):
+        self.lock = threading.Lock()
+        self.conn = connect_db(path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS lyrics (
+                    key TEXT PRIMARY KEY,
+                    provider TEXT,
+                    lyrics TEXT,
+                    fetched_at REAL NOT NULL,
+                    expires_at REAL
+                )
+                """
+            )
+            self.conn.execute(
+                "DELETE FROM lyrics WHERE expires_at < ?", (time.time(),)
+            )
+
+    def get(self, keys: list[str]) -> Optional[CachedLyrics]:
+        """
+        Returns the cached result for the first key that has one, or None on
+        a cache miss. Found lyrics win over a negative result.
+        """
+        if not keys:
+            return None
+        with self.lock:
+            rows = self.conn.execute(
+                f"""
+                SELECT provider, lyrics, fetched_at FROM lyrics
+                WHERE key IN ({', '.join('?' * len(keys))})
+                AND (expires_at IS NULL OR expires_at >= ?)
+                ORDER BY lyrics IS NULL
+                """,
+                (*keys, time.time()),
+            ).fetchall()
+        return CachedLyrics(*rows[0]) if rows else None
+
+    def put(self, keys: list[str], provider: Optional[str], lyrics: Optional[str]):
+        """Stores lyrics found by `provider`, or with None, that none were found."""
+        now = time.time()
+        expires_at = None if lyrics else now + LYRICS_CACHE_NEGATIVE_TTL
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO lyrics (key, provider, lyrics, fetched_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+                [(key, provider, lyrics, now, expires_at) for key in keys],
+            )
+
+
+_lyrics_cache: Optional[LyricsCache] = None
+_lyrics_cache_lock = threading.Lock()
+
+
+def get_lyrics_cache() -> LyricsCache:
+    """The shared LyricsCache of this process."""
+    global _lyrics_cache
+    with _lyrics_cache_lock:
+        if _lyrics_cache is None:
+            _lyrics_cache = LyricsCache()
+        return _lyrics_cache
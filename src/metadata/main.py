@@ -1,21 +1,265 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
 from pathlib import Path
-from metadata.tags import process_tags
-from metadata.lyrics import process_lyrics
+from typing import Optional, TypeVar
+from collections.abc import Callable, Iterator, Sequence
+
+from mutagen.id3 import ID3, ID3NoHeaderError
+
+from metadata.tags import parse_id3_tags, process_tags
+from metadata.lyrics import LYRICS_FRAMES, process_lyrics
 from metadata.album_art import process_album_art
+from metadata.library import get_library_index
+from metadata.manifest import Manifest
+from metadata.sync import StageResult, batched_fsyncs
+from metrics import observe_stage_timings
+from tracing import record_timings
+
+# A stage reads its sidecar and syncs it with the shared in-memory ID3 tags,
+# reporting what it changed. Stages must not save the tags themselves;
+# process_file does that once, and only if a stage changed them.
+Stage = Callable[[Path, ID3], StageResult]
+
+STAGES: tuple[Stage, ...] = (process_tags, process_lyrics, process_album_art)
+
+# Number of worker processes used by process_directory
+DEFAULT_WORKERS = int(os.environ.get("METADATA_WORKERS") or os.cpu_count() or 1)
+
+# Seconds spent in each stage, by stage name
+StageTimings = dict[str, float]
+
+# (mp3 path, changed, error message, stage timings)
+FileResult = tuple[Path, bool, Optional[str], StageTimings]
+
+AlbumResult = TypeVar("AlbumResult")
+
+
+def load_id3(mp3_path: Path) -> ID3:
+    """
+    Loads the ID3 tags of an MP3 file, starting fresh if it has none. Any
+    other read error is raised, so a corrupt tag is never replaced.
+    """
+    try:
+        return ID3(mp3_path)
+    except ID3NoHeaderError:
+        return ID3()
+
+
+def save_id3(mp3_path: Path, id3: ID3):
+    try:
+        id3.save(mp3_path)
+    except Exception as e:
+        raise RuntimeError(f"Failed to save ID3 tags to {mp3_path}: {e}") from e
 
 
-def process_file(mp3_path: Path):
+def process_file(
+    mp3_path: Path,
+    stages: Sequence[Stage] = STAGES,
+    timings: Optional[StageTimings] = None,
+) -> bool:
     """
     Process metadata for the given MP3 file.
+    The ID3 tags are parsed once, passed through every stage, and saved at
+    most once. Returns True if the MP3 or any of its sidecars was written.
+    If `timings` is given, the time spent in each stage, and in loading and
+    saving the tags, is added to it.
+    """
+    if timings is None:
+        timings = {}
+    start = time.perf_counter()
+    id3 = load_id3(mp3_path)
+    timings["load_id3"] = time.perf_counter() - start
+    results: list[StageResult] = []
+    for stage in stages:
+        start = time.perf_counter()
+        results.append(stage(mp3_path, id3))
+        timings[stage.__name__] = time.perf_counter() - start
+    if any(result.tags_changed for result in results):
+        start = time.perf_counter()
+        save_id3(mp3_path, id3)
+        timings["save_id3"] = time.perf_counter() - start
+    get_library_index().update(
+        mp3_path,
+        parse_id3_tags(id3),
+        has_lyrics=any(id3.getall(kind) for kind in LYRICS_FRAMES),
+        has_synced_lyrics=bool(id3.getall("SYLT")),
+        has_art=bool(id3.getall("APIC")),
+    )
+    return any(result.changed for result in results)
+
+
+def timed_process_file(mp3_path: Path) -> tuple[bool, StageTimings]:
+    """
+    Like process_file, but also returns the stage timings, for callers that
+    run it in another process and record the metrics themselves.
+    """
+    timings: StageTimings = {}
+    changed = process_file(mp3_path, timings=timings)
+    return changed, timings
+
+
+def process_album(mp3_files: list[Path]) -> list[FileResult]:
+    """
+    Process the given MP3 files (all from one album directory) in order.
+    Errors are collected per file instead of aborting the album.
     """
-    process_tags(mp3_path)
-    process_lyrics(mp3_path)
-    process_album_art(mp3_path)
+    results: list[FileResult] = []
+    # The sidecars all go to the album directory, which is synced once
+    with batched_fsyncs():
+        for mp3_file in mp3_files:
+            timings: StageTimings = {}
+            try:
+                changed = process_file(mp3_file, timings=timings)
+                results.append((mp3_file, changed, None, timings))
+            except Exception as e:
+                print(f"Error: Failed to process {mp3_file}: {e}")
+                results.append((mp3_file, False, f"{type(e).__name__}: {e}", timings))
+    return results
 
 
-def process_directory(directory: Path):
+def map_albums(
+    function: Callable[[list[Path]], AlbumResult],
+    albums: dict[Path, list[Path]],
+    workers: int,
+    on_error: Callable[[Path, Exception], AlbumResult],
+) -> Iterator[tuple[Path, AlbumResult]]:
+    """
+    Runs `function` on the MP3 files of each album, in `workers` processes
+    if there is more than one, yielding the results as albums finish.
+    `on_error` provides the result of an album whose worker failed.
+    """
+    if workers > 1 and len(albums) > 1:
+        # Spawn fresh interpreters, forking a threaded server is unsafe
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures: dict[Future[AlbumResult], Path] = {
+                executor.submit(function, mp3_files): album
+                for album, mp3_files in albums.items()
+            }
+            for future in as_completed(futures):
+                album = futures[future]
+                try:
+                    results = future.result()
+                except Exception as e:
+                    results = on_error(album, e)
+                yield album, results
+    else:
+        for album, mp3_files in albums.items():
+            yield album, function(mp3_files)
+
+
+_metadata_pool: Optional[ProcessPoolExecutor] = None
+_metadata_pool_lock = threading.Lock()
+
+
+def metadata_pool() -> ProcessPoolExecutor:
+    """
+    The process pool shared by the metadata stage of every download, so
+    that concurrent jobs never run more than DEFAULT_WORKERS processes and
+    a job for a single song doesn't pay for starting a pool. Its processes
+    are started as they are needed, and then kept for the next job.
+    """
+    global _metadata_pool
+    with _metadata_pool_lock:
+        if _metadata_pool is None:
+            # Spawn fresh interpreters, forking a threaded server is unsafe
+            _metadata_pool = ProcessPoolExecutor(
+                max_workers=DEFAULT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _metadata_pool
+
+
+def discard_metadata_pool(pool: ProcessPoolExecutor):
+    """Replaces a pool that broke because one of its processes died."""
+    global _metadata_pool
+    with _metadata_pool_lock:
+        if _metadata_pool is pool:
+            _metadata_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def process_directory(
+    directory: Path,
+    full: bool = False,
+    workers: int = DEFAULT_WORKERS,
+    status_callback: Optional[Callable[[str], None]] = None,
+) -> list[tuple[Path, str]]:
     """
     Process all MP3 files in the given directory.
+    Unless `full` is set, tracks whose MP3 and sidecars haven't changed since
+    they were last processed are skipped.
+
+    Work is split by album directory, so tracks sharing sidecars are always
+    handled by the same worker. Returns the (path, error) of every file that
+    failed.
     """
-    for mp3_file in directory.rglob("*.mp3"):
-        process_file(mp3_file)
+    library_index = get_library_index()
+    with Manifest() as manifest:
+        albums: dict[Path, list[Path]] = {}
+        seen: set[Path] = set()
+        skipped = 0
+        for mp3_file in directory.rglob("*.mp3"):
+            seen.add(mp3_file)
+            if (
+                not full
+                and manifest.is_unchanged(mp3_file)
+                and library_index.contains(mp3_file)
+            ):
+                skipped += 1
+                continue
+            albums.setdefault(mp3_file.parent, []).append(mp3_file)
+        library_index.prune(directory, seen)
+
+        total_files = sum(len(mp3_files) for mp3_files in albums.values())
+        start_log_str = f"Processing {total_files} {'file' if total_files == 1 else 'files'} ({skipped} unchanged)..."
+        print(start_log_str)
+        if status_callback:
+            status_callback(start_log_str)
+
+        processed_files = 0
+        changed_files = 0
+        errors: list[tuple[Path, str]] = []
+
+        def handle_results(album: Path, results: list[FileResult]):
+            nonlocal processed_files, changed_files
+            for mp3_file, changed, error, timings in results:
+                observe_stage_timings(timings)
+                record_timings(timings, track=str(mp3_file))
+                changed_files += changed
+                if error is None:
+                    manifest.record(mp3_file)
+                else:
+                    manifest.forget(mp3_file)
+                    errors.append((mp3_file, error))
+
+            processed_files += len(results)
+            percentage_str = f"{(processed_files / total_files) * 100:.2f}%"
+            album_log_str = f"Processed {percentage_str} ({processed_files}/{total_files}) - '{album.name}'"
+            print(album_log_str)
+            if status_callback:
+                status_callback(album_log_str)
+
+        def worker_failed(album: Path, e: Exception) -> list[FileResult]:
+            print(f"Error: Worker failed while processing {album}: {e}")
+            return [
+                (mp3_file, False, f"{type(e).__name__}: {e}", {})
+                for mp3_file in albums[album]
+            ]
+
+        for album, results in map_albums(
+            process_album, albums, workers, on_error=worker_failed
+        ):
+            handle_results(album, results)
+
+    done_log_str = f"Processed {total_files - len(errors)} out of {total_files} files ({changed_files} changed). Failed to process {len(errors)} files."
+    print(done_log_str)
+    if status_callback:
+        status_callback(done_log_str)
+
+    return errors
+
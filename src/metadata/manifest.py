@@ -0,0 +1,102 @@
+from pathlib import Path
+from typing import Optional
+
+from metadata.album_art import ALBUM_ART_NAME
+from utils import DATA_DIR, connect_db
+
+MANIFEST_PATH = DATA_DIR / "manifest.sqlite3"
+
+# Sidecar files whose changes should trigger reprocessing of their track
+SIDECAR_SUFFIXES = (".json", ".lrc", ".jpg")
+
+# Number of recorded tracks between commits during a scan
+COMMIT_INTERVAL = 500
+
+Fingerprint = tuple[int, int, str]  # (mp3 mtime_ns, mp3 size, sidecar fingerprint)
+
+
+def track_fingerprint(mp3_path: Path) -> Optional[Fingerprint]:
+    """
+    Describes the current on-disk state of a track and its sidecars using
+    only stat calls. Returns None if the MP3 itself can't be read.
+    """
+    try:
+        stat = mp3_path.stat()
+    except OSError:
+        return None
+
+    sidecar_paths = [mp3_path.with_suffix(suffix) for suffix in SIDECAR_SUFFIXES]
+    sidecar_paths.append(mp3_path.parent / ALBUM_ART_NAME)
+
+    sidecars = []
+    for sidecar_path in sidecar_paths:
+        try:
+            sidecar_stat = sidecar_path.stat()
+            sidecars.append(f"{sidecar_stat.st_mtime_ns}:{sidecar_stat.st_size}")
+        except OSError:
+            sidecars.append("-")
+
+    return stat.st_mtime_ns, stat.st_size, "|".join(sidecars)
+
+
+class Manifest:
+    """
+    Remembers the state of each track after its last successful processing,
+    so that a rescan can skip tracks whose MP3 and sidecars haven't changed.
+    """
+
+    def __init__(self, path: Path = MANIFEST_PATH):
+        self.conn = connect_db(path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tracks (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                sidecars TEXT NOT NULL
+            )
+            """
+        )
+        self.conn.commit()
+        self.pending = 0
+
+    def is_unchanged(self, mp3_path: Path) -> bool:
+        """Returns True if the track is exactly as it was when last recorded."""
+        row = self.conn.execute(
+            "SELECT mtime_ns, size, sidecars FROM tracks WHERE path = ?",
+            (str(mp3_path),),
+        ).fetchone()
+        return row is not None and tuple(row) == track_fingerprint(mp3_path)
+
+    def record(self, mp3_path: Path):
+        """Stores the current state of a track after it was processed."""
+        fingerprint = track_fingerprint(mp3_path)
+        if fingerprint is None:
+            self.forget(mp3_path)
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO tracks (path, mtime_ns, size, sidecars) VALUES (?, ?, ?, ?)",
+            (str(mp3_path), *fingerprint),
+        )
+        self._maybe_commit()
+
+    def forget(self, mp3_path: Path):
+        """Drops a track so it's processed again on the next scan."""
+        self.conn.execute("DELETE FROM tracks WHERE path = ?", (str(mp3_path),))
+        self._maybe_commit()
+
+    def _maybe_commit(self):
+        self.pending += 1
+        if self.pending >= COMMIT_INTERVAL:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,220 @@
+import json
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Optional
+from collections.abc import Callable, Sequence
+
+from mutagen.id3._frames import (
+    APIC,
+    COMM,
+    POPM,
+    SYLT,
+    USLT,
+    Frame,
+    TextFrame,
+    UrlFrame,
+)
+
+from metadata.library import get_library_index
+from metadata.main import DEFAULT_WORKERS, STAGES, Stage, load_id3, map_albums
+from metadata.manifest import Manifest
+from metadata.sync import frame_bytes, planning
+from utils import DATA_DIR
+
+PLANS_PATH = DATA_DIR / "plans"
+
+# Longest text shown for a frame in a diff
+DESCRIPTION_LENGTH = 120
+
+
+@dataclass
+class FileDiff:
+    """What process_file would change for one track."""
+
+    path: str
+    # Frame key (e.g. "COMM::eng") to its description before and after,
+    # None where the frame is missing
+    frames: dict[str, tuple[Optional[str], Optional[str]]] = field(
+        default_factory=dict
+    )
+    # Sidecar file name to "create", "update" or "delete"
+    sidecars: dict[str, str] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.frames or self.sidecars)
+
+
+def shorten(text: str) -> str:
+    text = text.replace("\n", "\\n")
+    if len(text) <= DESCRIPTION_LENGTH:
+        return text
+    return text[: DESCRIPTION_LENGTH - 3] + "..."
+
+
+def describe_frame(frame: Frame) -> str:
+    """A short, human-readable summary of a frame's content."""
+    if isinstance(frame, APIC):
+        return f"{frame.mime}, {len(frame.data)} bytes"
+    if isinstance(frame, (SYLT, USLT)):
+        # Enough to spot stripped credits: the line count and the first line
+        lines = (
+            [text for text, _ in frame.text]
+            if isinstance(frame, SYLT)
+            else frame.text.splitlines()
+        )
+        first_line = shorten(lines[0]) if lines else ""
+        return f"{len(lines)} lines, starting {first_line!r}"
+    if isinstance(frame, POPM):
+        return f"rating {frame.rating}"
+    if isinstance(frame, (COMM, TextFrame)):
+        return shorten(str(frame))
+    if isinstance(frame, UrlFrame):
+        return frame.url
+    return f"{len(frame_bytes(frame))} bytes"
+
+
+def plan_file(mp3_path: Path, stages: Sequence[Stage] = STAGES) -> FileDiff:
+    """
+    Runs the stages on the track in memory and reports what they would
+    change, without writing the MP3, its sidecars or the library index.
+    """
+    id3 = load_id3(mp3_path)
+    before = {key: (frame, frame_bytes(frame)) for key, frame in id3.items()}
+
+    with planning() as plan:
+        first_change = len(plan.changes)
+        for stage in stages:
+            stage(mp3_path, id3)
+
+    diff = FileDiff(str(mp3_path))
+    after = {key: (frame, frame_bytes(frame)) for key, frame in id3.items()}
+    for key in sorted(before.keys() | after.keys()):
+        old, new = before.get(key), after.get(key)
+        if old is not None and new is not None and old[1] == new[1]:
+            continue
+        diff.frames[key] = (
+            describe_frame(old[0]) if old else None,
+            describe_frame(new[0]) if new else None,
+        )
+    for path, change in plan.changes[first_change:]:
+        diff.sidecars[path.name] = change
+    return diff
+
+
+def plan_album(mp3_files: list[Path]) -> list[FileDiff]:
+    """
+    Plans the given MP3 files (all from one album directory) in order. The
+    planned sidecars are shared by the album, so a cover.jpg planned for its
+    first track is what the next tracks see.
+    """
+    diffs: list[FileDiff] = []
+    with planning():
+        for mp3_file in mp3_files:
+            try:
+                diffs.append(plan_file(mp3_file))
+            except Exception as e:
+                print(f"Error: Failed to plan {mp3_file}: {e}")
+                diffs.append(FileDiff(str(mp3_file), error=f"{type(e).__name__}: {e}"))
+    return diffs
+
+
+def plan_directory(
+    directory: Path,
+    full: bool = False,
+    workers: int = DEFAULT_WORKERS,
+    status_callback: Optional[Callable[[str], None]] = None,
+) -> dict[str, Any]:
+    """
+    Reports what process_directory would do to the given directory, without
+    writing anything. Returns a summary, with counts of the changes by frame
+    and sidecar type, and the diff of every track that would change or fail.
+    """
+    albums: dict[Path, list[Path]] = {}
+    skipped = 0
+    library_index = get_library_index()
+    with Manifest() as manifest:
+        for mp3_file in directory.rglob("*.mp3"):
+            if (
+                not full
+                and manifest.is_unchanged(mp3_file)
+                and library_index.contains(mp3_file)
+            ):
+                skipped += 1
+                continue
+            albums.setdefault(mp3_file.parent, []).append(mp3_file)
+
+    total_files = sum(len(mp3_files) for mp3_files in albums.values())
+    start_log_str = f"Planning {total_files} {'file' if total_files == 1 else 'files'} ({skipped} unchanged)..."
+    print(start_log_str)
+    if status_callback:
+        status_callback(start_log_str)
+
+    start = time.perf_counter()
+    planned_files = 0
+    frame_changes: Counter[str] = Counter()
+    sidecar_changes: Counter[str] = Counter()
+    diffs: list[FileDiff] = []
+
+    def worker_failed(album: Path, e: Exception) -> list[FileDiff]:
+        print(f"Error: Worker failed while planning {album}: {e}")
+        return [
+            FileDiff(str(mp3_file), error=f"{type(e).__name__}: {e}")
+            for mp3_file in albums[album]
+        ]
+
+    for album, album_diffs in map_albums(
+        plan_album, albums, workers, on_error=worker_failed
+    ):
+        for diff in album_diffs:
+            frame_changes.update(key[:4] for key in diff.frames)
+            sidecar_changes.update(
+                f"{Path(name).suffix} {change}" for name, change in diff.sidecars.items()
+            )
+            if diff.changed or diff.error:
+                diffs.append(diff)
+
+        planned_files += len(album_diffs)
+        percentage_str = f"{(planned_files / total_files) * 100:.2f}%"
+        album_log_str = f"Planned {percentage_str} ({planned_files}/{total_files}) - '{album.name}'"
+        print(album_log_str)
+        if status_callback:
+            status_callback(album_log_str)
+
+    diffs.sort(key=lambda diff: diff.path)
+    errors = sum(diff.error is not None for diff in diffs)
+    changed_files = sum(diff.changed for diff in diffs)
+    done_log_str = f"Planned {total_files} files: {changed_files} would change, {errors} would fail."
+    print(done_log_str)
+    if status_callback:
+        status_callback(done_log_str)
+
+    return {
+        "directory": str(directory),
+        "full": full,
+        "seconds": time.perf_counter() - start,
+        "files": total_files,
+        "skipped": skipped,
+        "changed": changed_files,
+        "errors": errors,
+        "frame_changes": dict(frame_changes.most_common()),
+        "sidecar_changes": dict(sidecar_changes.most_common()),
+        "diffs": [asdict(diff) for diff in diffs],
+    }
+
+
+def save_plan(name: str, plan: dict[str, Any]) -> Path:
+    PLANS_PATH.mkdir(parents=True, exist_ok=True)
+    path = PLANS_PATH / f"{name}.json"
+    path.write_text(json.dumps(plan, indent=2) + "\n")
+    return path
+
+
+def load_plan(name: str) -> Optional[dict[str, Any]]:
+    try:
+        return json.loads((PLANS_PATH / f"{name}.json").read_text())
+    except FileNotFoundError:
+        return None
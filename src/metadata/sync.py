@@ -0,0 +1,211 @@
+import contextvars
+import os
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+from collections.abc import Collection, Iterable, Iterator
+
+from mutagen.id3 import ID3
+from mutagen.id3._frames import Frame
+
+
+@dataclass
+class StageResult:
+    """What a metadata stage actually changed for one file."""
+
+    tags_changed: bool = False
+    sidecar_changed: bool = False
+
+    @property
+    def changed(self) -> bool:
+        return self.tags_changed or self.sidecar_changed
+
+
+def frame_bytes(frame: Frame) -> bytes:
+    """The serialized body of a frame, used to compare frames by content."""
+    return frame._writeData()
+
+
+def replace_frames(id3: ID3, kinds: Collection[str], frames: Iterable[Frame]) -> bool:
+    """
+    Replaces all frames of the given kinds (e.g. "APIC") with `frames`,
+    leaving the ID3 tags untouched if they already hold identical frames.
+    Returns True if the tags were modified.
+    """
+    frames = list(frames)
+    existing = sorted(
+        (key, frame_bytes(frame)) for key, frame in id3.items() if key[:4] in kinds
+    )
+    new = sorted((frame.HashKey, frame_bytes(frame)) for frame in frames)
+    if existing == new:
+        return False
+
+    for kind in kinds:
+        id3.delall(kind)
+    for frame in frames:
+        id3.add(frame)
+    return True
+
+
+@dataclass
+class SidecarPlan:
+    """
+    The sidecar writes and deletions a dry run would have made. Later reads
+    see the planned content, so tracks sharing a sidecar (like cover.jpg)
+    are planned as if the earlier ones had been written.
+    """
+
+    # Planned content by path, None for a deletion
+    files: dict[Path, Optional[bytes]] = field(default_factory=dict)
+    # Every planned change in order, as (path, "create", "update" or "delete")
+    changes: list[tuple[Path, str]] = field(default_factory=list)
+
+
+_plan: contextvars.ContextVar[Optional[SidecarPlan]] = contextvars.ContextVar(
+    "sidecar_plan", default=None
+)
+
+
+@contextmanager
+def planning() -> Iterator[SidecarPlan]:
+    """
+    Within this block, sidecars are only planned instead of written. Nested
+    blocks add to the plan of the outermost one.
+    """
+    plan = _plan.get() or SidecarPlan()
+    token = _plan.set(plan)
+    try:
+        yield plan
+    finally:
+        _plan.reset(token)
+
+
+def read_sidecar(path: Path) -> Optional[bytes]:
+    """The content of a sidecar file, or None if it doesn't exist."""
+    plan = _plan.get()
+    if plan is not None and path in plan.files:
+        return plan.files[path]
+    try:
+        return path.read_bytes()
+    except FileNotFoundError:
+        return None
+
+
+_fsync_batch: contextvars.ContextVar[Optional[set[Path]]] = contextvars.ContextVar(
+    "sidecar_fsync_batch", default=None
+)
+
+
+def fsync_directory(directory: Path):
+    """Makes the creation, replacement or removal of files in a directory durable."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # Not every platform can open a directory, Windows for one
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def sync_directory(directory: Path):
+    """Syncs the directory now, or at the end of the current batch."""
+    batch = _fsync_batch.get()
+    if batch is not None:
+        batch.add(directory)
+    else:
+        fsync_directory(directory)
+
+
+@contextmanager
+def batched_fsyncs() -> Iterator[None]:
+    """
+    Within this block, sidecar writes sync each directory they touched once
+    at the end, instead of once per file. Meant for bulk passes, where an
+    album's tracks all write to the same directory. Nested blocks join the
+    batch of the outermost one.
+    """
+    if _fsync_batch.get() is not None:
+        yield
+        return
+    batch: set[Path] = set()
+    token = _fsync_batch.set(batch)
+    try:
+        yield
+    finally:
+        _fsync_batch.reset(token)
+        for directory in sorted(batch):
+            fsync_directory(directory)
+
+
+def atomic_write(path: Path, data: bytes, mode: Optional[int] = None):
+    """
+    Replaces the file with `data` through a temporary file in the same
+    directory, so it's never seen, or left behind by a crash, half written.
+    """
+    temp_path = path.with_name(f".{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    sync_directory(path.parent)
+
+
+def write_sidecar(path: Path, data: bytes) -> bool:
+    """
+    Atomically writes a sidecar file unless it already has exactly this
+    content, so unchanged files keep their mtime. Returns True if the file
+    was written.
+    """
+    plan = _plan.get()
+    if plan is not None:
+        existing = read_sidecar(path)
+        if existing == data:
+            return False
+        plan.files[path] = data
+        plan.changes.append((path, "create" if existing is None else "update"))
+        return True
+
+    mode: Optional[int] = None
+    try:
+        stat = path.stat()
+        # Only read the file back if the size alone doesn't tell them apart
+        if stat.st_size == len(data) and path.read_bytes() == data:
+            return False
+        # A replaced file keeps its permissions
+        mode = stat.st_mode & 0o7777
+    except FileNotFoundError:
+        pass
+    atomic_write(path, data, mode)
+    return True
+
+
+def remove_sidecar(path: Path) -> bool:
+    """Deletes a sidecar file. Returns True if there was one to delete."""
+    plan = _plan.get()
+    if plan is not None:
+        if read_sidecar(path) is None:
+            return False
+        plan.files[path] = None
+        plan.changes.append((path, "delete"))
+        return True
+
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        return False
+    sync_directory(path.parent)
+    return True
@@ -23,9 +23,18 @@ from mutagen.id3._frames import (
     TSRC,
     TSSE,
     WOAS,
+    Frame,
     TextFrame,
 )
 
+from metadata.sync import (
+    StageResult,
+    frame_bytes,
+    read_sidecar,
+    replace_frames,
+    write_sidecar,
+)
+
 # Regex to find Spotify or YouTube Music URLs
 URL_REGEX = re.compile(r"(https?://(?:open\.spotify\.com|music\.youtube\.com)/[^\s]+)")
 
@@ -101,14 +110,8 @@ def get_text_frame(tags: ID3, key: str) -> Optional[str]:
     return str(frame) if frame else None
 
 
-def parse_id3_tags(mp3_path: Path) -> Optional[Tags]:
-    """Parses ID3 tags from an MP3 into a structured Tags object."""
-    try:
-        id3 = ID3(mp3_path)
-    except Exception as e:
-        print(f"Error: Failed to read ID3 tags from {mp3_path}: {e}")
-        return None
-
+def parse_id3_tags(id3: ID3) -> Tags:
+    """Parses ID3 tags into a structured Tags object."""
     spotify_url, youtube_url = None, None
     comment: str | None = None
 
@@ -169,51 +172,46 @@ def parse_id3_tags(mp3_path: Path) -> Optional[Tags]:
     )
 
 
-def embed_tags(mp3_path: Path, tags_data: Tags):
-    """Writes tags from a Tags object into an MP3 file."""
-    try:
-        id3 = ID3(mp3_path)
-    except Exception:
-        id3 = ID3()
-
-    # Clear all existing tags managed by this module
-    keys_to_delete = [k for k in id3.keys() if k[:4] in MANAGED_INTERNALLY]
-    for key in keys_to_delete:
-        id3.delall(key)
+def embed_tags(id3: ID3, tags_data: Tags) -> bool:
+    """
+    Writes tags from a Tags object into the given ID3 tags.
+    Returns True if the ID3 tags were modified.
+    """
+    frames: List[Frame] = []
 
-    # Add tags from our structured data
+    # Build the tags from our structured data
     if tags_data.title:
-        id3.add(TIT2(encoding=3, text=tags_data.title))
+        frames.append(TIT2(encoding=3, text=tags_data.title))
     if tags_data.artist:
-        id3.add(TPE1(encoding=3, text=tags_data.artist))
+        frames.append(TPE1(encoding=3, text=tags_data.artist))
     if tags_data.album:
-        id3.add(TALB(encoding=3, text=tags_data.album))
+        frames.append(TALB(encoding=3, text=tags_data.album))
     if tags_data.album_artist:
-        id3.add(TPE2(encoding=3, text=tags_data.album_artist))
+        frames.append(TPE2(encoding=3, text=tags_data.album_artist))
     if tags_data.track:
-        id3.add(TRCK(encoding=3, text=tags_data.track))
+        frames.append(TRCK(encoding=3, text=tags_data.track))
     if tags_data.disc:
-        id3.add(TPOS(encoding=3, text=tags_data.disc))
+        frames.append(TPOS(encoding=3, text=tags_data.disc))
     if tags_data.recording_date:
-        id3.add(TDRC(encoding=3, text=tags_data.recording_date))
+        frames.append(TDRC(encoding=3, text=tags_data.recording_date))
     if tags_data.copyright:
-        id3.add(TCOP(encoding=3, text=tags_data.copyright))
+        frames.append(TCOP(encoding=3, text=tags_data.copyright))
     if tags_data.genre:
-        id3.add(TCON(encoding=3, text=tags_data.genre))
+        frames.append(TCON(encoding=3, text=tags_data.genre))
     if tags_data.isrc:
-        id3.add(TSRC(encoding=3, text=tags_data.isrc))
+        frames.append(TSRC(encoding=3, text=tags_data.isrc))
     if tags_data.encoder:
-        id3.add(TENC(encoding=3, text=tags_data.encoder))
+        frames.append(TENC(encoding=3, text=tags_data.encoder))
     if tags_data.encoder_settings:
-        id3.add(TSSE(encoding=3, text=tags_data.encoder_settings))
+        frames.append(TSSE(encoding=3, text=tags_data.encoder_settings))
     if tags_data.popularity is not None:
-        id3.add(POPM(email="None", rating=tags_data.popularity))
+        frames.append(POPM(email="None", rating=tags_data.popularity))
 
     # Set WOAS, preferring Spotify URL
     if tags_data.spotify_url:
-        id3.add(WOAS(url=tags_data.spotify_url))
+        frames.append(WOAS(url=tags_data.spotify_url))
     elif tags_data.youtube_url:
-        id3.add(WOAS(url=tags_data.youtube_url))
+        frames.append(WOAS(url=tags_data.youtube_url))
 
     # Set COMM, combining comment and URLs
     comm_text = tags_data.comment or ""
@@ -222,53 +220,55 @@ def embed_tags(mp3_path: Path, tags_data: Tags):
     if tags_data.youtube_url:
         comm_text += f"\n{tags_data.youtube_url}"
     if comm_text.strip():
-        id3.add(COMM(encoding=3, lang="eng", desc="", text=comm_text.strip()))
+        frames.append(COMM(encoding=3, lang="eng", desc="", text=comm_text.strip()))
+
+    # Replace all existing tags managed by this module
+    changed = replace_frames(id3, MANAGED_INTERNALLY, frames)
 
     # Add back all other preserved tags
-    for frame in tags_data.other_tags.values():
-        id3.add(frame)
+    for key, frame in tags_data.other_tags.items():
+        existing = id3.get(key)
+        if existing is not frame and (
+            existing is None or frame_bytes(existing) != frame_bytes(frame)
+        ):
+            id3.add(frame)
+            changed = True
 
-    try:
-        id3.save(mp3_path)
-    except Exception as e:
-        raise RuntimeError(f"Failed to save ID3 tags to {mp3_path}: {e}") from e
+    return changed
 
 
-def process_tags(mp3_path: Path):
+def process_tags(mp3_path: Path, id3: ID3) -> StageResult:
     """
     Orchestrates tag processing for an MP3 file. It prioritizes a .json
     sidecar file for reading, then writes the final tags back to both the
-    .json file and the MP3's ID3 tags for synchronization.
+    .json file and the given ID3 tags for synchronization. Either is only
+    touched if its content actually differs.
     """
     json_path = mp3_path.with_suffix(".json")
-    tags_data: Optional[Tags] = None
+    tags_data: Tags
 
-    if json_path.exists():
+    json_data = read_sidecar(json_path)
+    if json_data is not None:
         # Priority 1: .json file if it exists
         try:
-            with open(json_path, "r", encoding="utf-8") as f:
-                json_content = f.read()
-            tags_data = json_to_tags(json_content)
+            tags_data = json_to_tags(json_data.decode("utf-8"))
             # Make sure to load 'other_tags' from the mp3, as they aren't in the json
-            id3_tags = parse_id3_tags(mp3_path)
-            if tags_data and id3_tags:
-                tags_data.other_tags = id3_tags.other_tags
+            tags_data.other_tags = parse_id3_tags(id3).other_tags
         except (json.JSONDecodeError, TypeError) as e:
             raise ValueError(f"Invalid JSON data in {json_path}: {e}") from e
     else:
-        # Priority 2: Parse directly from MP3 ID3 tags
-        tags_data = parse_id3_tags(mp3_path)
+        # Priority 2: Parse directly from the ID3 tags
+        tags_data = parse_id3_tags(id3)
 
     # In the future, cleaning/modification logic could go here.
-    if tags_data:
-        # Write to MP3 ID3 tags
-        embed_tags(mp3_path, tags_data)
 
-        # Write to .json file
-        try:
-            with open(json_path, "w", encoding="utf-8") as f:
-                f.write(tags_to_json(tags_data))
-        except Exception as e:
-            raise RuntimeError(f"Failed to write tags to {json_path}: {e}") from e
-    else:
-        print(f"Could not parse any tags for {mp3_path.name}, skipping")
+    # Write to ID3 tags
+    tags_changed = embed_tags(id3, tags_data)
+
+    # Write to .json file
+    try:
+        json_changed = write_sidecar(json_path, tags_to_json(tags_data).encode("utf-8"))
+    except Exception as e:
+        raise RuntimeError(f"Failed to write tags to {json_path}: {e}") from e
+
+    return StageResult(tags_changed=tags_changed, sidecar_changed=json_changed)
@@ -0,0 +1,213 @@
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Optional
+from collections.abc import Callable, Iterator, Sequence
+
+# Stages range from milliseconds (tags) to minutes (downloads)
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+LabelValues = tuple[str, ...]
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)
+    )
+    return f"{{{pairs}}}"
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(ABC):
+    """A metric in the Prometheus text format, optionally with labels."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def label_values(self, labels: dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.label_names):
+            raise ValueError(
+                f"{self.name} takes the labels {self.label_names}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    @abstractmethod
+    def samples(self) -> list[str]: ...
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        # Without labels there is a single series, which starts at zero
+        self.values: dict[LabelValues, float] = {} if labels else {(): 0}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            return [
+                f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}"
+                for key, value in self.values.items()
+            ]
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Instead of being set, it can read its
+    value from `function` whenever the metrics are scraped.
+    """
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        function: Optional[Callable[[], float]] = None,
+    ):
+        super().__init__(name, help, labels)
+        self.function = function
+        self.values: dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self) -> list[str]:
+        if self.function is not None:
+            try:
+                return [f"{self.name} {format_value(self.function())}"]
+            except Exception as e:
+                print(f"Error reading metric {self.name}: {e}")
+                return []
+        with self.lock:
+            return [
+                f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}"
+                for key, value in self.values.items()
+            ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: the count in each bucket (not cumulative), the sum
+        # and the total count
+        self.values: dict[LabelValues, tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self.label_values(labels)
+        with self.lock:
+            counts, total, count = self.values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observes how long the block took, even when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[str]:
+        lines: list[str] = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = format_labels(
+                        self.label_names + ("le",), key + (format_value(bound),)
+                    )
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = format_labels(self.label_names + ("le",), key + ("+Inf",))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = format_labels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+METRICS: list[Metric] = []
+
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in METRICS) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "intersonic_stage_duration_seconds",
+    "Time spent in each stage of downloading and processing a song.",
+    labels=("stage",),
+)
+SONGS = Counter(
+    "intersonic_songs_total",
+    "Songs handled by download jobs, by result (downloaded, skipped or failed).",
+    labels=("result",),
+)
+BYTES_WRITTEN = Counter(
+    "intersonic_bytes_written_total",
+    "Bytes of audio written by downloads.",
+)
+LYRICS_LOOKUPS = Counter(
+    "intersonic_lyrics_lookups_total",
+    "Lyrics lookups by downloads, by result (cached, found or not_found).",
+    labels=("result",),
+)
+EXIT_NODE_IP_CHECK_SECONDS = Histogram(
+    "intersonic_exit_node_ip_check_seconds",
+    "Time taken to reach the public IP check through the exit node.",
+    labels=("result",),
+)
+
+
+def observe_stage_timings(timings: dict[str, float]):
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
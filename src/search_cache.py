@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Optional
+from collections.abc import Callable, Iterator
+
+from spotdl.types.song import Song, SongError
+
+from tracing import in_current_context
+from utils import DATA_DIR, connect_db
+
+SEARCH_CACHE_PATH = DATA_DIR / "search_cache.sqlite3"
+
+# How long resolved queries are trusted, in seconds
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL") or 30 * 24 * 60 * 60)
+# Queries that found nothing are retried sooner
+SEARCH_CACHE_NEGATIVE_TTL = int(
+    os.environ.get("SEARCH_CACHE_NEGATIVE_TTL") or 24 * 60 * 60
+)
+# Playlists, albums and artists gain tracks, so they are only cached briefly
+SEARCH_CACHE_LIST_TTL = int(os.environ.get("SEARCH_CACHE_LIST_TTL") or 60 * 60)
+
+LIST_URL_REGEX = re.compile(
+    r"open\.spotify\.com/(?:intl-\w+/)?(?:playlist|album|artist)/|[?&]list="
+)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Turns equivalent queries into the same cache key: tracking parameters
+    are dropped from URLs, and text searches ignore case and spacing.
+    """
+    query = query.strip()
+    if query.startswith(("http://", "https://")):
+        if "music.youtube.com" in query or "youtube.com/watch" in query:
+            # The video and list IDs live in the query string, drop the rest
+            query = re.sub(r"[?&](?:si|feature|pp)=[^&]*", "", query)
+            return query.rstrip("/")
+        return query.split("?", 1)[0].split("#", 1)[0].rstrip("/")
+    return " ".join(query.split()).casefold()
+
+
+def query_ttl(query: str, songs: list[dict[str, Any]]) -> int:
+    if not songs:
+        return SEARCH_CACHE_NEGATIVE_TTL
+    if LIST_URL_REGEX.search(query):
+        return SEARCH_CACHE_LIST_TTL
+    return SEARCH_CACHE_TTL
+
+
+class SearchCache:
+    """
+    A persistent cache from normalized search query to the songs it resolved
+    to, including queries that resolved to nothing.
+    """
+
+    def __init__(self, path: Path = SEARCH_CACHE_PATH):
+        self.lock = threading.Lock()
+        self.conn = connect_db(path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS searches (
+                    query TEXT PRIMARY KEY,
+                    songs TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+                """
+            )
+            self.conn.execute(
+                "DELETE FROM searches WHERE expires_at < ?", (time.time(),)
+            )
+
+    def get(self, query: str) -> Optional[list[Song]]:
+        """Returns the cached songs for a query, or None on a cache miss."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT songs FROM searches WHERE query = ? AND expires_at >= ?",
+                (normalize_query(query), time.time()),
+            ).fetchone()
+        if row is None:
+            return None
+        return [Song.from_dict(data) for data in json.loads(row[0])]
+
+    def put(self, query: str, songs: list[Song]):
+        key = normalize_query(query)
+        data = [song.json for song in songs]
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO searches (query, songs, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(data), time.time() + query_ttl(key, data)),
+            )
+
+
+class ThreadErrorCounter(logging.Handler):
+    """Counts the errors logged by the thread that created it."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.thread = threading.get_ident()
+        self.count = 0
+
+    def emit(self, record: logging.LogRecord):
+        if record.thread == self.thread:
+            self.count += 1
+
+
+@contextmanager
+def counting_spotdl_errors() -> Iterator[ThreadErrorCounter]:
+    """
+    Counts the errors spotdl logs in this thread. Its search logs the songs
+    it failed to resolve, rate limits included, and leaves them out of the
+    results instead of raising.
+    """
+    logger = logging.getLogger("spotdl")
+    counter = ThreadErrorCounter()
+    logger.addHandler(counter)
+    try:
+        yield counter
+    finally:
+        logger.removeHandler(counter)
+
+
+def cached_search(
+    search: Callable[[list[str]], list[Song]],
+    queries: list[str],
+    cache: SearchCache,
+    threads: int = 1,
+    status_callback: Optional[Callable[[str], None]] = None,
+) -> list[Song]:
+    """
+    Resolves the queries with `search`, but only those missing from the
+    cache. Misses are searched one query at a time (`threads` in parallel)
+    so each result can be cached under its own query. Queries that fail
+    for another reason than having no results are skipped and not cached,
+    and results that may be incomplete are used but not cached.
+    """
+    cached: dict[str, list[Song]] = {}
+    misses: list[str] = []
+    for query in queries:
+        songs = cache.get(query)
+        if songs is None:
+            misses.append(query)
+        else:
+            cached[query] = songs
+
+    cache_log_str = f"Found {len(cached)} cached {'search' if len(cached) == 1 else 'searches'}, searching for {len(misses)} more..."
+    print(cache_log_str)
+    if status_callback and cached:
+        status_callback(cache_log_str)
+
+    def search_one(query: str) -> Optional[list[Song]]:
+        try:
+            with counting_spotdl_errors() as errors:
+                songs = search([query])
+        except SongError as e:
+            print(f"No results for '{query}': {e}")
+            cache.put(query, [])
+            return []
+        except Exception as e:
+            print(f"Error searching for '{query}': {e}")
+            return None
+        if errors.count:
+            print(f"Not caching the results for '{query}', the search logged {errors.count} errors")
+        elif not songs:
+            # Only a search that said so is known to have no results
+            print(f"Not caching the empty results for '{query}'")
+        else:
+            cache.put(query, songs)
+        return songs
+
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        for query, songs in zip(misses, executor.map(in_current_context(search_one), misses)):
+            if songs is not None:
+                cached[query] = songs
+
+    return [song for query in queries for song in cached.get(query, [])]
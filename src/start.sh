@@ -13,7 +13,8 @@ export NO_PROXY=localhost,127.0.0.1,::1,.local,.test,.example,.invalid
 
 export PYTHONUNBUFFERED=1
 # Use Gunicorn to run the Flask app from the 'web.server' module.
-# --workers 1: Important for threading.Lock to work
+# --workers 1: Important, the job queue workers and locks live in this one process
+# --threads 16: Every open /events stream keeps a thread busy
 # --bind 0.0.0.0:3000: Listen on port 3000 on all available network interfaces
 # web.server:app: Tells Gunicorn to look for an object named 'app' in the 'src/web/server.py' file.
-exec gunicorn --workers 1 --threads 4 --bind 0.0.0.0:3000 --log-level "info" web.server:app
+exec gunicorn --workers 1 --threads 16 --bind 0.0.0.0:3000 --log-level "info" web.server:app
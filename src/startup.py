@@ -0,0 +1,40 @@
+import threading
+from collections.abc import Iterable
+from typing import Any
+
+from events import EVENTS
+
+
+class Readiness:
+    """
+    Tracks the subsystems that are set up in the background after the
+    server starts. Each one is "starting", "ready" or "failed".
+    """
+
+    def __init__(self, names: Iterable[str]):
+        self.lock = threading.Lock()
+        self.states: dict[str, dict[str, Any]] = {
+            name: {"status": "starting", "message": "Starting..."} for name in names
+        }
+
+    def set(self, name: str, status: str, message: str):
+        with self.lock:
+            self.states[name] = {"status": status, "message": message}
+        print(f"{name}: {message}")
+        EVENTS.publish("startup", message, subsystem=name, status=status)
+
+    def is_ready(self, name: str) -> bool:
+        with self.lock:
+            return self.states[name]["status"] == "ready"
+
+    def all_ready(self) -> bool:
+        with self.lock:
+            return all(state["status"] == "ready" for state in self.states.values())
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        with self.lock:
+            return {name: dict(state) for name, state in self.states.items()}
+
+
+# Downloads need both Tailscale (for the exit node) and the spotdl client
+READINESS = Readiness(("tailscale", "downloader"))
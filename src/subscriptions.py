@@ -0,0 +1,310 @@
+import json
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Optional
+from collections.abc import Callable
+
+import spotipy
+from spotdl.utils.spotify import SpotifyClient
+
+from utils import DATA_DIR, connect_db
+
+SUBSCRIPTIONS_PATH = DATA_DIR / "subscriptions.sqlite3"
+
+# Seconds between syncs of each subscription
+SUBSCRIPTION_SYNC_INTERVAL = int(
+    os.environ.get("SUBSCRIPTION_SYNC_INTERVAL") or 6 * 60 * 60
+)
+# Seconds between checks for subscriptions that are due to be synced
+SUBSCRIPTION_CHECK_INTERVAL = 60
+
+SPOTIFY_LIST_REGEX = re.compile(
+    r"open\.spotify\.com/(?:intl-\w+/)?(playlist|album)/(\w+)"
+)
+
+
+def parse_list_url(url: str) -> Optional[tuple[str, str]]:
+    """The kind ("playlist" or "album") and ID of a Spotify list URL."""
+    match = SPOTIFY_LIST_REGEX.search(url)
+    return (match.group(1), match.group(2)) if match else None
+
+
+def spotify_get(url: str, **params: Any) -> dict[str, Any]:
+    """
+    A Spotify API request that skips spotdl's cache, which keeps every
+    response for the life of the process and would hide any change.
+    """
+    return spotipy.Spotify._get(SpotifyClient(), url, **params)
+
+
+def list_tracks(page: dict[str, Any]) -> list[str]:
+    """The URLs of the tracks in every page, starting with `page`."""
+    urls: list[str] = []
+    while True:
+        for item in page["items"]:
+            # Playlist items wrap the track, album items are the track
+            track = item["track"] if "track" in item else item
+            if (
+                track
+                and track.get("type") == "track"
+                and not track.get("is_local")
+                and track.get("external_urls", {}).get("spotify")
+            ):
+                urls.append(track["external_urls"]["spotify"])
+        if not page.get("next"):
+            return urls
+        page = spotify_get(page["next"])
+
+
+@dataclass
+class Subscription:
+    url: str
+    kind: str  # "playlist" or "album"
+    name: Optional[str]
+    snapshot_id: Optional[str]
+    track_count: int
+    added_at: float
+    synced_at: Optional[float]
+    error: Optional[str]
+
+
+@dataclass
+class ListState:
+    """What a sync found: the current name, snapshot and tracks of a list."""
+
+    name: str
+    snapshot_id: Optional[str]
+    tracks: list[str]
+
+
+class Subscriptions:
+    """
+    Playlists and albums that are kept in sync with the library. Each one
+    remembers its last seen snapshot and tracks, so a sync only has to look
+    at lists that changed, and only downloads the tracks that are new.
+    """
+
+    def __init__(self, path: Path = SUBSCRIPTIONS_PATH):
+        self.lock = threading.Lock()
+        self.conn = connect_db(path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS subscriptions (
+                    url TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    name TEXT,
+                    snapshot_id TEXT,
+                    tracks TEXT NOT NULL,
+                    added_at REAL NOT NULL,
+                    synced_at REAL,
+                    error TEXT
+                )
+                """
+            )
+
+    def add(self, url: str) -> bool:
+        """Subscribes to a playlist or album URL. Returns False if it already was."""
+        parsed = parse_list_url(url)
+        if parsed is None:
+            raise ValueError(f"Not a Spotify playlist or album URL: {url}")
+        kind, id = parsed
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO subscriptions (url, kind, tracks, added_at) VALUES (?, ?, '[]', ?)",
+                (f"https://open.spotify.com/{kind}/{id}", kind, time.time()),
+            )
+        return cursor.rowcount > 0
+
+    def remove(self, url: str) -> bool:
+        parsed = parse_list_url(url)
+        if parsed is None:
+            return False
+        kind, id = parsed
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "DELETE FROM subscriptions WHERE url = ?",
+                (f"https://open.spotify.com/{kind}/{id}",),
+            )
+        return cursor.rowcount > 0
+
+    def entries(self) -> list[Subscription]:
+        with self.lock:
+            rows = self.conn.execute(
+                """
+                SELECT url, kind, name, snapshot_id, json_array_length(tracks), added_at, synced_at, error
+                FROM subscriptions ORDER BY added_at
+                """
+            ).fetchall()
+        return [Subscription(*row) for row in rows]
+
+    def count(self) -> int:
+        with self.lock:
+            (count,) = self.conn.execute(
+                "SELECT COUNT(*) FROM subscriptions"
+            ).fetchone()
+        return count
+
+    def due(self, interval: float = SUBSCRIPTION_SYNC_INTERVAL) -> list[str]:
+        """The subscriptions that haven't been synced in `interval` seconds."""
+        with self.lock:
+            return [
+                url
+                for (url,) in self.conn.execute(
+                    "SELECT url FROM subscriptions WHERE synced_at IS NULL OR synced_at <= ? ORDER BY added_at",
+                    (time.time() - interval,),
+                )
+            ]
+
+    def state(self, url: str) -> Optional[tuple[str, Optional[str], list[str]]]:
+        """The kind, last seen snapshot and tracks of a subscription."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT kind, snapshot_id, tracks FROM subscriptions WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if row is None:
+            return None
+        kind, snapshot_id, tracks = row
+        return kind, snapshot_id, json.loads(tracks)
+
+    def update(self, url: str, state: Optional[ListState], error: Optional[str] = None):
+        """Records a sync, with the new state of the list if it changed."""
+        with self.lock, self.conn:
+            if state is not None:
+                self.conn.execute(
+                    "UPDATE subscriptions SET name = ?, snapshot_id = ?, tracks = ? WHERE url = ?",
+                    (state.name, state.snapshot_id, json.dumps(state.tracks), url),
+                )
+            self.conn.execute(
+                "UPDATE subscriptions SET synced_at = ?, error = ? WHERE url = ?",
+                (time.time(), error, url),
+            )
+
+
+def fetch_list(
+    kind: str, url: str, snapshot_id: Optional[str]
+) -> Optional[ListState]:
+    """
+    Fetches the current tracks of a list, or returns None if the playlist's
+    snapshot shows it hasn't changed. Albums have no snapshot, but they are
+    small enough to be fetched in a single request.
+    """
+    # Subscriptions are stored as https://open.spotify.com/<kind>/<id>
+    id = url.rsplit("/", 1)[-1]
+    if kind == "playlist":
+        playlist = spotify_get(f"playlists/{id}", fields="name,snapshot_id")
+        if playlist["snapshot_id"] == snapshot_id:
+            return None
+        tracks = list_tracks(
+            spotify_get(
+                f"playlists/{id}/tracks",
+                limit=100,
+                fields="items(track(type,is_local,external_urls)),next",
+            )
+        )
+        return ListState(playlist["name"], playlist["snapshot_id"], tracks)
+
+    album = spotify_get(f"albums/{id}")
+    return ListState(album["name"], None, list_tracks(album["tracks"]))
+
+
+def sync_subscriptions(
+    subscriptions: Subscriptions,
+    urls: list[str],
+    enqueue: Callable[[list[str]], Any],
+    status_callback: Optional[Callable[[str], None]] = None,
+) -> list[str]:
+    """
+    Checks the given subscriptions for changes and hands the tracks that
+    were added since the last sync to `enqueue`, which should start a job
+    that downloads them. Returns the new track URLs.
+    """
+    start_log_str = f"Syncing {len(urls)} {'subscription' if len(urls) == 1 else 'subscriptions'}..."
+    print(start_log_str)
+    if status_callback:
+        status_callback(start_log_str)
+
+    new_tracks: list[str] = []
+    seen: set[str] = set()
+    changed: dict[str, ListState] = {}
+    unchanged = 0
+    failed = 0
+    for index, url in enumerate(urls):
+        current = subscriptions.state(url)
+        if current is None:
+            continue
+        kind, snapshot_id, known_tracks = current
+        try:
+            state = fetch_list(kind, url, snapshot_id)
+        except Exception as e:
+            print(f"Error syncing {url}: {e}")
+            subscriptions.update(url, None, f"{type(e).__name__}: {e}")
+            failed += 1
+            continue
+        if state is None or (
+            state.tracks == known_tracks and state.snapshot_id == snapshot_id
+        ):
+            subscriptions.update(url, None)
+            unchanged += 1
+            continue
+
+        known = set(known_tracks)
+        added = [track for track in state.tracks if track not in known]
+        new_tracks.extend(track for track in added if track not in seen)
+        seen.update(added)
+        changed[url] = state
+        list_log_str = f"Synced {index + 1}/{len(urls)} - '{state.name}' ({len(added)} new {'track' if len(added) == 1 else 'tracks'})"
+        print(list_log_str)
+        if status_callback:
+            status_callback(list_log_str)
+
+    # The new snapshots are only saved once their tracks are safely queued,
+    # so a failure here means they are picked up again by the next sync
+    if new_tracks:
+        enqueue(new_tracks)
+    for url, state in changed.items():
+        subscriptions.update(url, state)
+
+    done_log_str = f"Synced {len(urls) - failed} out of {len(urls)} subscriptions ({unchanged} unchanged), found {len(new_tracks)} new {'track' if len(new_tracks) == 1 else 'tracks'}. Failed to sync {failed} subscriptions."
+    print(done_log_str)
+    if status_callback:
+        status_callback(done_log_str)
+    return new_tracks
+
+
+class SyncScheduler:
+    """
+    Periodically hands the subscriptions that are due to be synced to
+    `enqueue`, which should start a job that syncs them.
+    """
+
+    def __init__(
+        self,
+        subscriptions: Subscriptions,
+        enqueue: Callable[[list[str]], Any],
+        interval: float = SUBSCRIPTION_CHECK_INTERVAL,
+    ):
+        self.subscriptions = subscriptions
+        self.enqueue = enqueue
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, name="sync-scheduler", daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                urls = self.subscriptions.due()
+                if urls:
+                    self.enqueue(urls)
+            except Exception as e:
+                print(f"Error scheduling subscription syncs: {e}")
@@ -1,20 +1,47 @@
 import subprocess
 import json
 import os
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from typing import Any, Optional
+from collections.abc import Callable
 
-from tailscale_types import TailscaleStatus
+from tailscale_types import PeerNode, TailscaleStatus
+from metrics import EXIT_NODE_IP_CHECK_SECONDS, Gauge
+from tracing import in_current_context, span, trace
 from utils import extend_env, get_public_ipv4
 
+# Seconds between exit node health checks
+EXIT_NODE_CHECK_INTERVAL = int(os.environ.get("EXIT_NODE_CHECK_INTERVAL") or 60)
+# A working exit node is only replaced by one that is this many times faster
+# and at least EXIT_NODE_SWITCH_MARGIN milliseconds faster, so that similar
+# nodes don't make us flap between them
+EXIT_NODE_SWITCH_RATIO = 2.0
+EXIT_NODE_SWITCH_MARGIN = 50
+# Seconds the public IP check may take before the exit node counts as down
+EXIT_NODE_IP_TIMEOUT = 15
+
+PING_REGEX = re.compile(r" in ([\d.]+)ms")
+
+EXIT_NODE_PING_SECONDS = Gauge(
+    "intersonic_exit_node_ping_seconds",
+    "Latest round trip time to each candidate exit node, -1 if unreachable.",
+    labels=("node",),
+)
+
 
 def run_tailscale(*args):
-    result = subprocess.run(
-        ["tailscale"] + list(args),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        env=extend_env(no_proxy=True),
-        text=True,
-    )
+    with span("tailscale", command=" ".join(args[:1])):
+        result = subprocess.run(
+            ["tailscale"] + list(args),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=extend_env(no_proxy=True),
+            text=True,
+        )
     return result.returncode, result.stdout, result.stderr
 
 
@@ -69,34 +96,229 @@ def tailscale_exit_nodes():
     return exit_nodes
 
 
+def tailscale_ping(node: PeerNode) -> Optional[float]:
+    """Returns the round trip time to a node in milliseconds, or None if it's unreachable."""
+    status, stdout, stderr = run_tailscale(
+        "ping",
+        "--c",
+        "1",
+        "--timeout",
+        "5s",
+        # Don't fail just because the pong came through a relay
+        "--until-direct=false",
+        node["TailscaleIPs"][0],
+    )
+    match = PING_REGEX.search(stdout)
+    if status != 0 or not match:
+        return None
+    return float(match.group(1))
+
+
+def node_name(node: PeerNode) -> str:
+    return node["DNSName"].rstrip(".")
+
+
+def exit_node_patterns() -> list[str]:
+    """
+    TS_EXIT_NODE is a comma-separated list of exit node names or glob
+    patterns, e.g. "apple-tv,nas-*". A plain name matches the start of the
+    node's DNS name.
+    """
+    value = os.environ.get("TS_EXIT_NODE")
+    if not value:
+        raise ValueError("TS_EXIT_NODE environment variable is not set")
+    return [pattern.strip() for pattern in value.split(",") if pattern.strip()]
+
+
+def matches_pattern(node: PeerNode, pattern: str) -> bool:
+    if any(char in pattern for char in "*?["):
+        return fnmatch(node_name(node), pattern) or fnmatch(node["HostName"], pattern)
+    return node["DNSName"].startswith(pattern)
+
+
 def tailscale_setup():
+    """Logs in to Tailscale. The exit node is chosen by ExitNodeMonitor."""
     authkey = os.environ.get("TS_AUTHKEY")
     if not authkey:
         raise ValueError("TS_AUTHKEY environment variable is not set")
-    exit_node_name = os.environ.get("TS_EXIT_NODE")
-    if not exit_node_name:
-        raise ValueError("TS_EXIT_NODE environment variable is not set")
 
     tailscale_up(authkey=authkey)
     print(f"Public IPv4: {get_public_ipv4()}")
 
-    exit_nodes = tailscale_exit_nodes()
-    # print("Exit Nodes:")
-    # for node in exit_nodes:
-    #     print(f"- {node['DNSName'][:-1]} ({node['Relay']})")
 
-    matching_nodes = [
-        node for node in exit_nodes if node["DNSName"].startswith(exit_node_name)
-    ]
-    if len(matching_nodes) != 1:
-        raise RuntimeError(
-            f"Expected exactly one exit node matching '{exit_node_name}', found {len(matching_nodes)}"
+class ExitNodeMonitor:
+    """
+    Keeps traffic going out through the best exit node matching
+    TS_EXIT_NODE. Every check pings each online candidate and makes sure
+    the public IP can still be reached through the current one. When it
+    can't, or another candidate is much faster, it switches exit nodes
+    without restarting the app.
+    """
+
+    def __init__(
+        self,
+        interval: float = EXIT_NODE_CHECK_INTERVAL,
+        status_callback: Optional[Callable[[str], None]] = None,
+    ):
+        self.interval = interval
+        self.status_callback = status_callback
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+        self.current: Optional[str] = None
+        self.healthy = False
+        self.message = "Not checked yet."
+        self.public_ip: Optional[str] = None
+        self.ip_check_seconds: Optional[float] = None
+        self.latencies: dict[str, Optional[float]] = {}
+        self.checked_at: Optional[float] = None
+        self.reported: Optional[tuple[bool, Optional[str]]] = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="exit-node-monitor", daemon=True
         )
-    exit_node = matching_nodes[0]
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.check()
+
+    def status(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                "current": self.current,
+                "healthy": self.healthy,
+                "message": self.message,
+                "public_ip": self.public_ip,
+                "ip_check_seconds": self.ip_check_seconds,
+                "latencies": dict(self.latencies),
+                "checked_at": self.checked_at,
+            }
 
-    print(f"Setting exit node to: {exit_node['DNSName'][:-1]} ({exit_node['Relay']})")
-    tailscale_up(exit_node=exit_node["DNSName"])
-    time.sleep(1)
-    print(f"Tailscale is running with exit node: {exit_node['DNSName'][:-1]}")
+    def report(self, healthy: bool, message: str):
+        with self.lock:
+            # Latency changes alone aren't worth telling anyone about
+            key = (healthy, self.current if healthy else message)
+            changed = key != self.reported
+            self.reported = key
+            self.healthy = healthy
+            self.message = message
+            self.checked_at = time.time()
+        if changed:
+            print(f"Exit node: {message}")
+            if self.status_callback:
+                self.status_callback(message)
 
-    print(f"Public IPv4 (exit node enabled): {get_public_ipv4()}")
+    def probe_candidates(self) -> list[tuple[PeerNode, Optional[float]]]:
+        patterns = exit_node_patterns()
+        nodes = [
+            node
+            for node in tailscale_exit_nodes()
+            if any(matches_pattern(node, pattern) for pattern in patterns)
+        ]
+        with ThreadPoolExecutor(max_workers=max(len(nodes), 1)) as executor:
+            latencies = list(executor.map(in_current_context(tailscale_ping), nodes))
+        with self.lock:
+            self.latencies = {
+                node_name(node): latency for node, latency in zip(nodes, latencies)
+            }
+        for node, latency in zip(nodes, latencies):
+            EXIT_NODE_PING_SECONDS.set(
+                -1 if latency is None else latency / 1000, node=node_name(node)
+            )
+        return list(zip(nodes, latencies))
+
+    def check_public_ip(self) -> bool:
+        """Checks that traffic gets out through the current exit node."""
+        start = time.monotonic()
+        try:
+            with span("public_ip_check", node=self.current):
+                public_ip = get_public_ipv4(timeout=EXIT_NODE_IP_TIMEOUT)
+        except RuntimeError as e:
+            print(f"Exit node check failed: {e}")
+            EXIT_NODE_IP_CHECK_SECONDS.observe(time.monotonic() - start, result="failed")
+            return False
+        seconds = time.monotonic() - start
+        EXIT_NODE_IP_CHECK_SECONDS.observe(seconds, result="ok")
+        with self.lock:
+            self.public_ip = public_ip
+            self.ip_check_seconds = seconds
+        return True
+
+    def switch(self, node: PeerNode):
+        print(f"Setting exit node to: {node_name(node)} ({node['Relay']})")
+        tailscale_up(exit_node=node["DNSName"])
+        time.sleep(1)
+        with self.lock:
+            self.current = node_name(node)
+
+    def check(self):
+        try:
+            # The latest check is kept as the "exit-node-check" trace
+            with trace("exit-node-check"):
+                self.check_once()
+        except Exception as e:
+            self.report(False, f"Exit node check failed: {e}")
+
+    def check_once(self):
+        candidates = [
+            (node, latency)
+            for node, latency in self.probe_candidates()
+            if latency is not None
+        ]
+        if not candidates:
+            self.report(
+                False,
+                f"No reachable exit node matching '{os.environ.get('TS_EXIT_NODE')}', "
+                f"checking again in {self.interval:g} seconds.",
+            )
+            return
+
+        best_node, best_latency = min(candidates, key=lambda candidate: candidate[1])
+        current_latency = next(
+            (
+                latency
+                for node, latency in candidates
+                if node_name(node) == self.current
+            ),
+            None,
+        )
+
+        if current_latency is not None and self.check_public_ip():
+            if not (
+                current_latency > best_latency * EXIT_NODE_SWITCH_RATIO
+                and current_latency - best_latency > EXIT_NODE_SWITCH_MARGIN
+            ):
+                self.report(True, f"Using {self.current} ({current_latency:.0f} ms).")
+                return
+            reason = f"{node_name(best_node)} is faster than {self.current} ({current_latency:.0f} ms)"
+        elif self.current is None:
+            reason = "Picked the fastest exit node"
+        elif node_name(best_node) == self.current:
+            reason = f"{self.current} stopped passing traffic, reconnected"
+        else:
+            reason = f"{self.current} is down"
+
+        # A node can answer pings without passing traffic, so go down the
+        # candidates from the fastest until one reaches the internet
+        offline: list[str] = []
+        for node, latency in sorted(candidates, key=lambda candidate: candidate[1]):
+            self.switch(node)
+            if self.check_public_ip():
+                if offline:
+                    reason += f", {', '.join(offline)} can't reach the internet"
+                self.report(True, f"{reason}, using {self.current} ({latency:.0f} ms).")
+                return
+            offline.append(node_name(node))
+        self.report(
+            False,
+            f"{reason}, but none of the exit nodes can reach the internet, "
+            f"checking again in {self.interval:g} seconds.",
+        )
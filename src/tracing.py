@@ -0,0 +1,229 @@
+import cProfile
+import contextvars
+import io
+import os
+import pstats
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Optional
+from collections.abc import Callable, Iterator
+
+from utils import DATA_DIR
+
+# Set TRACING=1 to record timed spans for every job
+TRACING = os.environ.get("TRACING", "").lower() in ("1", "true", "yes")
+# Fraction of traced jobs that also run under cProfile, e.g. 0.1
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE") or 0)
+PROFILES_PATH = DATA_DIR / "profiles"
+
+# Number of finished traces kept for the web UI
+TRACE_BUFFER_SIZE = 50
+# Spans kept per trace, so that a scan of a huge library can't eat the memory
+MAX_SPANS = 100_000
+# Number of entries in each "slowest" list of a summary
+SUMMARY_SIZE = 10
+
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    duration: float
+    attributes: dict[str, Any]
+
+
+@dataclass
+class Trace:
+    name: str
+    attributes: dict[str, Any]
+    started_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    spans: list[Span] = field(default_factory=list)
+    dropped_spans: int = 0
+    profile_path: Optional[str] = None
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, name: str, start: float, duration: float, **attributes: Any):
+        with self.lock:
+            if len(self.spans) >= MAX_SPANS:
+                self.dropped_spans += 1
+                return
+            self.spans.append(Span(name, start, duration, attributes))
+
+    def summary(self) -> dict[str, Any]:
+        """The time spent per stage, and the slowest tracks and spans."""
+        with self.lock:
+            spans = list(self.spans)
+
+        stages: dict[str, list[float]] = {}
+        tracks: dict[str, dict[str, float]] = {}
+        for span in spans:
+            stages.setdefault(span.name, []).append(span.duration)
+            track = span.attributes.get("track")
+            if track is not None:
+                track_stages = tracks.setdefault(str(track), {})
+                track_stages[span.name] = track_stages.get(span.name, 0) + span.duration
+
+        end = self.finished_at or time.time()
+        return {
+            "name": self.name,
+            "attributes": self.attributes,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "duration": end - self.started_at,
+            "profile": self.profile_path,
+            "span_count": len(spans),
+            "dropped_spans": self.dropped_spans,
+            "stages": sorted(
+                (
+                    {
+                        "name": name,
+                        "count": len(durations),
+                        "total": sum(durations),
+                        "mean": sum(durations) / len(durations),
+                        "max": max(durations),
+                    }
+                    for name, durations in stages.items()
+                ),
+                key=lambda stage: stage["total"],
+                reverse=True,
+            ),
+            "slowest_tracks": sorted(
+                (
+                    {"track": track, "total": sum(times.values()), "stages": times}
+                    for track, times in tracks.items()
+                ),
+                key=lambda track: track["total"],
+                reverse=True,
+            )[:SUMMARY_SIZE],
+            "slowest_spans": [
+                {"name": span.name, "duration": span.duration, **span.attributes}
+                for span in sorted(spans, key=lambda span: span.duration, reverse=True)[
+                    :SUMMARY_SIZE
+                ]
+            ],
+        }
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar(
+    "current_trace", default=None
+)
+_traces: "OrderedDict[str, Trace]" = OrderedDict()
+_traces_lock = threading.Lock()
+# Held by the trace being profiled. Python allows a single profiler at a time
+_profile_lock = threading.Lock()
+
+
+def get_trace(name: str) -> Optional[Trace]:
+    with _traces_lock:
+        return _traces.get(name)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def trace(
+    name: str, profile: bool = False, **attributes: Any
+) -> Iterator[Optional[Trace]]:
+    """
+    Collects the spans recorded in this context under a trace named `name`.
+    With `profile`, a sampled share of the traces also run under cProfile,
+    unless another trace is being profiled already. Does nothing unless
+    TRACING is enabled.
+    """
+    if not TRACING:
+        yield None
+        return
+
+    current = Trace(name, attributes)
+    with _traces_lock:
+        _traces[name] = current
+        _traces.move_to_end(name)
+        while len(_traces) > TRACE_BUFFER_SIZE:
+            _traces.popitem(last=False)
+
+    # Before Python 3.12 cProfile only sees the thread it was enabled in,
+    # which is where the job orchestrates its work. From 3.12 on it uses
+    # sys.monitoring and sees every thread, other jobs' included
+    profiler = None
+    sampled = profile and random.random() < PROFILE_SAMPLE_RATE
+    if sampled and _profile_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Some other profiler is running, outside of the traces
+            print(f"Not profiling {name}: {e}")
+            profiler = None
+            _profile_lock.release()
+    elif sampled:
+        print(f"Not profiling {name}, another trace is being profiled")
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        if profiler:
+            profiler.disable()
+            _profile_lock.release()
+            current.profile_path = str(dump_profile(name, profiler))
+        _current_trace.reset(token)
+        current.finished_at = time.time()
+
+
+def dump_profile(name: str, profiler: cProfile.Profile) -> Path:
+    """Saves the raw profile, plus the top functions by cumulative time as text."""
+    PROFILES_PATH.mkdir(parents=True, exist_ok=True)
+    path = PROFILES_PATH / f"{name}.prof"
+    profiler.dump_stats(path)
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(50)
+    path.with_suffix(".txt").write_text(text.getvalue())
+    print(f"Saved the profile of {name} to {path}")
+    return path
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[None]:
+    """Times the block as a span of the current trace, if there is one."""
+    current = _current_trace.get()
+    if current is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current.add(name, start, time.perf_counter() - start, **attributes)
+
+
+def record_timings(timings: dict[str, float], **attributes: Any):
+    """
+    Adds spans measured elsewhere, like the stage timings that come back
+    from the metadata worker processes, to the current trace.
+    """
+    current = _current_trace.get()
+    if current is None:
+        return
+    now = time.perf_counter()
+    for name, seconds in timings.items():
+        current.add(name, now - seconds, seconds, **attributes)
+
+
+def in_current_context(function: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Wraps a function so that it runs in a copy of the current context,
+    trace included. Executor threads don't inherit the context by themselves.
+    """
+    context = contextvars.copy_context()
+
+    def run(*args: Any, **kwargs: Any) -> Any:
+        return context.copy().run(function, *args, **kwargs)
+
+    return run
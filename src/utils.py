@@ -1,9 +1,14 @@
+from pathlib import Path
 from typing import Tuple, Optional
 import requests
+import sqlite3
 import os
 
 LyricLine = Tuple[Optional[int], str]  # (ms, text)
 
+# Persistent state (manifests, caches, queues) lives here, outside the music library
+DATA_DIR = Path(os.environ.get("DATA_DIR", "/data/intersonic"))
+
 
 def to_ms(min_str: str, sec_str: str, ms_str: str) -> int:
     # Ensure ms is 3 digits (pad with zeros if needed)
@@ -24,7 +29,7 @@ def extend_env(
     return env
 
 
-def get_public_ipv4():
+def get_public_ipv4(timeout: float = 60):
     """
     Fetches the public IPv4 address using a new, isolated request session.
     This prevents connection pooling issues when network settings (like a
@@ -34,8 +39,17 @@ def get_public_ipv4():
     with requests.Session() as session:
         # The session will automatically detect and use the proxy environment variables.
         try:
-            response = session.get("https://api.ipify.org", timeout=60)
+            response = session.get("https://api.ipify.org", timeout=timeout)
             response.raise_for_status()
             return response.text
         except Exception as e:
             raise RuntimeError(f"Failed to get public IPv4 address: {e}") from e
+
+
+def connect_db(path: Path) -> sqlite3.Connection:
+    """Opens a SQLite database, creating its parent directory if needed."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
@@ -0,0 +1,187 @@
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional
+from collections.abc import Callable, Collection
+
+from watchdog.events import FileSystemEvent, FileSystemEventHandler
+from watchdog.observers import Observer
+
+from metadata.album_art import ALBUM_ART_NAME
+from metadata.library import get_library_index
+from metadata.main import StageTimings, process_file
+from metadata.manifest import SIDECAR_SUFFIXES, Manifest
+from metrics import observe_stage_timings
+from tracing import record_timings, trace
+
+# Files whose changes should be synced into their track
+WATCHED_SUFFIXES = {".mp3", *SIDECAR_SUFFIXES}
+
+# Wait for this many seconds without new events before processing a batch
+DEBOUNCE_SECONDS = 2.0
+
+
+class TrackChangeHandler(FileSystemEventHandler):
+    """Maps filesystem events on MP3s and sidecars to the affected tracks."""
+
+    def __init__(self, on_change: Callable[[Path], None]):
+        self.on_change = on_change
+
+    def on_any_event(self, event: FileSystemEvent):
+        if event.is_directory or event.event_type in ("opened", "closed_no_write"):
+            return
+        # Editors often save by writing a temporary file and renaming it
+        for raw_path in (event.src_path, event.dest_path):
+            if not raw_path:
+                continue
+            path = Path(str(raw_path))
+            if path.name == ALBUM_ART_NAME:
+                # The album cover is shared by every track in its directory
+                for mp3_path in path.parent.glob("*.mp3"):
+                    self.on_change(mp3_path)
+            elif path.suffix.lower() in WATCHED_SUFFIXES:
+                self.on_change(path.with_suffix(".mp3"))
+
+
+def process_changed(
+    mp3_paths: Collection[Path],
+    status_callback: Optional[Callable[[str], None]] = None,
+):
+    """
+    Runs process_file on the tracks whose MP3 or sidecars changed since they
+    were last processed, and forgets the tracks that were deleted.
+    """
+    processed, failed = 0, 0
+    with Manifest() as manifest:
+        for mp3_path in sorted(mp3_paths):
+            if not mp3_path.exists():
+                get_library_index().remove(mp3_path)
+                manifest.forget(mp3_path)
+                continue
+            if manifest.is_unchanged(mp3_path):
+                continue
+            timings: StageTimings = {}
+            try:
+                process_file(mp3_path, timings=timings)
+                manifest.record(mp3_path)
+                processed += 1
+            except Exception as e:
+                print(f"Error: Failed to process {mp3_path}: {e}")
+                manifest.forget(mp3_path)
+                failed += 1
+            observe_stage_timings(timings)
+            record_timings(timings, track=str(mp3_path))
+
+    log_str = f"Synced changes to {processed} {'file' if processed == 1 else 'files'}."
+    if failed:
+        log_str += f" Failed to process {failed} files."
+    print(log_str)
+    if status_callback:
+        status_callback(log_str)
+
+
+class LibraryWatcher:
+    """
+    Watches a music directory for tracks whose MP3 or sidecars changed, and
+    syncs them in debounced batches. With `enqueue`, each batch is handed to
+    it to be processed as a job, so that it waits for the other jobs that
+    write to the library. Without it, the batch is processed right away.
+
+    The scan manifest is updated after each track, so the events caused by
+    our own writes are recognized as unchanged and don't loop.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        debounce: float = DEBOUNCE_SECONDS,
+        status_callback: Optional[Callable[[str], None]] = None,
+        enqueue: Optional[Callable[[list[Path]], Any]] = None,
+    ):
+        self.directory = directory
+        self.debounce = debounce
+        self.status_callback = status_callback
+        self.enqueue = enqueue
+
+        self.lock = threading.Lock()
+        self.pending: set[Path] = set()
+        self.last_event = 0.0
+        self.wakeup = threading.Event()
+        self.stopping = False
+
+        self.observer = Observer()
+        self.observer.schedule(
+            TrackChangeHandler(self.track_changed), str(directory), recursive=True
+        )
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.observer.start()
+        self.thread.start()
+        print(f"Watching {self.directory} for changes")
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        self.observer.stop()
+        self.observer.join()
+        self.thread.join()
+
+    def track_changed(self, mp3_path: Path):
+        with self.lock:
+            self.pending.add(mp3_path)
+            self.last_event = time.monotonic()
+        self.wakeup.set()
+
+    def run(self):
+        while not self.stopping:
+            self.wakeup.wait()
+            self.wakeup.clear()
+
+            # Wait until the burst of events has settled
+            while not self.stopping:
+                with self.lock:
+                    remaining = self.last_event + self.debounce - time.monotonic()
+                if remaining <= 0:
+                    break
+                time.sleep(remaining)
+
+            with self.lock:
+                batch, self.pending = self.pending, set()
+            if batch and not self.stopping:
+                try:
+                    self.process_batch(batch)
+                except Exception as e:
+                    print(f"Error syncing changes: {e}")
+
+    def process_batch(self, mp3_paths: set[Path]):
+        # Our own writes cause events too, skip the tracks they left unchanged
+        with Manifest() as manifest:
+            changed = sorted(
+                mp3_path
+                for mp3_path in mp3_paths
+                if not (mp3_path.exists() and manifest.is_unchanged(mp3_path))
+            )
+        if not changed:
+            return
+        if self.enqueue is not None:
+            self.enqueue(changed)
+            return
+        # The latest batch is kept as the "watcher" trace
+        with trace("watcher"):
+            process_changed(changed, self.status_callback)
+
+
+def watch_directory(directory: Path):
+    """Watches the given directory until interrupted."""
+    watcher = LibraryWatcher(directory)
+    watcher.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        watcher.stop()
+
+
+if __name__ == "__main__":
+    watch_directory(Path("/music"))
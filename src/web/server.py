@@ -1,128 +1,520 @@
-import asyncio
+import json
+import os
 import pathlib
+from dataclasses import asdict
 from threading import Lock, Thread
-from flask import Flask, render_template, request, jsonify
+from collections.abc import Callable
+from flask import Flask, Response, render_template, request, jsonify
 
-from download import download_missing
+from download import (
+    download_limiter,
+    download_missing,
+    failure_ledger,
+    init_downloader,
+    retry_failed,
+)
+from events import EVENTS
+from failures import RetryScheduler
+from jobs import Job, JobQueue
+from metadata.library import get_library_index
 from metadata.main import process_directory
-from tailscale import tailscale_setup
+from metadata.plan import load_plan, plan_directory, save_plan
+from metrics import STAGE_SECONDS, Gauge, render_metrics
+from startup import READINESS
+from subscriptions import (
+    Subscriptions,
+    SyncScheduler,
+    parse_list_url,
+    sync_subscriptions,
+)
+from tailscale import ExitNodeMonitor, tailscale_setup
+from tracing import TRACING, get_trace, trace
+from watch import LibraryWatcher, process_changed
 
 app = Flask(__name__, template_folder="templates", static_folder="static")
 
-# Gunicorn must have a single worker process for this to work correctly
-TASK_LOCK = Lock()
+# Gunicorn must have a single worker process, the job workers live in it
+WATCHER_LOCK = Lock()
 
-TASK_STATE = {"is_running": False, "message": "Idle. Ready to accept tasks."}
+WATCHER_STATE = {"message": None}
 
 
-def update_status(message: str):
-    """A thread-safe way to update the global status."""
-    global TASK_STATE
-    with TASK_LOCK:
-        TASK_STATE["message"] = message
-        print(f"Status Updated: {message}")
+def update_watcher_status(message: str):
+    """A thread-safe way to update the status of the library watcher."""
+    with WATCHER_LOCK:
+        WATCHER_STATE["message"] = message
+        print(f"Watcher Status Updated: {message}")
+    EVENTS.publish("watcher", message)
 
 
-def run_download_task(queries: list[str]):
-    """The wrapper function that will run in a separate thread."""
-    global TASK_STATE
+def run_download_job(job: Job, status_callback: Callable[[str], None]):
+    download_missing(job.params["queries"], status_callback=status_callback)
 
-    # threads do not get a default event loop, so we create one for spotdl
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
 
-    try:
-        # Pass our status_callback to the core download function
-        download_missing(queries, status_callback=update_status)
-    except Exception as e:
-        print(f"An error occurred in download thread: {e}")
-        update_status(f"Error during download: {e}")
-    finally:
-        with TASK_LOCK:
-            TASK_STATE["is_running"] = False
+def run_retry_job(job: Job, status_callback: Callable[[str], None]):
+    retry_failed(job.params["urls"], status_callback=status_callback)
+
+
+def run_sync_job(job: Job, status_callback: Callable[[str], None]):
+    sync_subscriptions(
+        SUBSCRIPTIONS, job.params["urls"], enqueue_download, status_callback
+    )
+
+
+def run_process_job(job: Job, status_callback: Callable[[str], None]):
+    if "paths" in job.params:
+        # Changes found by the library watcher
+        process_changed(
+            [pathlib.Path(path) for path in job.params["paths"]], status_callback
+        )
+        return
+    status_callback("Scanning for files to process...")
+    process_directory(
+        pathlib.Path("/music"),
+        full=job.params.get("full", False),
+        status_callback=status_callback,
+    )
+
+
+def run_plan_job(job: Job, status_callback: Callable[[str], None]):
+    status_callback("Scanning for files to plan...")
+    plan = plan_directory(
+        pathlib.Path("/music"),
+        full=job.params.get("full", False),
+        status_callback=status_callback,
+    )
+    save_plan(f"job-{job.id}", plan)
+
+
+# Job types that need the downloader (and its Spotify client)
+DOWNLOAD_JOB_TYPES = ("download", "retry", "sync")
+# Job types that scan the whole library
+METADATA_JOB_TYPES = ("process", "plan")
+
+# Metadata processing and planning already use every core, and would pick up
+# MP3s that a download is still writing or processing, so each of them runs
+# alone. Downloads wait in the queue until the downloader is initialized.
+JOBS = JobQueue(
+    {
+        "download": run_download_job,
+        "retry": run_retry_job,
+        "sync": run_sync_job,
+        "process": run_process_job,
+        "plan": run_plan_job,
+    },
+    exclusive_types={"sync"},
+    conflicts={
+        type: (*METADATA_JOB_TYPES, *DOWNLOAD_JOB_TYPES) for type in METADATA_JOB_TYPES
+    },
+    paused_types=DOWNLOAD_JOB_TYPES,
+)
+
+
+Gauge(
+    "intersonic_jobs_queued",
+    "Jobs waiting in the queue.",
+    function=lambda: JOBS.count("queued"),
+)
+Gauge(
+    "intersonic_jobs_running",
+    "Jobs currently running.",
+    function=lambda: JOBS.count("running"),
+)
+Gauge(
+    "intersonic_downloads_in_flight",
+    "Songs being downloaded right now.",
+    function=lambda: download_limiter.status()["in_flight"],
+)
+Gauge(
+    "intersonic_download_limit",
+    "Current limit of the adaptive download concurrency.",
+    function=lambda: download_limiter.current_limit,
+)
+Gauge(
+    "intersonic_failed_songs",
+    "Songs in the failure ledger.",
+    function=failure_ledger.count,
+)
+
+
+def update_download_availability():
+    """Downloads only run while every subsystem, including the exit node, is up."""
+    for type in DOWNLOAD_JOB_TYPES:
+        if READINESS.all_ready():
+            JOBS.resume(type)
+        else:
+            JOBS.pause(type)
+
+
+SUBSCRIPTIONS = Subscriptions()
+
+
+def enqueue_download(queries: list[str]) -> Job:
+    return JOBS.enqueue(
+        "download",
+        {"queries": queries},
+        f"Waiting to download {len(queries)} {"query" if len(queries) == 1 else "queries"}...",
+    )
+
+
+def enqueue_sync(urls: list[str]) -> Job:
+    return JOBS.enqueue(
+        "sync",
+        {"urls": urls},
+        f"Waiting to sync {len(urls)} {'subscription' if len(urls) == 1 else 'subscriptions'}...",
+    )
+
 
+def schedule_sync(urls: list[str]):
+    """Syncs the subscriptions that are due, unless a sync is already waiting."""
+    if JOBS.count("queued", type="sync") or JOBS.count("running", type="sync"):
+        return
+    enqueue_sync(urls)
 
-def run_process_task():
-    """Wrapper for the metadata processing task."""
-    global TASK_STATE
 
-    # threads do not get a default event loop, so we create one for spotdl
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+def enqueue_retry(urls: list[str]) -> Job:
+    return JOBS.enqueue(
+        "retry",
+        {"urls": urls},
+        f"Waiting to retry {len(urls)} failed {'song' if len(urls) == 1 else 'songs'}...",
+    )
 
+
+def enqueue_watched_changes(mp3_paths: list[pathlib.Path]) -> Job:
+    files_str = f"{len(mp3_paths)} {'file' if len(mp3_paths) == 1 else 'files'}"
+    job = JOBS.enqueue(
+        "process",
+        {"paths": [str(path) for path in mp3_paths]},
+        f"Waiting to sync changes to {files_str}...",
+    )
+    update_watcher_status(f"Queued job #{job.id} to sync changes to {files_str}.")
+    return job
+
+
+def update_exit_node_status(message: str):
+    READINESS.set("tailscale", "ready" if EXIT_NODES.healthy else "failed", message)
+    update_download_availability()
+
+
+EXIT_NODES = ExitNodeMonitor(status_callback=update_exit_node_status)
+
+
+def status_context() -> dict:
+    with WATCHER_LOCK:
+        watcher_message = WATCHER_STATE["message"]
+    starting = {
+        name: state
+        for name, state in READINESS.snapshot().items()
+        if state["status"] != "ready"
+    }
+    return {
+        "jobs": JOBS.recent(),
+        "watcher_message": watcher_message,
+        "starting": starting,
+        "exit_node": EXIT_NODES.status(),
+        "downloads": download_limiter.status(),
+        "failed_count": failure_ledger.count(),
+        "subscription_count": SUBSCRIPTIONS.count(),
+    }
+
+
+def render_status(notice: str | None = None):
+    return render_template("_status.html", notice=notice, **status_context())
+
+
+def initialize():
+    with trace("startup"):
+        initialize_subsystems()
+
+
+def initialize_subsystems():
+    """
+    Sets up Tailscale, the exit node and then the downloader. This runs in
+    the background so the server can answer requests (and queue jobs) while
+    the network comes up, which can take minutes with a slow exit node.
+    """
+    READINESS.set("tailscale", "starting", "Connecting to Tailscale...")
+    try:
+        with STAGE_SECONDS.time(stage="tailscale_setup"):
+            tailscale_setup()
+    except Exception as e:
+        READINESS.set("tailscale", "failed", f"Tailscale setup failed: {e}")
+        READINESS.set(
+            "downloader", "failed", "Not started, Tailscale failed to connect."
+        )
+        return
+    READINESS.set("tailscale", "starting", "Choosing an exit node...")
+    # Reports through update_exit_node_status, and keeps checking afterwards
+    EXIT_NODES.check()
+    EXIT_NODES.start()
+
+    READINESS.set("downloader", "starting", "Initializing the downloader...")
     try:
-        update_status("Processing metadata for all files...")
-        process_directory(pathlib.Path("/music"))
-        update_status("Metadata processing complete.")
+        init_downloader()
     except Exception as e:
-        print(f"An error occurred in process thread: {e}")
-        update_status(f"Error during processing: {e}")
-    finally:
-        with TASK_LOCK:
-            TASK_STATE["is_running"] = False
+        READINESS.set("downloader", "failed", f"Downloader setup failed: {e}")
+        return
+    READINESS.set("downloader", "ready", "The downloader is ready.")
+    update_download_availability()
 
 
-print("Initializing Tailscale...")
-tailscale_setup()
-print("Tailscale setup complete.")
+Thread(target=initialize, name="initialize", daemon=True).start()
+
+JOBS.start()
+RetryScheduler(failure_ledger, enqueue_retry).start()
+SyncScheduler(SUBSCRIPTIONS, schedule_sync).start()
+
+if os.environ.get("WATCH_MUSIC", "").lower() in ("1", "true", "yes"):
+    LibraryWatcher(pathlib.Path("/music"), enqueue=enqueue_watched_changes).start()
 
 
 @app.route("/")
 def index():
-    return render_template("index.html")
+    return render_template("index.html", **status_context())
 
 
 @app.route("/start_task", methods=["POST"])
 def start_task():
     """
-    A single endpoint to start either task. It returns immediately
-    and kicks off the background thread.
+    A single endpoint to queue any task. It returns immediately,
+    the job workers pick the job up as soon as they are free.
     """
-    global TASK_STATE
     task_type = request.form.get("task_type")
 
-    with TASK_LOCK:
-        if TASK_STATE["is_running"]:
-            return (
-                render_template("_status.html", status="Task already in progress."),
-                429,
-            )
-
-        TASK_STATE["is_running"] = True
-
-        if task_type == "download":
-            queries_text = request.form.get("queries", "")
-            queries = [q.strip() for q in queries_text.splitlines() if q.strip()]
-            if not queries:
-                TASK_STATE["is_running"] = False
-                return render_template(
-                    "_status.html", status="Idle. No queries provided."
-                )
-
-            print(f"Received {len(queries)} queries for download.")
-
-            TASK_STATE["message"] = (
-                f"Starting download for {len(queries)} {"query" if len(queries) == 1 else "queries"}..."
-            )
-            thread = Thread(target=run_download_task, args=(queries,))
-            thread.start()
-
-        elif task_type == "process":
-            print("Starting metadata processing task...")
-            TASK_STATE["message"] = "Starting metadata processing..."
-            thread = Thread(target=run_process_task)
-            thread.start()
+    if task_type == "download":
+        queries_text = request.form.get("queries", "")
+        queries = [q.strip() for q in queries_text.splitlines() if q.strip()]
+        if not queries:
+            return render_status("No queries provided.")
 
-        else:
-            TASK_STATE["is_running"] = False
-            return render_template("_status.html", status="Invalid task type."), 400
+        print(f"Received {len(queries)} queries for download.")
+        job = enqueue_download(queries)
+
+    elif task_type == "retry":
+        urls = failure_ledger.take_all()
+        if not urls:
+            return render_status("No failed songs to retry.")
+        print(f"Queueing a retry of {len(urls)} failed songs...")
+        try:
+            job = enqueue_retry(urls)
+        except Exception:
+            # Otherwise they'd stay marked as retrying, with no job to run them
+            failure_ledger.release(urls)
+            raise
+
+    elif task_type == "sync":
+        urls = [subscription.url for subscription in SUBSCRIPTIONS.entries()]
+        if not urls:
+            return render_status("No subscriptions to sync.")
+        print(f"Queueing a sync of {len(urls)} subscriptions...")
+        job = enqueue_sync(urls)
 
-    return render_template("_status.html", status=TASK_STATE["message"])
+    elif task_type == "process":
+        full = request.form.get("full") == "on"
+        print(f"Queueing {'full ' if full else ''}metadata processing task...")
+        job = JOBS.enqueue(
+            "process", {"full": full}, "Waiting to start metadata processing..."
+        )
+
+    elif task_type == "plan":
+        full = request.form.get("full") == "on"
+        print(f"Queueing {'full ' if full else ''}metadata planning task...")
+        job = JOBS.enqueue(
+            "plan", {"full": full}, "Waiting to plan metadata processing..."
+        )
+
+    else:
+        return render_status("Invalid task type."), 400
+
+    if job.type in DOWNLOAD_JOB_TYPES and not READINESS.is_ready("downloader"):
+        return render_status(
+            f"Queued {job.type} job #{job.id}, it will start once the downloader is ready."
+        )
+    return render_status(f"Queued {job.type} job #{job.id}.")
+
+
+@app.route("/subscriptions", methods=["GET", "POST"])
+def subscriptions():
+    """
+    Lists the subscribed playlists and albums, or subscribes to (or, with
+    action=remove, unsubscribes from) the URLs in the form.
+    """
+    if request.method == "GET":
+        return jsonify([asdict(entry) for entry in SUBSCRIPTIONS.entries()])
+
+    urls_text = request.form.get("urls", "")
+    urls = [url.strip() for url in urls_text.splitlines() if url.strip()]
+    if not urls:
+        return render_status("No playlist or album URLs provided.")
+
+    if request.form.get("action") == "remove":
+        removed = sum(SUBSCRIPTIONS.remove(url) for url in urls)
+        return render_status(
+            f"Unsubscribed from {removed} {'list' if removed == 1 else 'lists'}."
+        )
+
+    invalid = [url for url in urls if parse_list_url(url) is None]
+    if invalid:
+        return render_status(f"Not a Spotify playlist or album URL: {invalid[0]}"), 400
+
+    added = [url for url in urls if SUBSCRIPTIONS.add(url)]
+    if not added:
+        return render_status("Already subscribed to every list.")
+    # The first sync downloads everything that isn't in the library yet
+    job = enqueue_sync(
+        [
+            subscription.url
+            for subscription in SUBSCRIPTIONS.entries()
+            if subscription.synced_at is None
+        ]
+    )
+    return render_status(
+        f"Subscribed to {len(added)} {'list' if len(added) == 1 else 'lists'}, queued sync job #{job.id}."
+    )
 
 
 @app.route("/status")
 def get_status():
-    """The polling endpoint. Returns the current status."""
-    global TASK_STATE
-    with TASK_LOCK:
-        return render_template("_status.html", status=TASK_STATE["message"])
+    """Returns the current status of recent jobs."""
+    return render_status()
+
+
+# Seconds between keepalive comments on an idle event stream
+EVENT_KEEPALIVE_SECONDS = 15
+
+
+@app.route("/events")
+def get_events():
+    """
+    A Server-Sent Events stream of every progress event as it happens.
+    New clients first receive the recent events still in the buffer,
+    reconnecting clients only the ones they missed. An ID that isn't a
+    number replays the whole buffer, like for a new client.
+    """
+    try:
+        last_id = int(
+            request.headers.get("Last-Event-ID") or request.args.get("since") or 0
+        )
+    except ValueError:
+        last_id = 0
+
+    def stream(last_id: int):
+        events = EVENTS.since(last_id)
+        while True:
+            if not events:
+                yield ": keepalive\n\n"
+            for event in events:
+                yield f"id: {event['id']}\ndata: {json.dumps(event)}\n\n"
+                last_id = event["id"]
+            events = EVENTS.wait(last_id, EVENT_KEEPALIVE_SECONDS)
+
+    return Response(
+        stream(last_id),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/healthz")
+def healthz():
+    """Liveness: the server is up, whatever state the subsystems are in."""
+    return jsonify(
+        {
+            "status": "ok",
+            "subsystems": READINESS.snapshot(),
+            "exit_node": EXIT_NODES.status(),
+            "downloads": download_limiter.status(),
+        }
+    )
+
+
+@app.route("/readyz")
+def readyz():
+    """Readiness: every subsystem finished initializing."""
+    ready = READINESS.all_ready()
+    body = {
+        "status": "ready" if ready else "not ready",
+        "subsystems": READINESS.snapshot(),
+    }
+    return jsonify(body), 200 if ready else 503
+
+
+@app.route("/failed")
+def get_failed():
+    """Lists the songs in the failure ledger."""
+    return jsonify([asdict(entry) for entry in failure_ledger.entries()])
+
+
+def bool_arg(name: str) -> bool | None:
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return value.lower() in ("1", "true", "yes")
+
+
+@app.route("/library/tracks")
+def get_library_tracks():
+    """
+    Looks up tracks in the library catalog. Filters: artist, album, isrc,
+    spotify_url, has_lyrics, has_synced_lyrics and has_art, e.g.
+    /library/tracks?artist=Queen&has_lyrics=0
+    """
+    tracks = get_library_index().find(
+        artist=request.args.get("artist"),
+        album=request.args.get("album"),
+        isrc=request.args.get("isrc"),
+        spotify_url=request.args.get("spotify_url"),
+        has_lyrics=bool_arg("has_lyrics"),
+        has_synced_lyrics=bool_arg("has_synced_lyrics"),
+        has_art=bool_arg("has_art"),
+        limit=request.args.get("limit", 1000, type=int),
+    )
+    return jsonify(tracks)
+
+
+@app.route("/library/stats")
+def get_library_stats():
+    return jsonify(get_library_index().stats())
+
+
+@app.route("/metrics")
+def get_metrics():
+    """Metrics in the Prometheus text format."""
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/jobs/<int:job_id>")
+def get_job(job_id: int):
+    job = JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(asdict(job))
+
+
+@app.route("/jobs/<int:job_id>/timings")
+def get_job_timings(job_id: int):
+    """Where a job spent its time: per stage, and the slowest tracks and spans."""
+    return get_trace_summary(f"job-{job_id}")
+
+
+@app.route("/jobs/<int:job_id>/plan")
+def get_job_plan(job_id: int):
+    """What a plan job found that metadata processing would change."""
+    plan = load_plan(f"job-{job_id}")
+    if plan is None:
+        return jsonify({"error": "Plan not found"}), 404
+    return jsonify(plan)
+
+
+@app.route("/traces/<name>")
+def get_trace_summary(name: str):
+    """
+    The timing breakdown of a recent trace: "job-<id>", "startup",
+    "exit-node-check" or "watcher".
+    """
+    if not TRACING:
+        return jsonify({"error": "Tracing is disabled, set TRACING=1"}), 404
+    recorded = get_trace(name)
+    if recorded is None:
+        return jsonify({"error": "Trace not found"}), 404
+    return jsonify(recorded.summary())
@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# Paths under DATA_DIR are read when the modules are imported, so this has to
+# happen before any of them are. Every test session gets a scratch directory.
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="intersonic-tests-")
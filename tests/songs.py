@@ -0,0 +1,26 @@
+from spotdl.types.song import Song
+
+
+def make_song(id: str) -> Song:
+    return Song(
+        name=f"Song {id}",
+        artists=["Artist"],
+        artist="Artist",
+        genres=[],
+        disc_number=1,
+        disc_count=1,
+        album_name="Album",
+        album_artist="Artist",
+        duration=180,
+        year=2024,
+        date="2024-01-01",
+        track_number=1,
+        tracks_count=1,
+        song_id=id,
+        explicit=False,
+        publisher="Label",
+        url=f"https://open.spotify.com/track/{id}",
+        isrc=None,
+        cover_url=None,
+        copyright_text=None,
+    )
@@ -0,0 +1,92 @@
+import random
+from pathlib import Path
+from typing import Optional
+
+from mutagen.id3 import APIC, ID3, TIT2
+
+from benchmark import SILENT_FRAME, make_art
+from metadata.album_art import ALBUM_ART_NAME, convert_to_jpeg
+from metadata.main import process_album
+
+
+def make_track(path: Path, art: Optional[bytes]) -> Path:
+    path.write_bytes(SILENT_FRAME * 4)
+    id3 = ID3()
+    id3.add(TIT2(encoding=3, text=path.stem))
+    if art is not None:
+        id3.add(APIC(encoding=3, mime="image/jpeg", type=3, data=art))
+    id3.save(path)
+    return path
+
+
+def embedded_art(path: Path) -> bytes:
+    return ID3(path).getall("APIC")[0].data
+
+
+def test_tracks_keep_their_own_art(tmp_path: Path):
+    rng = random.Random(0)
+    album_art = convert_to_jpeg(make_art(rng, 300, "JPEG"))
+    other_art = convert_to_jpeg(make_art(rng, 300, "JPEG"))
+    first = make_track(tmp_path / "01.mp3", album_art)
+    second = make_track(tmp_path / "02.mp3", other_art)
+    third = make_track(tmp_path / "03.mp3", album_art)
+
+    process_album([first, second, third])
+
+    # The first track provides the cover, the odd one out keeps its own art
+    assert (tmp_path / ALBUM_ART_NAME).read_bytes() == album_art
+    assert not first.with_suffix(".jpg").exists()
+    assert second.with_suffix(".jpg").read_bytes() == other_art
+    assert not third.with_suffix(".jpg").exists()
+    assert embedded_art(second) == other_art
+    assert embedded_art(third) == album_art
+
+
+def test_tracks_without_art_get_the_cover(tmp_path: Path):
+    cover = convert_to_jpeg(make_art(random.Random(0), 300, "JPEG"))
+    (tmp_path / ALBUM_ART_NAME).write_bytes(cover)
+    track = make_track(tmp_path / "01.mp3", None)
+
+    process_album([track])
+
+    assert embedded_art(track) == cover
+    assert not track.with_suffix(".jpg").exists()
+
+
+def test_only_copies_of_the_cover_are_removed(tmp_path: Path):
+    rng = random.Random(0)
+    cover = convert_to_jpeg(make_art(rng, 300, "JPEG"))
+    other_art = convert_to_jpeg(make_art(rng, 300, "JPEG"))
+    (tmp_path / ALBUM_ART_NAME).write_bytes(cover)
+    copy = make_track(tmp_path / "01.mp3", cover)
+    copy.with_suffix(".jpg").write_bytes(cover)
+    own = make_track(tmp_path / "02.mp3", cover)
+    own.with_suffix(".jpg").write_bytes(other_art)
+
+    process_album([copy, own])
+
+    assert not copy.with_suffix(".jpg").exists()
+    assert own.with_suffix(".jpg").read_bytes() == other_art
+    assert embedded_art(own) == other_art
+    assert (tmp_path / ALBUM_ART_NAME).read_bytes() == cover
+
+
+def test_edited_cover_reaches_every_track(tmp_path: Path):
+    rng = random.Random(0)
+    old_art = convert_to_jpeg(make_art(rng, 300, "JPEG"))
+    new_art = convert_to_jpeg(make_art(rng, 300, "JPEG"))
+    other_art = convert_to_jpeg(make_art(rng, 300, "JPEG"))
+    tracks = [make_track(tmp_path / f"{i:02d}.mp3", old_art) for i in range(3)]
+    own = make_track(tmp_path / "03.mp3", other_art)
+    process_album([*tracks, own])
+    assert (tmp_path / ALBUM_ART_NAME).read_bytes() == old_art
+
+    (tmp_path / ALBUM_ART_NAME).write_bytes(new_art)
+    process_album([*tracks, own])
+
+    for track in tracks:
+        assert embedded_art(track) == new_art
+        assert not track.with_suffix(".jpg").exists()
+    assert (tmp_path / ALBUM_ART_NAME).read_bytes() == new_art
+    # Art that was never the album's stays
+    assert embedded_art(own) == other_art
@@ -0,0 +1,104 @@
+import threading
+
+import pytest
+
+import concurrency
+from concurrency import AdaptiveLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(concurrency.time, "monotonic", clock)
+    return clock
+
+
+def succeed(limiter: AdaptiveLimiter, clock: Clock, latency: float = 1):
+    started = limiter.acquire()
+    clock.now += latency
+    limiter.release(started, "success")
+
+
+def test_limit_grows_by_about_one_per_limit_successes(clock: Clock):
+    changes: list[tuple[int, str]] = []
+    limiter = AdaptiveLimiter(
+        4, maximum=8, on_change=lambda *change: changes.append(change)
+    )
+    # Each success adds 1 / limit, so it takes a little more than 4
+    for _ in range(4):
+        succeed(limiter, clock)
+    assert limiter.current_limit == 4
+    succeed(limiter, clock)
+    assert limiter.current_limit == 5
+    assert changes == [(5, "success")]
+
+    for _ in range(100):
+        succeed(limiter, clock)
+    assert limiter.current_limit == 8
+
+
+def test_slow_successes_dont_grow_the_limit(clock: Clock):
+    limiter = AdaptiveLimiter(4)
+    succeed(limiter, clock, latency=1)
+    for _ in range(20):
+        succeed(limiter, clock, latency=10)
+    assert limiter.current_limit == 4
+
+
+@pytest.mark.parametrize("outcome, limit", [("throttled", 4), ("error", 6)])
+def test_failures_cut_the_limit(clock: Clock, outcome: str, limit: int):
+    limiter = AdaptiveLimiter(8)
+    started = limiter.acquire()
+    clock.now += 1
+    limiter.release(started, outcome)
+    assert limiter.current_limit == limit
+
+
+def test_a_burst_of_failures_counts_once(clock: Clock):
+    limiter = AdaptiveLimiter(8)
+    burst = [limiter.acquire() for _ in range(4)]
+    clock.now += 1
+    for started in burst:
+        limiter.release(started, "throttled")
+    assert limiter.current_limit == 4
+
+    # Work started after the cut counts again
+    started = limiter.acquire()
+    clock.now += 1
+    limiter.release(started, "throttled")
+    assert limiter.current_limit == 2
+
+
+def test_limit_stays_above_the_minimum(clock: Clock):
+    limiter = AdaptiveLimiter(4, minimum=2)
+    for _ in range(5):
+        started = limiter.acquire()
+        clock.now += 1
+        limiter.release(started, "throttled")
+    assert limiter.current_limit == 2
+
+
+def test_acquire_waits_for_a_free_slot(clock: Clock):
+    limiter = AdaptiveLimiter(1)
+    started = limiter.acquire()
+    acquired = threading.Event()
+
+    def acquire():
+        limiter.acquire()
+        acquired.set()
+
+    waiter = threading.Thread(target=acquire)
+    waiter.start()
+    assert not acquired.wait(0.1)
+    limiter.release(started, "success")
+    assert acquired.wait(5)
+    waiter.join()
+    assert limiter.status()["in_flight"] == 1
@@ -0,0 +1,84 @@
+import time
+from pathlib import Path
+
+import pytest
+from spotdl.types.song import Song
+
+import failures
+from failures import RETRY_MAX_ATTEMPTS, FailureLedger
+from songs import make_song
+
+
+@pytest.fixture
+def ledger(tmp_path: Path) -> FailureLedger:
+    return FailureLedger(tmp_path / "failures.sqlite3")
+
+
+def entry(ledger: FailureLedger, song: Song) -> failures.FailedSong:
+    [found] = [entry for entry in ledger.entries() if entry.url == song.url]
+    return found
+
+
+def test_transient_failures_wait_for_a_retry(ledger: FailureLedger):
+    song = make_song("a")
+    ledger.record(song, "throttled", "429 Too Many Requests")
+    failed = entry(ledger, song)
+    assert failed.status == "waiting" and failed.attempts == 1
+    assert failed.retry_at is not None and failed.retry_at > time.time()
+    assert failed.name == song.display_name
+
+
+def test_transient_failures_give_up_after_the_last_attempt(ledger: FailureLedger):
+    song = make_song("a")
+    for _ in range(RETRY_MAX_ATTEMPTS):
+        ledger.record(song, "timeout", "Read timed out")
+    failed = entry(ledger, song)
+    assert failed.attempts == RETRY_MAX_ATTEMPTS
+    assert failed.status == "failed" and failed.retry_at is None
+
+
+def test_other_failures_are_not_retried_automatically(ledger: FailureLedger):
+    song = make_song("a")
+    ledger.record(song, "metadata", "ValueError: Invalid JSON data")
+    failed = entry(ledger, song)
+    assert failed.status == "failed" and failed.retry_at is None
+    assert ledger.take_due() == []
+    # But they can be retried by hand
+    assert ledger.take_all() == [song.url]
+
+
+def test_due_songs_are_taken_once(ledger: FailureLedger, monkeypatch):
+    monkeypatch.setattr(failures, "retry_delay", lambda attempts: 0)
+    due, later = make_song("due"), make_song("later")
+    ledger.record(due, "network", "Connection reset")
+    monkeypatch.setattr(failures, "retry_delay", lambda attempts: 3600)
+    ledger.record(later, "network", "Connection reset")
+
+    assert ledger.take_due() == [due.url]
+    assert entry(ledger, due).status == "retrying"
+    assert ledger.take_due() == []
+    # Songs already being retried aren't taken again
+    assert ledger.take_all() == [later.url]
+
+
+def test_released_songs_wait_again(ledger: FailureLedger):
+    song = make_song("a")
+    ledger.record(song, "network", "Connection reset")
+    assert ledger.take_all() == [song.url]
+    ledger.release([song.url])
+    released = entry(ledger, song)
+    assert released.status == "waiting" and released.attempts == 1
+
+
+def test_songs_round_trip_and_resolve(ledger: FailureLedger):
+    songs = [make_song("a"), make_song("b")]
+    for song in songs:
+        ledger.record(song, "DownloadError", "No results found")
+    assert ledger.count() == 2
+
+    restored = ledger.songs([songs[1].url, songs[0].url, "unknown"])
+    assert [song.url for song in restored] == [songs[1].url, songs[0].url]
+    assert restored[0].name == "Song b"
+
+    ledger.resolve(songs[0].url)
+    assert [entry.url for entry in ledger.entries()] == [songs[1].url]
@@ -0,0 +1,128 @@
+import time
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+from jobs import Job, JobQueue
+
+TYPES = ("download", "sync", "process")
+
+
+def noop(job: Job, status_callback):
+    pass
+
+
+def make_queue(path: Path, **kwargs) -> JobQueue:
+    return JobQueue(
+        {type: noop for type in TYPES}, path=path / "jobs.sqlite3", **kwargs
+    )
+
+
+def claim(queue: JobQueue) -> Optional[Job]:
+    with queue.condition:
+        return queue.claim()
+
+
+@pytest.fixture
+def queue(tmp_path: Path) -> JobQueue:
+    return make_queue(
+        tmp_path,
+        exclusive_types={"sync"},
+        conflicts={"process": ("process", "download", "sync")},
+    )
+
+
+def test_jobs_are_claimed_in_order(queue: JobQueue):
+    first = queue.enqueue("download", {"n": 1}, "")
+    second = queue.enqueue("download", {"n": 2}, "")
+    claimed = claim(queue)
+    assert claimed is not None and claimed.id == first.id
+    assert claimed.status == "running" and claimed.params == {"n": 1}
+    claimed = claim(queue)
+    assert claimed is not None and claimed.id == second.id
+    assert claim(queue) is None
+
+
+def test_exclusive_type_runs_alone(queue: JobQueue):
+    queue.enqueue("sync", {}, "")
+    queue.enqueue("sync", {}, "")
+    first = claim(queue)
+    assert first is not None
+    assert claim(queue) is None
+
+    queue.finish(first, "done")
+    assert claim(queue) is not None
+
+
+def test_conflicting_types_wait_for_each_other(queue: JobQueue):
+    queue.enqueue("download", {}, "")
+    process = queue.enqueue("process", {}, "")
+    newer_download = queue.enqueue("download", {}, "")
+
+    download = claim(queue)
+    assert download is not None and download.type == "download"
+    # The process job waits for the download, and the newer download waits
+    # for the process job instead of overtaking it
+    assert claim(queue) is None
+
+    queue.finish(download, "done")
+    claimed = claim(queue)
+    assert claimed is not None and claimed.id == process.id
+    assert claim(queue) is None
+
+    queue.finish(claimed, "done")
+    claimed = claim(queue)
+    assert claimed is not None and claimed.id == newer_download.id
+
+
+def test_paused_types_stay_queued(queue: JobQueue):
+    queue.pause("download")
+    queue.enqueue("download", {}, "")
+    process = queue.enqueue("process", {}, "")
+    # A paused download doesn't hold back the process job
+    claimed = claim(queue)
+    assert claimed is not None and claimed.id == process.id
+    queue.finish(claimed, "done")
+    assert claim(queue) is None
+
+    queue.resume("download")
+    claimed = claim(queue)
+    assert claimed is not None and claimed.type == "download"
+
+
+def test_running_jobs_are_requeued_after_a_restart(tmp_path: Path):
+    queue = make_queue(tmp_path)
+    job = queue.enqueue("download", {"queries": ["a"]}, "")
+    assert claim(queue) is not None
+    assert queue.count("running") == 1
+
+    restarted = make_queue(tmp_path)
+    requeued = restarted.get(job.id)
+    assert requeued is not None
+    assert requeued.status == "queued" and requeued.started_at is None
+    assert requeued.message.startswith("Interrupted by a restart")
+    claimed = claim(restarted)
+    assert claimed is not None and claimed.params == {"queries": ["a"]}
+
+
+def test_workers_record_the_outcome(tmp_path: Path):
+    def fail(job: Job, status_callback):
+        status_callback("Working...")
+        raise RuntimeError("broken")
+
+    queue = JobQueue(
+        {"download": noop, "process": fail}, workers=1, path=tmp_path / "jobs.sqlite3"
+    )
+    done = queue.enqueue("download", {}, "")
+    failed = queue.enqueue("process", {}, "")
+    queue.start()
+
+    deadline = time.monotonic() + 10
+    while queue.count("queued") or queue.count("running"):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert queue.get(done.id).status == "done"  # type: ignore[union-attr]
+    failed_job = queue.get(failed.id)
+    assert failed_job is not None and failed_job.status == "failed"
+    assert failed_job.message == "Error: broken"
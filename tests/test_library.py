@@ -0,0 +1,25 @@
+import sqlite3
+from pathlib import Path
+
+from metadata.library import LibraryIndex
+from metadata.tags import Tags
+
+
+def test_isrcs_are_found_whatever_their_case(tmp_path: Path):
+    index = LibraryIndex(tmp_path / "library.sqlite3")
+    mp3_path = tmp_path / "track.mp3"
+    index.update(mp3_path, Tags(title="Title", isrc="usabc2400001"))
+
+    for isrc in ("usabc2400001", "USABC2400001"):
+        [track] = index.find(isrc=isrc)
+        assert track["path"] == str(mp3_path) and track["isrc"] == "USABC2400001"
+    assert index.owned([(None, "usAbc2400001", tmp_path / "other.mp3")]) == [True]
+
+
+def test_stored_isrcs_are_normalized_on_open(tmp_path: Path):
+    path = tmp_path / "library.sqlite3"
+    LibraryIndex(path).update(tmp_path / "track.mp3", Tags(isrc="USABC2400001"))
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE tracks SET isrc = lower(isrc)")
+
+    assert len(LibraryIndex(path).find(isrc="USABC2400001")) == 1
@@ -0,0 +1,136 @@
+import pytest
+from mutagen.id3 import ID3
+
+from metadata.lyrics import (
+    embed_lyrics_to_mp3,
+    parse_id3_lyrics,
+    parse_lrc,
+    serialize_to_lrc,
+)
+
+LRC = """\
+[ar:Artist]
+[ti:Title]
+[00:01.00]First line
+[00:02.50]<00:02.50>Word <00:03.125>by <00:03.40>word
+Unsynced line
+[00:04.007]Exact milliseconds
+"""
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        LRC,
+        "",
+        "Just plain lyrics\nwithout any timestamps\n",
+        "[00:00.00]\n[00:01.00]After an empty line\n",
+    ],
+)
+def test_round_trip(text: str):
+    parsed = parse_lrc(text)
+    again = parse_lrc(serialize_to_lrc(parsed.lines, parsed.tags, parsed.offset))
+    assert again == parsed
+
+
+def test_serialized_text_reads_back_the_same():
+    parsed = parse_lrc(LRC)
+    text = serialize_to_lrc(parsed.lines, parsed.tags)
+    again = parse_lrc(text)
+    assert serialize_to_lrc(again.lines, again.tags) == text
+
+
+def test_parse():
+    parsed = parse_lrc(LRC)
+    assert parsed.tags == {"ar": "Artist", "ti": "Title"}
+    assert parsed.lines == [
+        (1000, "First line"),
+        (2500, "<00:02.50>Word <00:03.125>by <00:03.40>word"),
+        (None, "Unsynced line"),
+        (4007, "Exact milliseconds"),
+    ]
+
+
+def test_repeated_lines_are_put_in_order():
+    parsed = parse_lrc(
+        "[00:01.00]Verse\n[00:02.00][00:04.00]Chorus\n[00:03.00]Bridge\n"
+    )
+    assert parsed.lines == [
+        (1000, "Verse"),
+        (2000, "Chorus"),
+        (3000, "Bridge"),
+        (4000, "Chorus"),
+    ]
+
+
+def test_unsynced_lines_stay_after_their_line():
+    parsed = parse_lrc("[00:02.00]Second\nunsynced\n[00:01.00]First\n")
+    assert parsed.lines == [(1000, "First"), (2000, "Second"), (None, "unsynced")]
+
+
+def test_offset_is_applied():
+    text = "[offset:+500]\n[00:02.00]<00:02.20>Sooner\n[00:00.20]Clamped\n"
+    parsed = parse_lrc(text)
+    assert "offset" not in parsed.tags and parsed.offset == 500
+    # Word timestamps are kept as written, and shifted when they're split
+    assert parsed.lines == [(0, "Clamped"), (1500, "<00:02.20>Sooner")]
+    tags = ID3()
+    embed_lyrics_to_mp3(tags, parsed.lines, parsed.offset)
+    sync_data = tags.getall("SYLT")[0].text
+    assert sync_data == [("Clamped", 0), ("\n", 1500), ("Sooner", 1700)]
+
+
+def test_offset_round_trip():
+    parsed = parse_lrc("[ar:Artist]\n[offset:-250]\n[00:01.00]<00:01.20>Later\n")
+    assert parsed.lines == [(1250, "<00:01.20>Later")]
+    text = serialize_to_lrc(parsed.lines, parsed.tags, parsed.offset)
+    assert text == "[ar:Artist]\n[offset:-250]\n[00:01.00] <00:01.20>Later\n"
+    assert parse_lrc(text) == parsed
+
+
+def test_carriage_returns():
+    assert parse_lrc("[00:01.00]One\r\n[00:02.00]Two\r\n").lines == [
+        (1000, "One"),
+        (2000, "Two"),
+    ]
+
+
+@pytest.mark.parametrize(
+    "lines",
+    [
+        [(1000, "First line"), (2000, "Second line")],
+        [(1000, "Word <00:01.50>by <00:01.75>word"), (2000, "Next <00:02.40>line")],
+    ],
+)
+def test_sylt_round_trip(lines):
+    tags = ID3()
+    assert embed_lyrics_to_mp3(tags, lines)
+    assert parse_id3_lyrics(tags) == lines
+    # Embedding the same lyrics again changes nothing
+    assert not embed_lyrics_to_mp3(tags, lines)
+
+
+def test_unsynced_lyrics_only_use_uslt():
+    tags = ID3()
+    embed_lyrics_to_mp3(tags, [(None, "Plain"), (None, "lyrics")])
+    assert tags.getall("SYLT") == []
+    assert parse_id3_lyrics(tags) == [(None, "Plain"), (None, "lyrics")]
+
+
+def test_section_labels_are_lyrics():
+    text = "[ar:Artist]\n[Intro: Drake]\nHello there\n[Chorus: Drake]\nYeah\n"
+    parsed = parse_lrc(text)
+    assert parsed.tags == {"ar": "Artist"}
+    assert parsed.lines == [
+        (None, "[Intro: Drake]"),
+        (None, "Hello there"),
+        (None, "[Chorus: Drake]"),
+        (None, "Yeah"),
+    ]
+    assert serialize_to_lrc(parsed.lines, parsed.tags) == text
+
+
+def test_header_tags_only_come_before_the_lyrics():
+    parsed = parse_lrc("[ti:Title]\n[00:01.00]Line\n[ar:Not a header]\n")
+    assert parsed.tags == {"ti": "Title"}
+    assert parsed.lines == [(1000, "Line"), (None, "[ar:Not a header]")]
@@ -0,0 +1,58 @@
+from pathlib import Path
+
+import pytest
+
+from benchmark import SILENT_FRAME, generate_library
+from metadata.main import process_album, process_directory
+
+
+def snapshot(directory: Path) -> dict[Path, tuple[bytes, int]]:
+    return {
+        path: (path.read_bytes(), path.stat().st_mtime_ns)
+        for path in sorted(directory.rglob("*"))
+        if path.is_file()
+    }
+
+
+@pytest.fixture
+def library(tmp_path: Path) -> Path:
+    directory = tmp_path / "library"
+    generate_library(directory, 24)
+    return directory
+
+
+def test_second_pass_writes_nothing(library: Path):
+    assert process_directory(library, full=True, workers=1) == []
+    first = snapshot(library)
+
+    assert process_directory(library, full=True, workers=1) == []
+    assert snapshot(library) == first
+
+
+def test_unchanged_tracks_are_skipped(library: Path):
+    process_directory(library, workers=1)
+    messages: list[str] = []
+    process_directory(library, workers=1, status_callback=messages.append)
+    assert messages[0] == "Processing 0 files (24 unchanged)..."
+
+
+def test_corrupt_tag_is_left_alone(tmp_path: Path):
+    mp3_path = tmp_path / "corrupt.mp3"
+    # An ID3v2.4 header claiming far more data than the file has
+    data = b"ID3\x04\x00\x00\x7f\x7f\x7f\x7f" + b"x" * 40 + SILENT_FRAME * 4
+    mp3_path.write_bytes(data)
+
+    [(path, changed, error, _)] = process_album([mp3_path])
+    assert path == mp3_path and not changed
+    assert error is not None
+    assert mp3_path.read_bytes() == data
+    assert not mp3_path.with_suffix(".json").exists()
+
+
+def test_missing_tag_starts_fresh(tmp_path: Path):
+    mp3_path = tmp_path / "untagged.mp3"
+    mp3_path.write_bytes(SILENT_FRAME * 4)
+
+    [(_, changed, error, _)] = process_album([mp3_path])
+    assert error is None and changed
+    assert mp3_path.with_suffix(".json").exists()
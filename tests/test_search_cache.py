@@ -0,0 +1,97 @@
+import logging
+import time
+from pathlib import Path
+
+import pytest
+from spotdl.types.song import Song, SongError
+
+import search_cache
+from search_cache import (
+    SEARCH_CACHE_LIST_TTL,
+    SEARCH_CACHE_NEGATIVE_TTL,
+    SEARCH_CACHE_TTL,
+    SearchCache,
+    cached_search,
+    normalize_query,
+)
+from songs import make_song
+
+PLAYLIST = "https://open.spotify.com/playlist/abc"
+
+
+@pytest.fixture
+def cache(tmp_path: Path) -> SearchCache:
+    return SearchCache(tmp_path / "search_cache.sqlite3")
+
+
+def expires_in(cache: SearchCache, query: str) -> float:
+    with cache.lock:
+        (expires_at,) = cache.conn.execute(
+            "SELECT expires_at FROM searches WHERE query = ?",
+            (normalize_query(query),),
+        ).fetchone()
+    return expires_at - time.time()
+
+
+def test_equivalent_queries_share_an_entry(cache: SearchCache):
+    song = make_song("a")
+    cache.put("https://open.spotify.com/track/a?si=123", [song])
+    [cached] = cache.get("https://open.spotify.com/track/a") or []
+    assert cached.url == song.url
+    cache.put("  Some   Song ", [song])
+    assert cache.get("some song") is not None
+
+
+def test_ttls(cache: SearchCache):
+    cache.put("track", [make_song("a")])
+    cache.put(PLAYLIST, [make_song("a")])
+    cache.put("nothing", [])
+    assert expires_in(cache, "track") == pytest.approx(SEARCH_CACHE_TTL, abs=5)
+    assert expires_in(cache, PLAYLIST) == pytest.approx(SEARCH_CACHE_LIST_TTL, abs=5)
+    assert expires_in(cache, "nothing") == pytest.approx(
+        SEARCH_CACHE_NEGATIVE_TTL, abs=5
+    )
+    assert cache.get("nothing") == []
+
+
+def test_expired_entries_miss(cache: SearchCache, monkeypatch):
+    cache.put(PLAYLIST, [make_song("a")])
+    now = time.time()
+    monkeypatch.setattr(
+        search_cache.time, "time", lambda: now + SEARCH_CACHE_LIST_TTL + 1
+    )
+    assert cache.get(PLAYLIST) is None
+
+
+def test_only_clean_searches_are_cached(cache: SearchCache):
+    searched: list[str] = []
+
+    def search(queries: list[str]) -> list[Song]:
+        [query] = queries
+        searched.append(query)
+        if query == "partial":
+            # How spotdl reports the songs it dropped from the results
+            logging.getLogger("spotdl.utils.search").error(
+                "%s generated an exception: %s", "Song b", "429 Too Many Requests"
+            )
+            return [make_song("a")]
+        if query == "missing":
+            raise SongError("No results found for song: missing")
+        if query == "broken":
+            raise ValueError("Invalid JSON data")
+        if query == "empty":
+            return []
+        return [make_song(query)]
+
+    queries = ["clean", "partial", "missing", "broken", "empty"]
+    songs = cached_search(search, queries, cache, threads=len(queries))
+    assert sorted(song.song_id for song in songs) == ["a", "clean"]
+
+    assert cache.get("clean") is not None
+    assert cache.get("missing") == []
+    for query in ("partial", "broken", "empty"):
+        assert cache.get(query) is None
+
+    searched.clear()
+    cached_search(search, queries, cache, threads=len(queries))
+    assert sorted(searched) == ["broken", "empty", "partial"]
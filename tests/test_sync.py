@@ -0,0 +1,93 @@
+import os
+import stat
+from pathlib import Path
+
+import pytest
+
+from metadata import sync
+from metadata.sync import (
+    atomic_write,
+    batched_fsyncs,
+    planning,
+    read_sidecar,
+    remove_sidecar,
+    write_sidecar,
+)
+
+
+def test_identical_content_is_not_rewritten(tmp_path: Path):
+    path = tmp_path / "track.lrc"
+    assert write_sidecar(path, b"lyrics")
+    os.utime(path, ns=(0, 0))
+
+    assert not write_sidecar(path, b"lyrics")
+    assert path.stat().st_mtime_ns == 0
+
+    # Same size, different content
+    assert write_sidecar(path, b"lyric!")
+    assert path.read_bytes() == b"lyric!"
+
+
+def test_replaced_files_keep_their_mode(tmp_path: Path):
+    path = tmp_path / "track.json"
+    path.write_bytes(b"{}")
+    path.chmod(0o640)
+    assert write_sidecar(path, b'{"title": "Title"}')
+    assert stat.S_IMODE(path.stat().st_mode) == 0o640
+
+
+def test_failed_writes_leave_nothing_behind(tmp_path: Path, monkeypatch):
+    path = tmp_path / "track.lrc"
+    path.write_bytes(b"old")
+
+    def fail(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(sync.os, "replace", fail)
+    with pytest.raises(OSError):
+        atomic_write(path, b"new")
+    assert path.read_bytes() == b"old"
+    assert [child.name for child in tmp_path.iterdir()] == ["track.lrc"]
+
+
+def test_plans_write_nothing(tmp_path: Path):
+    existing = tmp_path / "existing.lrc"
+    existing.write_bytes(b"old")
+    created = tmp_path / "created.lrc"
+
+    with planning() as plan:
+        assert write_sidecar(existing, b"new")
+        assert write_sidecar(created, b"new")
+        assert not write_sidecar(created, b"new")
+        # Later reads see the plan
+        assert read_sidecar(created) == b"new"
+        assert remove_sidecar(existing)
+        assert read_sidecar(existing) is None
+
+    assert plan.changes == [
+        (existing, "update"),
+        (created, "create"),
+        (existing, "delete"),
+    ]
+    assert existing.read_bytes() == b"old"
+    assert not created.exists()
+
+
+def test_batched_fsyncs_sync_each_directory_once(tmp_path: Path, monkeypatch):
+    synced: list[Path] = []
+    monkeypatch.setattr(sync, "fsync_directory", synced.append)
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+
+    with batched_fsyncs():
+        for name in ("a", "b", "c"):
+            write_sidecar(first / f"{name}.lrc", b"lyrics")
+        with batched_fsyncs():
+            write_sidecar(second / "a.lrc", b"lyrics")
+        remove_sidecar(first / "a.lrc")
+        assert synced == []
+    assert synced == [first, second]
+
+    write_sidecar(first / "d.lrc", b"lyrics")
+    assert synced == [first, second, first]
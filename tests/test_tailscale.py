@@ -0,0 +1,78 @@
+from typing import Optional
+
+import pytest
+
+import tailscale
+from tailscale import ExitNodeMonitor, node_name
+from tailscale_types import PeerNode
+
+
+def make_node(name: str) -> PeerNode:
+    return {  # type: ignore[typeddict-item]
+        "DNSName": f"{name}.tailnet.ts.net.",
+        "HostName": name,
+        "Relay": "fra",
+        "TailscaleIPs": ["100.64.0.1"],
+        "ExitNodeOption": True,
+        "Online": True,
+    }
+
+
+class FakeTailnet:
+    """Exit nodes with fixed pings, some of which don't pass any traffic."""
+
+    def __init__(self, latencies: dict[str, Optional[float]], offline: set[str]):
+        self.nodes = {name: make_node(name) for name in latencies}
+        self.latencies = latencies
+        self.offline = offline
+        self.exit_node: Optional[str] = None
+        self.switches: list[str] = []
+
+    def up(self, *, authkey=None, exit_node=None):
+        self.exit_node = exit_node.rstrip(".").split(".")[0]
+        self.switches.append(self.exit_node)
+
+    def ping(self, node: PeerNode) -> Optional[float]:
+        return self.latencies[node["HostName"]]
+
+    def public_ipv4(self, timeout: float = 60) -> str:
+        if self.exit_node is None or self.exit_node in self.offline:
+            raise RuntimeError("Failed to get public IPv4 address: timed out")
+        return "203.0.113.1"
+
+
+@pytest.fixture
+def tailnet(monkeypatch) -> FakeTailnet:
+    tailnet = FakeTailnet({"fast": 10, "medium": 40, "slow": 90}, offline={"fast"})
+    monkeypatch.setenv("TS_EXIT_NODE", "fast,medium,slow")
+    monkeypatch.setattr(
+        tailscale, "tailscale_exit_nodes", lambda: list(tailnet.nodes.values())
+    )
+    monkeypatch.setattr(tailscale, "tailscale_ping", tailnet.ping)
+    monkeypatch.setattr(tailscale, "tailscale_up", tailnet.up)
+    monkeypatch.setattr(tailscale, "get_public_ipv4", tailnet.public_ipv4)
+    monkeypatch.setattr(tailscale.time, "sleep", lambda seconds: None)
+    return tailnet
+
+
+def test_fails_over_past_a_node_without_internet(tailnet: FakeTailnet):
+    monitor = ExitNodeMonitor()
+    monitor.check()
+    assert tailnet.switches == ["fast", "medium"]
+    assert monitor.current == node_name(tailnet.nodes["medium"])
+    assert monitor.healthy
+    assert "can't reach the internet" in monitor.message
+
+    # The working node is kept on the next check
+    monitor.check()
+    assert tailnet.switches == ["fast", "medium"]
+    assert monitor.healthy
+
+
+def test_unhealthy_only_when_no_node_passes_traffic(tailnet: FakeTailnet):
+    tailnet.offline = {"fast", "medium", "slow"}
+    monitor = ExitNodeMonitor()
+    monitor.check()
+    assert tailnet.switches == ["fast", "medium", "slow"]
+    assert not monitor.healthy
+    assert "none of the exit nodes can reach the internet" in monitor.message
@@ -0,0 +1,45 @@
+import threading
+from pathlib import Path
+from typing import Optional
+
+import tracing
+from tracing import Trace, span, trace
+
+
+def test_one_trace_is_profiled_at_a_time(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(tracing, "TRACING", True)
+    monkeypatch.setattr(tracing, "PROFILE_SAMPLE_RATE", 1)
+    monkeypatch.setattr(tracing, "PROFILES_PATH", tmp_path)
+    both_started = threading.Barrier(2)
+    traces: dict[str, Optional[Trace]] = {}
+    errors: list[BaseException] = []
+
+    def job(name: str):
+        try:
+            with trace(name, profile=True) as current:
+                both_started.wait(timeout=10)
+                with span("work"):
+                    sum(range(1000))
+                both_started.wait(timeout=10)
+            traces[name] = current
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=job, args=(name,)) for name in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    profiled = [
+        current for current in traces.values() if current and current.profile_path
+    ]
+    assert len(profiled) == 1
+    assert Path(profiled[0].profile_path).exists()  # type: ignore[arg-type]
+    assert all(current and current.spans for current in traces.values())
+
+    # Once it's done, the next sampled trace is profiled again
+    with trace("c", profile=True) as current:
+        pass
+    assert current is not None and current.profile_path is not None
@@ -0,0 +1,34 @@
+from pathlib import Path
+
+from mutagen.id3 import ID3
+
+from benchmark import generate_library
+from metadata.library import get_library_index
+from metadata.main import process_directory
+from metadata.tags import parse_id3_tags, tags_to_json
+from watch import LibraryWatcher, process_changed
+
+
+def test_changes_are_handed_to_the_job_queue(tmp_path: Path):
+    library = tmp_path / "library"
+    generate_library(library, 3)
+    process_directory(library, workers=1)
+    edited, deleted, untouched = sorted(library.rglob("*.mp3"))
+
+    tags = parse_id3_tags(ID3(edited))
+    tags.title = "Edited"
+    edited.with_suffix(".json").write_text(tags_to_json(tags))
+    deleted.unlink()
+
+    batches: list[list[Path]] = []
+    watcher = LibraryWatcher(library, enqueue=batches.append)
+    watcher.process_batch({edited, deleted, untouched})
+    assert batches == [[edited, deleted]]
+
+    process_changed(batches[0])
+    assert str(ID3(edited)["TIT2"]) == "Edited"
+    assert not get_library_index().contains(deleted)
+
+    # The writes of the job itself don't queue another one
+    watcher.process_batch({edited})
+    assert len(batches) == 1